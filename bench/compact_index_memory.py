@@ -0,0 +1,76 @@
+"""วัดหน่วยความจำและเวลาสร้างดัชนี id -> offset: dict เทียบกับ CompactIndex
+
+    python bench/compact_index_memory.py [จำนวนรายการ]     (ค่าเริ่มต้น 1,000,000)
+
+แต่ละกรณีรันใน process ใหม่ แล้ววัด peak RSS ที่เพิ่มขึ้นระหว่างสร้างดัชนี (ru_maxrss, ใช้ได้บน Linux/macOS)
+array ของ key/offset ที่ป้อนเข้าไปถูกสร้างก่อนจุดวัด จึงไม่นับรวมในผล
+- dict: dict(zip(keys, offsets)) แบบที่ FixedRecordFile เคยใช้
+- sorted: key เรียงตามลำดับในไฟล์อยู่แล้ว (กรณีปกติ)
+- nearly: เรียงแล้วสลับตำแหน่งไว้ 2%
+- random: ลำดับสุ่มทั้งหมด"""
+import os
+import random
+import resource
+import subprocess
+import sys
+import time
+from array import array
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cpro  # noqa: E402
+
+CASES = ('dict', 'sorted', 'nearly', 'random')
+
+
+def make_keys(case, n, seed=1):
+    rnd = random.Random(seed)
+    keys = array('q', range(1, n + 1))
+    if case == 'nearly':
+        for _ in range(n // 100):                 # สลับ 1% ของคู่ = 2% ของรายการ
+            i, j = rnd.randrange(n), rnd.randrange(n)
+            keys[i], keys[j] = keys[j], keys[i]
+    elif case in ('random', 'dict'):
+        rnd.shuffle(keys)                         # สลับใน array ตรง ๆ ไม่ให้ list ชั่วคราวดัน peak ก่อนวัด
+    return keys
+
+
+def peak_rss():
+    """peak RSS ของ process นี้เป็นไบต์ (Linux รายงานเป็น KB, macOS เป็นไบต์)"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def run_case(case, n):
+    keys = make_keys(case, n)
+    offsets = array('q', (cpro.HEADER_SIZE + i * 64 for i in range(n)))
+    base = peak_rss()
+    t = time.perf_counter()
+    if case == 'dict':
+        idx = dict(zip(keys, offsets))
+    else:
+        idx = cpro.CompactIndex()
+        idx.load(keys, offsets)
+    elapsed = time.perf_counter() - t
+    grown = peak_rss() - base
+    assert len(idx) == n
+    return grown, elapsed
+
+
+def main():
+    if sys.argv[1:2] == ['--case']:
+        grown, elapsed = run_case(sys.argv[2], int(sys.argv[3]))
+        print(grown, elapsed)
+        return
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    print(f"{n:,} รายการ")
+    print(f"{'กรณี':<10}{'peak RSS เพิ่ม':>16}{'ต่อรายการ':>12}{'เวลา':>10}")
+    for case in CASES:
+        out = subprocess.run([sys.executable, os.path.abspath(__file__), '--case', case, str(n)],
+                             check=True, capture_output=True, text=True).stdout.split()
+        grown, elapsed = int(out[0]), float(out[1])
+        print(f"{case:<10}{grown / 2 ** 20:>13.1f} MB{grown / n:>10.1f} B{elapsed:>9.2f} s")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,22 @@
 
+import io
 import os
+import sys
+import json
+import time
+import zlib
+import heapq
+import itertools
+import bisect
+import queue
 import struct
+import threading
+import unicodedata
+from array import array
 from datetime import datetime
+from operator import itemgetter
 from collections import Counter
+from contextlib import contextmanager
 
 # --------------------------
 # ค่าคงที่: ชื่อไฟล์ต่าง ๆ
@@ -26,6 +40,13 @@ def from_fixed_bytes(b: bytes) -> str:
     """แปลง bytes (ที่มี \x00 padding) กลับเป็นสตริง (UTF-8)"""
     return b.split(b'\x00', 1)[0].decode('utf-8', errors='ignore')
 
+_ZERO_WIDTH = dict.fromkeys(map(ord, '\u200b\u200c\u200d\ufeff'), None)
+
+def normalize_text(text: str) -> str:
+    """ทำข้อความให้อยู่ในรูปมาตรฐานสำหรับค้นหา (ตัด zero-width, NFKC, casefold)
+    NFKC ทำให้ 'ำ' กับ 'ํ'+'า' ที่พิมพ์ต่างกันกลายเป็นรูปเดียวกัน"""
+    return unicodedata.normalize('NFKC', text.translate(_ZERO_WIDTH)).casefold().strip()
+
 def input_int(prompt: str, allow_zero=True, positive_only=False):
     while True:
         s = input(prompt).strip()
@@ -85,112 +106,678 @@ NB_SIZE = struct.calcsize(NB_FMT)
 SO_FMT = '<I I I I 12s 12s I'          # is_deleted, sold_out_id, notebook_id, customer_id, name, sold_date, status
 SO_SIZE = struct.calcsize(SO_FMT)
 
+# --------------------------
+# ส่วนหัวไฟล์ (file header)
+# magic, version, record_size, record_count, live_count, hole_count, generation, flags
+# ไฟล์เก่าที่ไม่มี header (legacy) ยังอ่าน/เขียนได้ แต่ stats() ต้องสแกนทั้งไฟล์
+# version 1 ไม่มี flags (ช่องนั้นเป็น padding ที่เป็นศูนย์) จึงอ่านเป็น flags=0 ได้เลย
+# --------------------------
+FILE_MAGIC = b'NBDB'
+FORMAT_VERSION = 2
+HEADER_FMT = '<4s H H I Q Q Q Q I'
+FLAG_CRC = 0x1                          # ทุกช่องมี CRC32 (4 bytes) ต่อท้ายระเบียน
+CRC_SIZE = 4
+HEADER_SIZE = 64                        # เผื่อที่ว่างไว้สำหรับฟิลด์ในอนาคต
+HEADER_PAD = HEADER_SIZE - struct.calcsize(HEADER_FMT)
+
+class CorruptFileError(ValueError):
+    """ไฟล์ข้อมูลเสียหาย หรือรูปแบบไม่ตรงกับที่โปรแกรมรู้จัก"""
+
+def pack_header(record_size, record_count, live, holes, generation, flags=0):
+    return struct.pack(HEADER_FMT, FILE_MAGIC, FORMAT_VERSION, HEADER_SIZE,
+                       record_size, record_count, live, holes, generation, flags) + b'\x00' * HEADER_PAD
+
+def read_header(f):
+    """อ่าน header จากต้นไฟล์ที่เปิดอยู่ คืน dict หรือ None ถ้าเป็นไฟล์ legacy (ไม่มี magic)"""
+    f.seek(0)
+    raw = f.read(HEADER_SIZE)
+    if raw[:4] != FILE_MAGIC:
+        return None
+    if len(raw) < HEADER_SIZE:
+        raise CorruptFileError("header ไม่ครบ")
+    magic, version, hsize, rsize, count, live, holes, gen, flags = struct.unpack_from(HEADER_FMT, raw)
+    if version > FORMAT_VERSION or hsize != HEADER_SIZE:
+        raise CorruptFileError(f"ไม่รองรับรูปแบบไฟล์ version={version} header={hsize}")
+    return {'version': version, 'record_size': rsize, 'record_count': count,
+            'live': live, 'holes': holes, 'generation': gen, 'flags': flags}
+
+def record_crc(packed: bytes) -> bytes:
+    return struct.pack('<I', zlib.crc32(packed))
+
 # --------------------------
 # ชั้นจัดการไฟล์ไบนารีทั่วไป
 # --------------------------
+# ล็อกร่วมของทุกแฟ้ม: ถือไว้สั้น ๆ ตอนเขียนหนึ่งช่อง และตอนสร้าง snapshot
+# งานที่ต้องแก้หลายแฟ้มพร้อมกัน (เช่น การขาย) ถือล็อกนี้ครอบไว้เพื่อให้ snapshot เห็นทั้งหมดหรือไม่เห็นเลย
+STORE_LOCK = threading.RLock()
+
+class CompactIndex:
+    """ดัชนี id -> offset แบบประหยัดหน่วยความจำ ใช้แทน dict ใน FixedRecordFile.index
+    ข้อมูลหลักเก็บเป็น array('q') ของ key และ offset ที่เรียงตาม key (16 bytes ต่อรายการ) ค้นด้วย bisect
+    key ใหม่ไปอยู่ใน dict เล็ก ๆ (delta) ส่วนการลบ key ในส่วนหลักจะตั้ง offset เป็น TOMB
+    เมื่อ delta + ที่ถูกลบ เกินราว 1/32 ของส่วนหลัก จะรวมเข้าไปใหม่ในครั้งเดียว
+    รองรับ in / [] / get / pop / del / len / iter / keys / values / items / clear เหมือน dict
+    (ลำดับการวนไม่ใช่ลำดับที่เพิ่ม)"""
+    TOMB = -1
+    MERGE_MIN = 1024
+
+    def __init__(self, pairs=()):
+        self._base = (array('q'), array('q'))   # (keys, offsets) สลับทั้งคู่พร้อมกันตอนรวม
+        self._delta = {}
+        self._dead = set()                      # key ในส่วนหลักที่ถูกลบแล้ว
+        if pairs:
+            self.update(pairs)
+
+    def _find(self, key):
+        keys, offs = self._base
+        try:
+            i = bisect.bisect_left(keys, key)
+        except TypeError:
+            return -1           # key ที่ไม่ใช่ตัวเลข: ไม่มีในดัชนี เหมือน dict
+        if i < len(keys) and keys[i] == key:
+            return i
+        return -1
+
+    def __contains__(self, key):
+        if key in self._delta:
+            return True
+        i = self._find(key)
+        return i >= 0 and self._base[1][i] != self.TOMB
+
+    def get(self, key, default=None):
+        value = self._delta.get(key)
+        if value is not None:
+            return value
+        i = self._find(key)
+        if i >= 0:
+            value = self._base[1][i]
+            if value != self.TOMB:
+                return value
+        return default
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, offset):
+        if key in self._delta:
+            self._delta[key] = offset
+            return
+        i = self._find(key)
+        if i >= 0:
+            self._base[1][i] = offset
+            self._dead.discard(key)
+        else:
+            self._delta[key] = offset
+            self._maybe_merge()
+
+    def __delitem__(self, key):
+        if self._delta.pop(key, None) is not None:
+            return
+        i = self._find(key)
+        if i < 0 or self._base[1][i] == self.TOMB:
+            raise KeyError(key)
+        self._base[1][i] = self.TOMB
+        self._dead.add(key)
+        self._maybe_merge()
+
+    def pop(self, key, *default):
+        value = self.get(key)
+        if value is None:
+            if default:
+                return default[0]
+            raise KeyError(key)
+        del self[key]
+        return value
+
+    def __len__(self):
+        return len(self._base[0]) - len(self._dead) + len(self._delta)
+
+    def __iter__(self):
+        return (k for k, _ in self.items())
+
+    def keys(self):
+        return iter(self)
+
+    def values(self):
+        return (v for _, v in self.items())
+
+    def items(self):
+        keys, offs = self._base
+        for k, v in zip(keys, offs):
+            if v != self.TOMB:
+                yield k, v
+        yield from list(self._delta.items())
+
+    def clear(self):
+        self._base = (array('q'), array('q'))
+        self._delta = {}
+        self._dead = set()
+
+    def update(self, pairs):
+        """เพิ่มหลายรายการ: ถ้าดัชนียังว่างจะสร้างส่วนหลักทีเดียวด้วย load() ไม่ผ่าน delta"""
+        if len(self):
+            for key, offset in pairs:
+                self[key] = offset
+            return
+        keys, offs = array('q'), array('q')
+        for key, offset in pairs:
+            keys.append(key)
+            offs.append(offset)
+        self.load(keys, offs)
+
+    def load(self, keys, offsets):
+        """แทนที่ข้อมูลทั้งหมดด้วย array('q') ของ key/offset ที่คู่กันตามตำแหน่ง (key ซ้ำใช้ตัวหลังสุดเหมือน dict)
+        array ที่ส่งมาจะถูกใช้เป็นส่วนหลักหรือถูกล้างทิ้ง; ไม่สร้าง object ต่อรายการนอกจากชิ้นละ SORT_CHUNK ตอนเรียง
+        ไฟล์ส่วนใหญ่เกือบเรียงตาม id อยู่แล้ว: แยกลำดับที่เพิ่มขึ้นออกมาในรอบเดียว เรียงเฉพาะส่วนที่หลุดลำดับ
+        แล้วรวมกลับแบบคัดลอกเป็นช่วง ๆ"""
+        if all(a < b for a, b in zip(keys, itertools.islice(keys, 1, None))):
+            self._base = (keys, offsets)    # เรียงอยู่แล้ว (กรณีปกติ): ใช้ array เดิมได้เลย
+            self._delta = {}
+            self._dead = set()
+            return
+        run_k, run_o, run_p = array('q'), array('q'), array('q')
+        rest_k, rest_o, rest_p = array('q'), array('q'), array('q')
+        # แยกลำดับที่เพิ่มขึ้นออกมา: key ที่น้อยกว่าตัวท้ายจะดันตัวท้ายที่มากกว่าออกไปได้ไม่เกิน RUN_BACKTRACK ตัว
+        # (id ใหญ่ที่ไปอยู่ในช่องว่างต้นไฟล์จึงไม่ตัดทั้งลำดับ) ที่เหลือเก็บพร้อมตำแหน่งเดิมไว้ตัดสินตอน key ซ้ำ
+        for pos, (key, offset) in enumerate(zip(keys, offsets)):
+            if pos == self.SORT_CHUNK and len(rest_k) * 2 > pos:
+                # ไม่ได้เกือบเรียง: ส่งทั้งหมดไปเรียงแบบแบ่งชิ้นแทน
+                rest_k += run_k + keys[pos:]
+                rest_o += run_o + offsets[pos:]
+                rest_p += run_p + array('q', range(pos, len(keys)))
+                run_k, run_o, run_p = array('q'), array('q'), array('q')
+                break
+            if run_k and key <= run_k[-1]:
+                start = max(0, len(run_k) - self.RUN_BACKTRACK)
+                cut = bisect.bisect_right(run_k, key, start)
+                if cut == start and start > 0 or cut > 0 and run_k[cut - 1] == key:
+                    rest_k.append(key)
+                    rest_o.append(offset)
+                    rest_p.append(pos)
+                    continue
+                rest_k += run_k[cut:]
+                rest_o += run_o[cut:]
+                rest_p += run_p[cut:]
+                del run_k[cut:], run_o[cut:], run_p[cut:]
+            run_k.append(key)
+            run_o.append(offset)
+            run_p.append(pos)
+        del keys[:], offsets[:]
+        if rest_k and run_k:
+            rest = self._sort_pairs(rest_k, rest_o, rest_p, keep_positions=True)
+            run_k, run_o = self._merge_sorted(run_k, run_o, run_p, *rest)
+        elif rest_k:
+            run_k, run_o, _ = self._sort_pairs(rest_k, rest_o, rest_p)
+        self._base = (run_k, run_o)
+        self._delta = {}
+        self._dead = set()
+
+    RUN_BACKTRACK = 8
+    SORT_CHUNK = 1 << 16
+
+    @classmethod
+    def _sort_pairs(cls, keys, offsets, positions, keep_positions=False):
+        # เรียงทีละชิ้นแล้ว merge ทุกชิ้นพร้อมกัน; key ซ้ำเก็บตัวที่ตำแหน่งเดิมหลังสุด
+        # คืน array ตำแหน่งเดิมด้วยเมื่อ keep_positions (ใช้ตัดสิน key ซ้ำตอนรวมกับลำดับหลัก)
+        runs = []
+        for lo in range(0, len(keys), cls.SORT_CHUNK):
+            order = sorted(range(lo, min(lo + cls.SORT_CHUNK, len(keys))), key=keys.__getitem__)
+            runs.append((array('q', (keys[i] for i in order)), array('q', (offsets[i] for i in order)),
+                         array('q', (positions[i] for i in order))))
+        del keys[:], offsets[:], positions[:]
+        out_k, out_o, out_p = array('q'), array('q'), array('q')
+        last = last_pos = None
+        for key, offset, pos in heapq.merge(*(zip(*run) for run in runs), key=itemgetter(0)):
+            if key == last:
+                if pos > last_pos:
+                    out_o[-1] = offset
+                    last_pos = pos
+                    if keep_positions:
+                        out_p[-1] = pos
+            else:
+                out_k.append(key)
+                out_o.append(offset)
+                if keep_positions:
+                    out_p.append(pos)
+                last, last_pos = key, pos
+        return out_k, out_o, out_p
+
+    @staticmethod
+    def _merge_sorted(ka, oa, pa, kb, ob, pb):
+        # รวมสองชุดที่เรียงและไม่มี key ซ้ำในชุด คัดลอกเป็นช่วงด้วย bisect; key ตรงกันใช้ตัวที่ตำแหน่งเดิมหลังกว่า
+        out_k, out_o = array('q'), array('q')
+        i = j = 0
+        while i < len(ka) and j < len(kb):
+            e = bisect.bisect_left(ka, kb[j], i)
+            out_k += ka[i:e]
+            out_o += oa[i:e]
+            i = e
+            if i < len(ka) and ka[i] == kb[j]:
+                if pa[i] > pb[j]:
+                    ob[j] = oa[i]
+                i += 1
+            if i == len(ka):
+                break
+            e = bisect.bisect_left(kb, ka[i], j)
+            if e < len(kb) and kb[e] == ka[i]:
+                if pa[i] > pb[e]:
+                    ob[e] = oa[i]
+                e += 1
+                i += 1
+            out_k += kb[j:e]
+            out_o += ob[j:e]
+            j = e
+        out_k += ka[i:]
+        out_o += oa[i:]
+        out_k += kb[j:]
+        out_o += ob[j:]
+        return out_k, out_o
+
+    def _maybe_merge(self):
+        if len(self._delta) + len(self._dead) > max(self.MERGE_MIN, len(self._base[0]) >> 5):
+            self.merge()
+
+    def merge(self):
+        """รวม delta และตัดรายการที่ถูกลบออกจากส่วนหลัก: คัดลอกส่วนหลักเป็นช่วง ๆ ครั้งเดียว"""
+        keys, offs = self._base
+        delta, dead = self._delta, self._dead
+        pending = sorted([*delta, *dead])
+        if not pending:
+            return
+        if not dead and (not keys or pending[0] > keys[-1]):
+            # กรณีที่พบบ่อย: id ใหม่มากกว่าทุก id เดิม ต่อท้ายได้เลย
+            keys, offs = keys[:], offs[:]
+            keys.extend(pending)
+            offs.extend(delta[k] for k in pending)
+            self._base = (keys, offs)
+            self._delta = {}
+            return
+        new_keys, new_offs = array('q'), array('q')
+        start = 0
+        for key in pending:
+            i = bisect.bisect_left(keys, key, start)
+            if i > start:
+                new_keys += keys[start:i]
+                new_offs += offs[start:i]
+            if key in dead:
+                start = i + 1
+            else:
+                new_keys.append(key)
+                new_offs.append(delta[key])
+                start = i
+        new_keys += keys[start:]
+        new_offs += offs[start:]
+        self._base = (new_keys, new_offs)
+        self._delta = {}
+        self._dead = set()
+
+    def memory_usage(self):
+        """ขนาดโดยประมาณ (bytes) ของ array ส่วนหลักและ delta"""
+        keys, offs = self._base
+        return (keys.buffer_info()[1] * keys.itemsize + offs.buffer_info()[1] * offs.itemsize
+                + sys.getsizeof(self._delta) + 64 * len(self._delta) + sys.getsizeof(self._dead))
+
+    def __repr__(self):
+        return f"CompactIndex({len(self)} entries)"
+
 class FixedRecordFile:
-    def __init__(self, path: str, fmt: str, size: int, key_field: str):
+    def __init__(self, path: str, fmt: str, size: int, key_field: str, checksums=False):
         self.path = path
         self.fmt = fmt
         self.size = size
+        self.stride = size          # ขนาดช่องในไฟล์ (ระเบียน + CRC ถ้าเปิดใช้)
+        self.checksums = checksums  # ใช้กับไฟล์ที่สร้างใหม่เท่านั้น ไฟล์เดิมเป็นไปตาม header
         self.key_field = key_field  # ชื่อฟิลด์ id ที่ใช้เป็น key
-        self.index = {}             # map: id -> offset
+        self.index = CompactIndex() # map: id -> offset (นับจากต้นไฟล์ รวม header)
         self.free_offsets = []      # รายการตำแหน่งที่ is_deleted=1
+        self.listeners = []         # callback(op, id, offset, before, after) เมื่อมีการเขียน
+        self.header = None          # dict จาก read_header (None = ไฟล์ legacy)
+        self.data_start = 0         # ตำแหน่งระเบียนแรก
+        self.version = 0            # เพิ่มทีละ 1 ทุกครั้งที่เขียน (ใช้กับ snapshot)
+        self._snapshots = []        # Snapshot ที่ยังเปิดอยู่
+        self._cow = {}              # offset -> [(version ที่เขียนทับ, bytes เดิม)] เก็บเฉพาะตอนมี snapshot
+        self._gone = {}             # id -> [(version ที่ลบ, offset เดิม)] ให้ snapshot หาระเบียนที่ถูกลบได้
+        self.dirty = None           # offset -> ความยาวของช่วงที่ถูกเขียน (None = ไม่ติดตาม) ใช้กับ replication
         self._ensure_file()
         self._scan()
 
+    def add_listener(self, fn):
+        """ลงทะเบียน callback ที่จะถูกเรียกหลัง add/update/delete สำเร็จ"""
+        self.listeners.append(fn)
+
+    def _notify(self, op, record_id, offset, before, after):
+        for fn in self.listeners:
+            fn(op, record_id, offset, before, after)
+
+    def _read_at(self, offset: int):
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            return self._unpack_slot(f.read(self.stride), offset)
+
+    def _seal(self, packed: bytes) -> bytes:
+        """ต่อ CRC32 ท้ายระเบียน ถ้าไฟล์เปิดใช้ checksum"""
+        if self.stride != self.size:
+            return packed + record_crc(packed)
+        return packed
+
+    def _unpack_slot(self, chunk: bytes, offset: int):
+        """แปลงข้อมูลหนึ่งช่องเป็น tuple และตรวจ CRC (ถ้ามี)"""
+        data = chunk[:self.size]
+        if self.stride != self.size and chunk[self.size:] != record_crc(data):
+            raise CorruptFileError(f"{self.path}: CRC ไม่ตรงที่ offset {offset}")
+        return struct.unpack(self.fmt, data)
+
     def _ensure_file(self):
-        if not os.path.exists(self.path):
+        """ไฟล์ใหม่ (หรือไฟล์ว่าง) จะถูกสร้างพร้อม header"""
+        if not os.path.exists(self.path) or os.path.getsize(self.path) == 0:
             with open(self.path, 'wb') as f:
-                pass
+                f.write(pack_header(self.size, 0, 0, 0, 0, FLAG_CRC if self.checksums else 0))
+
+    def _open_header(self, f):
+        """อ่านและตรวจ header เทียบกับขนาดไฟล์จริง"""
+        self.header = read_header(f)
+        if self.header is None:
+            self.data_start = 0
+            self.stride = self.size
+            return
+        h = self.header
+        if h['record_size'] != self.size:
+            raise CorruptFileError(f"{self.path}: ขนาดระเบียน {h['record_size']} ไม่ตรงกับ {self.size}")
+        self.stride = self.size + (CRC_SIZE if h['flags'] & FLAG_CRC else 0)
+        expected = HEADER_SIZE + h['record_count'] * self.stride
+        actual = f.seek(0, os.SEEK_END)
+        if actual != expected or h['live'] + h['holes'] != h['record_count']:
+            raise CorruptFileError(f"{self.path}: header ระบุ {expected} bytes แต่ไฟล์มี {actual} bytes "
+                                   f"(ใช้ migrate_file เพื่อซ่อม)")
+        self.data_start = HEADER_SIZE
+
+    def _mark_dirty(self, offset, length):
+        if self.dirty is not None:
+            if length > self.dirty.get(offset, 0):
+                self.dirty[offset] = length
+
+    def take_dirty(self):
+        """คืนช่วงที่ถูกเขียนตั้งแต่ครั้งก่อนเป็น list[(offset, length)] ที่เรียงและรวมช่วงติดกันแล้ว
+        แล้วเริ่มติดตามรอบใหม่; คืน None ถ้ายังไม่เคยติดตาม หรือไฟล์ถูกเขียนใหม่ทั้งไฟล์ (ต้องสำเนาทั้งไฟล์)"""
+        with STORE_LOCK:
+            dirty, self.dirty = self.dirty, {}
+        if dirty is None:
+            return None
+        ranges = []
+        for offset, length in sorted(dirty.items()):
+            if ranges and offset <= ranges[-1][0] + ranges[-1][1]:
+                last = ranges[-1]
+                last[1] = max(last[1], offset + length - last[0])
+            else:
+                ranges.append([offset, length])
+        return [tuple(r) for r in ranges]
+
+    def _write_header(self, f):
+        h = self.header
+        h['generation'] += 1
+        self._mark_dirty(0, HEADER_SIZE)
+        f.seek(0)
+        f.write(pack_header(self.size, h['record_count'], h['live'], h['holes'], h['generation'], h['flags']))
 
     def _scan(self):
         """อ่านทั้งไฟล์ สร้างดัชนีและรายการช่องว่าง"""
         self.index.clear()
         self.free_offsets.clear()
         with open(self.path, 'rb') as f:
-            offset = 0
+            self._open_header(f)
+            f.seek(self.data_start)
+            offset = self.data_start
+            keys, offsets = array('q'), array('q')
             while True:
-                chunk = f.read(self.size)
-                if not chunk or len(chunk) < self.size:
+                chunk = f.read(self.stride)
+                if not chunk or len(chunk) < self.stride:
                     break
-                rec = struct.unpack(self.fmt, chunk)
+                rec = struct.unpack(self.fmt, chunk[:self.size])
                 is_deleted = rec[0]
                 # key อยู่ตำแหน่ง 1 เสมอ (หลัง is_deleted)
                 key = rec[1]
                 if is_deleted == 1:
                     self.free_offsets.append(offset)
                 else:
-                    self.index[key] = offset
-                offset += self.size
-
-    def _write_at(self, offset: int, packed: bytes):
-        with open(self.path, 'r+b') as f:
+                    keys.append(key)
+                    offsets.append(offset)
+                offset += self.stride
+        self.index.load(keys, offsets)
+
+    def _write_at(self, offset: int, packed: bytes, live=0, holes=0):
+        """เขียนทับระเบียน แล้วปรับตัวนับใน header (ถ้ามี) ในการเปิดไฟล์ครั้งเดียวกัน
+        ถ้ามี snapshot เปิดอยู่ จะเก็บข้อมูลเดิมของช่องนี้ไว้ก่อนเขียนทับ (copy-on-write)"""
+        with STORE_LOCK, open(self.path, 'r+b') as f:
+            if self._snapshots and offset < max(sn.end for sn in self._snapshots):
+                f.seek(offset)
+                self._cow.setdefault(offset, []).append((self.version + 1, f.read(self.stride)))
             f.seek(offset)
-            f.write(packed)
+            f.write(self._seal(packed))
+            self._mark_dirty(offset, self.stride)
+            if self.header is not None:
+                self.header['live'] += live
+                self.header['holes'] += holes
+                self._write_header(f)
+            self.version += 1
 
     def _append(self, packed: bytes) -> int:
-        with open(self.path, 'ab') as f:
-            pos = f.tell()
-            f.write(packed)
+        with STORE_LOCK, open(self.path, 'r+b') as f:
+            pos = f.seek(0, os.SEEK_END)
+            f.write(self._seal(packed))
+            self._mark_dirty(pos, self.stride)
+            if self.header is not None:
+                self.header['record_count'] += 1
+                self.header['live'] += 1
+                self._write_header(f)
+            self.version += 1
             return pos
 
     def add(self, packed_with_id: bytes, record_id: int):
-        """เพิ่มระเบียนใหม่: ถ้ามีช่องว่าง (deleted) จะเขียนทับก่อน มิฉะนั้น append"""
-        if record_id in self.index:
-            raise ValueError(f"ID {record_id} มีอยู่แล้ว")
-        if self.free_offsets:
-            offset = self.free_offsets.pop(0)
-            self._write_at(offset, packed_with_id)
-            self.index[record_id] = offset
-        else:
-            offset = self._append(packed_with_id)
-            self.index[record_id] = offset
+        """เพิ่มระเบียนใหม่: ถ้ามีช่องว่าง (deleted) จะเขียนทับก่อน มิฉะนั้น append
+        ตรวจ id, เขียน และแจ้ง listener อยู่ใน STORE_LOCK เดียวกัน ลำดับเหตุการณ์จึงตรงกับลำดับที่เขียนจริง"""
+        with STORE_LOCK:
+            if record_id in self.index:
+                raise ValueError(f"ID {record_id} มีอยู่แล้ว")
+            if self.free_offsets:
+                offset = self.free_offsets.pop(0)
+                self._write_at(offset, packed_with_id, live=1, holes=-1)
+                self.index[record_id] = offset
+            else:
+                offset = self._append(packed_with_id)
+                self.index[record_id] = offset
+            if self.listeners:
+                self._notify('add', record_id, offset, None, struct.unpack(self.fmt, packed_with_id))
         return offset
 
     def get(self, record_id: int):
-        if record_id not in self.index:
+        offset = self.index.get(record_id)
+        if offset is None:
             return None, None
-        offset = self.index[record_id]
+        return offset, self._read_at(offset)
+
+    def get_many(self, record_ids):
+        """อ่านหลายระเบียนในการเปิดไฟล์ครั้งเดียว (อ่านเรียงตาม offset) คืน dict id -> rec"""
+        index = self.index
+        found = ((index.get(rid), rid) for rid in set(record_ids))
+        pairs = sorted(p for p in found if p[0] is not None)
+        out = {}
         with open(self.path, 'rb') as f:
-            f.seek(offset)
-            data = f.read(self.size)
-        return offset, struct.unpack(self.fmt, data)
+            for offset, rid in pairs:
+                f.seek(offset)
+                out[rid] = self._unpack_slot(f.read(self.stride), offset)
+        return out
+
+    def add_many(self, items):
+        """append หลายระเบียนต่อท้ายไฟล์ด้วยการเขียนครั้งเดียว (ไม่ใช้ช่องว่าง)
+        items: list[(record_id, packed)] คืน list ของ offset"""
+        ids = [rid for rid, _ in items]
+        blob = b''.join(self._seal(packed) for _, packed in items)
+        with STORE_LOCK:
+            if len(set(ids)) != len(ids) or any(rid in self.index for rid in ids):
+                raise ValueError("มี ID ซ้ำในชุดข้อมูลหรือมีอยู่แล้วในแฟ้ม")
+            if not items:
+                return []
+            with open(self.path, 'r+b') as f:
+                pos = f.seek(0, os.SEEK_END)
+                f.write(blob)
+                self._mark_dirty(pos, len(blob))
+                if self.header is not None:
+                    self.header['record_count'] += len(items)
+                    self.header['live'] += len(items)
+                    self._write_header(f)
+                self.version += 1
+            offsets = [pos + i * self.stride for i in range(len(items))]
+            for rid, offset in zip(ids, offsets):
+                self.index[rid] = offset
+            if self.listeners:
+                for (rid, packed), offset in zip(items, offsets):
+                    self._notify('add', rid, offset, None, struct.unpack(self.fmt, packed))
+        return offsets
+
+    def update_many(self, items):
+        """เขียนทับหลายระเบียนในการเปิดไฟล์ครั้งเดียว เรียงตาม offset เพื่อให้ seek ไปทางเดียว
+        items: list[(record_id, packed)]"""
+        if not items:
+            return
+        with STORE_LOCK:
+            missing = [rid for rid, _ in items if rid not in self.index]
+            if missing:
+                raise ValueError(f"ไม่พบ ID {', '.join(map(str, missing))}")
+            work = sorted((self.index[rid], rid, packed) for rid, packed in items)
+            changes = []
+            with open(self.path, 'r+b') as f:
+                limit = max((sn.end for sn in self._snapshots), default=0)
+                ver = self.version + 1
+                for offset, rid, packed in work:
+                    before = None
+                    if self.listeners or offset < limit:
+                        f.seek(offset)
+                        old = f.read(self.stride)
+                        if offset < limit:
+                            self._cow.setdefault(offset, []).append((ver, old))
+                        before = struct.unpack(self.fmt, old[:self.size])
+                    f.seek(offset)
+                    f.write(self._seal(packed))
+                    self._mark_dirty(offset, self.stride)
+                    changes.append((rid, offset, before, packed))
+                if self.header is not None:
+                    self._write_header(f)
+                self.version = ver
+            if self.listeners:
+                for rid, offset, before, packed in changes:
+                    self._notify('update', rid, offset, before, struct.unpack(self.fmt, packed))
 
     def update(self, record_id: int, packed: bytes):
-        if record_id not in self.index:
-            raise ValueError(f"ไม่พบ ID {record_id}")
-        offset = self.index[record_id]
-        self._write_at(offset, packed)
-
-    def delete(self, record_id: int):
-        if record_id not in self.index:
-            raise ValueError(f"ไม่พบ ID {record_id}")
-        offset = self.index.pop(record_id)
-        # ตั้ง is_deleted=1 ที่ระเบียนนี้ โดยไม่เปลี่ยนข้อมูลอื่น
-        with open(self.path, 'r+b') as f:
-            f.seek(offset)
-            data = f.read(self.size)
-            rec = list(struct.unpack(self.fmt, data))
+        with STORE_LOCK:
+            offset = self.index.get(record_id)
+            if offset is None:
+                raise ValueError(f"ไม่พบ ID {record_id}")
+            before = self._read_at(offset) if self.listeners else None
+            self._write_at(offset, packed)
+            if self.listeners:
+                self._notify('update', record_id, offset, before, struct.unpack(self.fmt, packed))
+
+    def delete(self, record_id: int, op='delete'):
+        """ลบระเบียน (ตั้ง is_deleted=1); op คือชื่อเหตุการณ์ที่ส่งให้ listener เช่น 'archive'"""
+        with STORE_LOCK:
+            offset = self.index.get(record_id)
+            if offset is None:
+                raise ValueError(f"ไม่พบ ID {record_id}")
+            # ตั้ง is_deleted=1 ที่ระเบียนนี้ โดยไม่เปลี่ยนข้อมูลอื่น
+            rec = list(self._read_at(offset))
             rec[0] = 1  # is_deleted=1
-            f.seek(offset)
-            f.write(struct.pack(self.fmt, *rec))
-        self.free_offsets.append(offset)
+            self._write_at(offset, struct.pack(self.fmt, *rec), live=-1, holes=1)
+            if self._snapshots and offset < max(sn.end for sn in self._snapshots):
+                self._gone.setdefault(record_id, []).append((self.version, offset))
+            del self.index[record_id]
+            self.free_offsets.append(offset)
+            if self.listeners:
+                rec[0] = 0
+                self._notify(op, record_id, offset, tuple(rec), None)
+
+    def compact(self, chunk_records=4096):
+        """เขียนไฟล์ใหม่โดยตัดช่องที่ถูกลบทิ้ง (offset ของระเบียนจะเปลี่ยน จึงต้องไม่มี snapshot เปิดอยู่)"""
+        with STORE_LOCK:
+            if self._snapshots:
+                raise RuntimeError("มี snapshot เปิดอยู่ ไม่สามารถ compact ได้")
+            tmp = self.path + '.compact'
+            live = 0
+            with open(self.path, 'rb') as src, open(tmp, 'wb') as dst:
+                if self.header is not None:
+                    dst.write(b'\x00' * HEADER_SIZE)
+                src.seek(self.data_start)
+                while True:
+                    block = src.read(self.stride * chunk_records)
+                    if not block:
+                        break
+                    usable = len(block) - len(block) % self.stride
+                    keep = [block[p:p + self.stride] for p in range(0, usable, self.stride)
+                            if struct.unpack_from('<I', block, p)[0] == 0]
+                    live += len(keep)
+                    dst.write(b''.join(keep))
+                if self.header is not None:
+                    h = self.header
+                    dst.seek(0)
+                    dst.write(pack_header(self.size, live, live, 0, h['generation'] + 1, h['flags']))
+                dst.flush()
+                os.fsync(dst.fileno())
+            os.replace(tmp, self.path)
+            self.version += 1
+            self.dirty = None   # ทั้งไฟล์เปลี่ยน: replication ต้องสำเนาใหม่ทั้งไฟล์
+            self._scan()
 
     def iter_active(self):
         """วนอ่านเฉพาะระเบียนที่ไม่ถูกลบ"""
         with open(self.path, 'rb') as f:
-            offset = 0
+            f.seek(self.data_start)
+            offset = self.data_start
             while True:
-                chunk = f.read(self.size)
-                if not chunk or len(chunk) < self.size:
+                chunk = f.read(self.stride)
+                if not chunk or len(chunk) < self.stride:
                     break
-                rec = struct.unpack(self.fmt, chunk)
+                rec = struct.unpack(self.fmt, chunk[:self.size])
                 if rec[0] == 0:  # is_deleted==0
                     yield offset, rec
-                offset += self.size
+                offset += self.stride
+
+    def snapshot(self):
+        """เปิดมุมมองแบบอ่านอย่างเดียว ณ จุดเวลานี้ (ใช้กับ with หรือเรียก close() เอง)"""
+        with STORE_LOCK:
+            snap = Snapshot(self)
+            self._snapshots.append(snap)
+        return snap
+
+    def _release(self, snap):
+        """ปิด snapshot และทิ้งข้อมูลเดิมที่ไม่มี snapshot ใดต้องใช้แล้ว"""
+        with STORE_LOCK:
+            if snap in self._snapshots:
+                self._snapshots.remove(snap)
+            if not self._snapshots:
+                self._cow.clear()
+                self._gone.clear()
+                return
+            oldest = min(sn.version for sn in self._snapshots)
+            for table in (self._cow, self._gone):
+                for key in list(table):
+                    kept = [e for e in table[key] if e[0] > oldest]
+                    if kept:
+                        table[key] = kept
+                    else:
+                        del table[key]
 
     def stats(self):
+        """สรุปจำนวนระเบียน: ไฟล์ที่มี header ตอบจาก header ทันที, ไฟล์ legacy ต้องสแกน"""
+        if self.header is not None:
+            h = self.header
+            return {
+                'active': h['live'],
+                'deleted': h['holes'],
+                'holes': h['holes'],
+                'total_slots': h['record_count'],
+            }
         total_slots = 0
         deleted = 0
         active = 0
@@ -212,6 +799,190 @@ class FixedRecordFile:
             'total_slots': total_slots
         }
 
+def migrate_file(path: str, fmt: str, size: int, chunk_records=4096, checksums=None):
+    """แปลงไฟล์ legacy (หรือซ่อม header ของไฟล์ใหม่) ให้เป็นรูปแบบที่มี header แบบ streaming
+    เขียนลงไฟล์ชั่วคราวแล้ว os.replace; ระเบียนท้ายไฟล์ที่ไม่ครบจะถูกตัดทิ้ง
+    checksums=True/False เปิด/ปิด CRC ต่อช่อง, None = คงตามไฟล์เดิม
+    คืน dict สรุปผล"""
+    count = live = holes = 0
+    tmp = path + '.migrate'
+    with open(path, 'rb') as src, open(tmp, 'wb') as dst:
+        old = read_header(src)
+        start = HEADER_SIZE if old is not None else 0
+        if old is not None and old['record_size'] != size:
+            raise CorruptFileError(f"{path}: ขนาดระเบียน {old['record_size']} ไม่ตรงกับ {size}")
+        generation = old['generation'] + 1 if old is not None else 0
+        had_crc = old is not None and bool(old['flags'] & FLAG_CRC)
+        if checksums is None:
+            checksums = had_crc
+        flags = FLAG_CRC if checksums else 0
+        src_stride = size + (CRC_SIZE if had_crc else 0)
+        src.seek(start)
+        dst.write(pack_header(size, 0, 0, 0, 0, flags))
+        tail = 0
+        while True:
+            block = src.read(src_stride * chunk_records)
+            if not block:
+                break
+            whole = len(block) - len(block) % src_stride
+            tail = len(block) - whole
+            out = []
+            for pos in range(0, whole, src_stride):
+                packed = block[pos:pos + size]
+                if struct.unpack_from('<I', packed)[0] == 1:  # is_deleted==1
+                    holes += 1
+                else:
+                    live += 1
+                out.append(packed + record_crc(packed) if checksums else packed)
+            count += whole // src_stride
+            dst.write(b''.join(out))
+        dst.seek(0)
+        dst.write(pack_header(size, count, live, holes, generation, flags))
+        dst.flush()
+        os.fsync(dst.fileno())
+    os.replace(tmp, path)
+    return {'path': path, 'was_legacy': old is None, 'records': count,
+            'live': live, 'holes': holes, 'dropped_tail_bytes': tail}
+
+class Snapshot:
+    """มุมมองของ FixedRecordFile ณ version หนึ่ง อ่านได้ขณะที่ผู้เขียนยังทำงานต่อ
+    ช่องที่ถูกเขียนทับหลังจากเปิด snapshot จะอ่านจากสำเนาเดิมที่แฟ้มเก็บไว้ใน _cow
+    ระเบียนที่ append หลังเปิด snapshot (เกิน end) จะไม่ถูกมองเห็น"""
+    def __init__(self, db):
+        # ต้องสร้างภายใต้ STORE_LOCK (ผ่าน FixedRecordFile.snapshot)
+        self.db = db
+        self.version = db.version
+        self.header = dict(db.header) if db.header is not None else None
+        size = os.path.getsize(db.path)
+        self.end = size - (size - db.data_start) % db.stride
+        self.fmt = db.fmt
+        self.key_field = db.key_field
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.db._release(self)
+
+    def _slot_at(self, offset, current: bytes) -> bytes:
+        """คืน bytes ของช่อง ณ version ของ snapshot (current = ที่อ่านได้จากไฟล์ตอนนี้)"""
+        entries = self.db._cow.get(offset)
+        if entries:
+            for ver, old in list(entries):
+                if ver > self.version:
+                    return old
+        return current
+
+    def _iter_slots(self, chunk_records=1024):
+        db = self.db
+        stride = db.stride
+        with open(db.path, 'rb') as f:
+            offset = db.data_start
+            f.seek(offset)
+            while offset < self.end:
+                block = f.read(min(stride * chunk_records, self.end - offset))
+                if not block:
+                    break
+                for pos in range(0, len(block) - len(block) % stride, stride):
+                    chunk = self._slot_at(offset + pos, block[pos:pos + stride])
+                    yield offset + pos, struct.unpack(self.fmt, chunk[:db.size])
+                offset += len(block)
+
+    def iter_active(self):
+        for offset, rec in self._iter_slots():
+            if rec[0] == 0:
+                yield offset, rec
+
+    def iter_raw(self, chunk_records=1024):
+        """bytes ทั้งไฟล์ ณ version ของ snapshot (header + ทุกช่องรวม CRC) ทีละก้อน
+        ใช้สำเนาไฟล์ไปที่อื่นโดยไม่ต้องถือ STORE_LOCK ระหว่างอ่าน"""
+        db = self.db
+        stride = db.stride
+        if self.header is not None:
+            h = self.header
+            yield pack_header(db.size, h['record_count'], h['live'], h['holes'], h['generation'], h['flags'])
+        with open(db.path, 'rb') as f:
+            offset = db.data_start
+            f.seek(offset)
+            while offset < self.end:
+                block = f.read(min(stride * chunk_records, self.end - offset))
+                if not block:
+                    break
+                # ตรวจ _cow หลังอ่าน: ผู้เขียนเก็บสำเนาเดิมก่อนเขียนทับเสมอ
+                if db._cow:
+                    block = b''.join(self._slot_at(offset + pos, block[pos:pos + stride])
+                                     for pos in range(0, len(block), stride))
+                yield block
+                offset += len(block)
+
+    def _read_slot(self, f, offset):
+        f.seek(offset)
+        return struct.unpack(self.fmt, self._slot_at(offset, f.read(self.db.stride))[:self.db.size])
+
+    def _lookup(self, f, record_id):
+        """หา (offset, rec) ของ id ณ version ของ snapshot จากไฟล์ที่เปิดอยู่
+        ลองช่องตามดัชนีปัจจุบันก่อน ถ้าไม่ใช่ (ถูกลบหลังเปิด snapshot แล้วอาจเพิ่มใหม่ที่อื่น)
+        จึงดูช่องเดิมที่แฟ้มจดไว้ใน _gone; id ที่ไม่เคยมีจึงไม่ต้องสแกนทั้งไฟล์"""
+        db = self.db
+        offset = db.index.get(record_id)
+        candidates = [offset] if offset is not None else []
+        candidates += [off for ver, off in db._gone.get(record_id, ()) if ver > self.version]
+        for offset in candidates:
+            if offset < self.end:
+                rec = self._read_slot(f, offset)
+                if rec[0] == 0 and rec[1] == record_id:
+                    return offset, rec
+        return None, None
+
+    def get(self, record_id: int):
+        with open(self.db.path, 'rb') as f:
+            return self._lookup(f, record_id)
+
+    def get_many(self, record_ids):
+        """เหมือน FixedRecordFile.get_many แต่อ่าน ณ version ของ snapshot (ไม่เห็นช่องเกิน end) คืน dict id -> rec"""
+        index = self.db.index
+        out = {}
+        with open(self.db.path, 'rb') as f:
+            for rid in sorted(set(record_ids), key=lambda rid: index.get(rid, -1)):
+                _, rec = self._lookup(f, rid)
+                if rec is not None:
+                    out[rid] = rec
+        return out
+
+    @property
+    def index(self):
+        # ดัชนีปัจจุบันของแฟ้ม (ไม่ใช่ ณ เวลา snapshot) ใช้ตรวจแบบคร่าว ๆ ว่ามี id นี้หรือไม่
+        return self.db.index
+
+    def stats(self):
+        if self.header is not None:
+            h = self.header
+            return {'active': h['live'], 'deleted': h['holes'],
+                    'holes': h['holes'], 'total_slots': h['record_count']}
+        active = deleted = 0
+        for _, rec in self._iter_slots():
+            if rec[0] == 1:
+                deleted += 1
+            else:
+                active += 1
+        return {'active': active, 'deleted': deleted, 'holes': deleted,
+                'total_slots': active + deleted}
+
+@contextmanager
+def snapshot_all(*dbs):
+    """เปิด snapshot ของหลายแฟ้มพร้อมกันที่จุดเวลาเดียวกัน เช่น
+    with snapshot_all(cus_db, nb_db, so_db) as (c, n, s): build_report_text(c, n, s)"""
+    with STORE_LOCK:
+        snaps = [db.snapshot() for db in dbs]
+    try:
+        yield snaps
+    finally:
+        for snap in snaps:
+            snap.close()
+
 # --------------------------
 # ตัวช่วย pack/unpack ของแต่ละไฟล์
 # --------------------------
@@ -285,11 +1056,1895 @@ def unpack_soldout(rec):
     }
 
 # --------------------------
-# ตัวจัดการทั้งสามแฟ้ม
+# ดัชนีค้นหา prefix/substring (n-gram)
+# --------------------------
+class SearchIndex:
+    """ดัชนีค้นหาแบบขึ้นต้นด้วย/มีคำนี้ ของบางฟิลด์ในแฟ้ม
+    ค่าที่เก็บมาจาก unpack_* (ผ่าน from_fixed_bytes แล้ว) จึงถูกตัดตามขนาดไบต์เหมือนในไฟล์
+    - ids (array ที่เรียงแล้ว) กับ rows[field] เก็บค่าที่ normalize แล้วเรียงตาม id ใช้ยืนยันผลโดยไม่ต้องอ่านแฟ้ม
+    - prefix: ต่อฟิลด์เก็บ list ของค่าที่เรียงแล้วคู่กับ array ของ id แล้วหาช่วงด้วย bisect
+    - substring: posting list (array('I') ของ id ที่เรียงแล้ว) ของทุก trigram ในค่า
+      ค่าที่สั้นกว่า GRAM ใช้ทั้งค่าเป็น gram แทน คำค้นสั้นจึงหาได้จากการไล่ชื่อ gram ที่มีคำนั้น
+    อัปเดตเองผ่าน listener ของ FixedRecordFile (ใช้ค่าก่อน/หลังที่แฟ้มส่งมา)
+    และบันทึกลงไฟล์ข้าง ๆ (<path>.sidx) แบบไบนารีภายใน SAVE_DELAY วินาทีหลังมีการเขียน"""
+    GRAM = 3
+    SAVE_DELAY = 5.0            # None = บันทึกเฉพาะตอน save()/registry.close()
+    MAGIC = b'NBSX'
+    VERSION = 2
+
+    def __init__(self, db, unpack, fields, path=None):
+        self.db = db
+        self.unpack = unpack
+        self.fields = tuple(fields)
+        self.path = path or db.path + '.sidx'
+        self._clear()
+        self.dirty = False
+        self._timer = None
+        if not self._load():
+            self.rebuild()
+        db.add_listener(self._on_change)
+
+    def _clear(self):
+        self.ids = array('I')                                      # id ที่มีในดัชนี เรียงจากน้อยไปมาก
+        self.rows = {f: [] for f in self.fields}                  # field -> ค่าตามลำดับ ids
+        self.sorted = {f: ([], array('I')) for f in self.fields}   # field -> (ค่าที่เรียงแล้ว, id คู่กัน)
+        self.grams = {f: {} for f in self.fields}                 # field -> {gram: array('I') ของ id}
+
+    def _signature(self):
+        st = os.stat(self.db.path)
+        return [st.st_size, st.st_mtime_ns]
+
+    def _grams_of(self, s):
+        if len(s) < self.GRAM:
+            return {s} if s else set()
+        return {s[i:i + self.GRAM] for i in range(len(s) - self.GRAM + 1)}
+
+    def _values_of(self, rec):
+        d = self.unpack(rec)
+        return tuple(normalize_text(d[f]) for f in self.fields)
+
+    def _index(self, rid, vals):
+        row = bisect.bisect_left(self.ids, rid)
+        self.ids.insert(row, rid)
+        for f, v in zip(self.fields, vals):
+            self.rows[f].insert(row, v)
+            values, ids = self.sorted[f]
+            i = bisect.bisect_right(values, v)
+            values.insert(i, v)
+            ids.insert(i, rid)
+            g = self.grams[f]
+            for gram in self._grams_of(v):
+                post = g.get(gram)
+                if post is None:
+                    g[gram] = array('I', (rid,))
+                else:
+                    post.insert(bisect.bisect_left(post, rid), rid)
+
+    def _unindex(self, rid):
+        row = bisect.bisect_left(self.ids, rid)
+        if row == len(self.ids) or self.ids[row] != rid:
+            return
+        del self.ids[row]
+        for f in self.fields:
+            v = self.rows[f].pop(row)
+            values, ids = self.sorted[f]
+            for i in range(bisect.bisect_left(values, v), bisect.bisect_right(values, v)):
+                if ids[i] == rid:
+                    del values[i]
+                    del ids[i]
+                    break
+            g = self.grams[f]
+            for gram in self._grams_of(v):
+                post = g[gram]
+                del post[bisect.bisect_left(post, rid)]
+                if not post:
+                    del g[gram]
+
+    def _finish(self, order):
+        # สร้าง sorted จาก rows โดยใช้ลำดับที่เรียงตามค่าแล้ว (list ทั้งสองชี้สตริงชุดเดียวกัน)
+        for f in self.fields:
+            rows = self.rows[f]
+            self.sorted[f] = ([rows[i] for i in order[f]], array('I', map(self.ids.__getitem__, order[f])))
+
+    def rebuild(self):
+        """สร้างดัชนีใหม่ทั้งหมดจากแฟ้มข้อมูล"""
+        self._clear()
+        ids = array('I')
+        columns = {f: [] for f in self.fields}
+        for _, rec in self.db.iter_active():
+            ids.append(rec[1])
+            for f, v in zip(self.fields, self._values_of(rec)):
+                columns[f].append(v)
+        by_id = sorted(range(len(ids)), key=ids.__getitem__)
+        self.ids = array('I', map(ids.__getitem__, by_id))
+        for f in self.fields:
+            column = columns[f]
+            rows = self.rows[f] = [column[i] for i in by_id]
+            g = self.grams[f]
+            for rid, v in zip(self.ids, rows):
+                for gram in self._grams_of(v):
+                    post = g.get(gram)
+                    if post is None:
+                        g[gram] = array('I', (rid,))
+                    else:
+                        post.append(rid)     # วนตาม id จากน้อยไปมาก posting จึงเรียงอยู่แล้ว
+        self._finish({f: sorted(range(len(self.ids)), key=self.rows[f].__getitem__) for f in self.fields})
+        self._mark_dirty()
+
+    def _on_change(self, op, record_id, offset, before, after):
+        self._unindex(record_id)
+        if after is not None:
+            self._index(record_id, self._values_of(after))
+        self._mark_dirty()
+
+    def _mark_dirty(self):
+        self.dirty = True
+        if self.SAVE_DELAY is not None and self._timer is None:
+            self._timer = threading.Timer(self.SAVE_DELAY, self._autosave)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _autosave(self):
+        self._timer = None
+        try:
+            self.save()
+        except OSError as e:
+            print("** Warning: บันทึกดัชนีค้นหาไม่สำเร็จ:", e)
+
+    @staticmethod
+    def _read_array(f, count, swap):
+        a = array('I')
+        a.frombytes(f.read(count * a.itemsize))
+        if len(a) != count:
+            raise ValueError("ไฟล์ดัชนีไม่ครบ")
+        if swap:
+            a.byteswap()
+        return a
+
+    @staticmethod
+    def _read_strings(f, count, length):
+        # สตริงคั่นด้วย \x00 (from_fixed_bytes ตัดที่ \x00 ค่าจึงไม่มีตัวนี้)
+        items = f.read(length).decode('utf-8').split('\x00') if count else []
+        if len(items) != count:
+            raise ValueError("ไฟล์ดัชนีไม่ครบ")
+        return items
+
+    def _load(self):
+        """โหลดดัชนีจากไฟล์ ถ้าไม่มี/เสีย/ไม่ตรงกับแฟ้มข้อมูลปัจจุบัน คืนค่า False"""
+        try:
+            with open(self.path, 'rb') as f:
+                if f.read(4) != self.MAGIC:
+                    return False
+                head_len, = struct.unpack('<I', f.read(4))
+                head = json.loads(f.read(head_len).decode('utf-8'))
+                if (head.get('version') != self.VERSION or head.get('fields') != list(self.fields)
+                        or head.get('signature') != self._signature()):
+                    return False
+                swap = head.get('byteorder') != sys.byteorder
+                n = head['count']
+                self.ids = self._read_array(f, n, swap)
+                order = {}
+                for field in self.fields:
+                    rows_len, n_grams, grams_len, n_postings = head['sections'][field]
+                    self.rows[field] = self._read_strings(f, n, rows_len)
+                    order[field] = self._read_array(f, n, swap)
+                    grams = self._read_strings(f, n_grams, grams_len)
+                    counts = self._read_array(f, n_grams, swap)
+                    postings = self._read_array(f, n_postings, swap)
+                    g = self.grams[field]
+                    pos = 0
+                    for gram, count in zip(grams, counts):
+                        g[gram] = postings[pos:pos + count]
+                        pos += count
+        except (OSError, ValueError, KeyError, struct.error):
+            self._clear()
+            return False
+        self._finish(order)
+        return True
+
+    def save(self):
+        """บันทึกดัชนีลงไฟล์ (เขียนไฟล์ชั่วคราวแล้ว replace)
+        ถือ STORE_LOCK ไว้ให้ดัชนีตรงกับ signature ของแฟ้มข้อมูล"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        with STORE_LOCK:
+            if not self.dirty and os.path.exists(self.path):
+                return
+            # ลำดับตามค่าของแต่ละฟิลด์เก็บเป็นตำแหน่งใน rows (ไม่ต้องเก็บสตริงซ้ำ)
+            row_of = {rid: i for i, rid in enumerate(self.ids)} if self.ids else {}
+            sections = {}
+            blobs = [self.ids.tobytes()]
+            for field in self.fields:
+                rows_blob = '\x00'.join(self.rows[field]).encode('utf-8')
+                order = array('I', map(row_of.__getitem__, self.sorted[field][1]))
+                g = self.grams[field]
+                grams_blob = '\x00'.join(g).encode('utf-8')
+                counts = array('I', map(len, g.values()))
+                sections[field] = [len(rows_blob), len(g), len(grams_blob), sum(counts)]
+                blobs += [rows_blob, order.tobytes(), grams_blob, counts.tobytes()]
+                blobs += [post.tobytes() for post in g.values()]
+            head = json.dumps({
+                'version': self.VERSION,
+                'fields': list(self.fields),
+                'signature': self._signature(),
+                'byteorder': sys.byteorder,
+                'count': len(self.ids),
+                'sections': sections,
+            }, ensure_ascii=False).encode('utf-8')
+            tmp = self.path + '.tmp'
+            with open(tmp, 'wb') as f:
+                f.write(self.MAGIC + struct.pack('<I', len(head)) + head)
+                for blob in blobs:
+                    f.write(blob)
+            os.replace(tmp, self.path)
+            self.dirty = False
+
+    @staticmethod
+    def _has(post, rid):
+        i = bisect.bisect_left(post, rid)
+        return i < len(post) and post[i] == rid
+
+    def search(self, query, fields=None, prefix=False):
+        """คืนรายการ id ที่ฟิลด์ใดฟิลด์หนึ่งขึ้นต้นด้วย (prefix=True) หรือมี query อยู่"""
+        q = normalize_text(query)
+        if not q:
+            return []
+        fields = self.fields if fields is None else tuple(fields)
+        found = set()
+        for f in fields:
+            g = self.grams[f]
+            if prefix:
+                values, ids = self.sorted[f]
+                lo = bisect.bisect_left(values, q)
+                hi = bisect.bisect_left(values, q + '\U0010ffff', lo)
+                found.update(ids[lo:hi])
+            elif len(q) < self.GRAM:
+                # ทุก substring สั้นอยู่ใน gram ใด gram หนึ่งของค่านั้นเสมอ: ผลตรงโดยไม่ต้องยืนยัน
+                for gram, post in g.items():
+                    if q in gram:
+                        found.update(post)
+            elif len(q) == self.GRAM:
+                found.update(g.get(q, ()))
+            else:
+                posts = [g.get(gram) for gram in self._grams_of(q)]
+                if not all(posts):
+                    continue
+                posts.sort(key=len)
+                cand = set(posts[0])
+                for p in posts[1:]:
+                    if len(p) > 32 * len(cand):
+                        cand = {rid for rid in cand if self._has(p, rid)}
+                    else:
+                        cand.intersection_update(p)
+                # มีครบทุก trigram แต่อาจไม่ได้เรียงติดกัน: ยืนยันกับค่าจริง
+                rows = self.rows[f]
+                found.update(rid for rid in cand if q in rows[bisect.bisect_left(self.ids, rid)])
+        return sorted(found)
+
+# --------------------------
+# ตัวจัดการทั้งสามแฟ้ม (เปิดแบบ lazy ผ่าน registry)
+# --------------------------
+# ชื่อ store -> (ไฟล์เริ่มต้น, struct format, ขนาดระเบียน, ฟิลด์ key)
+STORE_SPECS = {
+    'cus': (CUS_FILE, CUS_FMT, CUS_SIZE, 'customer_id'),
+    'nb':  (NB_FILE,  NB_FMT,  NB_SIZE,  'notebook_id'),
+    'so':  (SO_FILE,  SO_FMT,  SO_SIZE,  'sold_out_id'),
+}
+
+# ชื่อ store -> unpack (ใช้แปลงระเบียนเป็น dict เช่นใน change log)
+STORE_UNPACK = {
+    'cus': unpack_customer,
+    'nb':  unpack_notebook,
+    'so':  unpack_soldout,
+}
+
+# ชื่อ store -> (unpack, ฟิลด์ที่ทำดัชนีค้นหา)
+SEARCH_SPECS = {
+    'cus': (unpack_customer, ('name', 'address', 'tel')),
+    'nb':  (unpack_notebook, ('serial_num',)),
+}
+
+class StoreRegistry:
+    """เก็บ path ของแต่ละแฟ้ม และเปิด FixedRecordFile/SearchIndex เมื่อถูกใช้ครั้งแรก
+    ทำให้ import โมดูลไม่ต้องอ่านไฟล์ข้อมูลเลย"""
+    def __init__(self, base_dir='.', checksums=False, changelog=None, trace=None, **paths):
+        self.base_dir = base_dir
+        self.checksums = checksums  # เปิด CRC ต่อช่องให้ไฟล์ที่สร้างใหม่
+        self.changelog = changelog  # path ของ change log (None = ไม่บันทึก)
+        self.trace = trace          # path ของไฟล์ trace สำหรับบันทึก workload (None = ไม่บันทึก)
+        self.paths = {name: spec[0] for name, spec in STORE_SPECS.items()}
+        self.paths.update(paths)
+        self._stores = {}
+        self._search = {}
+        self._fields = {}
+        self._changelog = None
+        self._recorder = None
+        self._archive = None
+
+    def configure(self, base_dir=None, checksums=None, changelog=None, trace=None, **paths):
+        """เปลี่ยนโฟลเดอร์/ไฟล์ของแต่ละ store (ต้องเรียกก่อนเปิดแฟ้ม)"""
+        if self._stores:
+            raise RuntimeError("ต้องกำหนด path ก่อนเปิดแฟ้ม (เรียก close() ก่อน)")
+        unknown = set(paths) - set(STORE_SPECS)
+        if unknown:
+            raise ValueError(f"ไม่รู้จัก store: {', '.join(sorted(unknown))}")
+        if base_dir is not None:
+            self.base_dir = base_dir
+        if checksums is not None:
+            self.checksums = checksums
+        if changelog is not None:
+            self.changelog = changelog
+        if trace is not None:
+            self.trace = trace
+        self.paths.update(paths)
+
+    def path(self, name):
+        return os.path.join(self.base_dir, self.paths[name])
+
+    def is_open(self, name):
+        return name in self._stores
+
+    def store(self, name):
+        """เปิด store ครั้งแรกใน STORE_LOCK: หลาย thread ที่ขอพร้อมกันจะได้ FixedRecordFile ตัวเดียวกัน
+        (ไม่เช่นนั้นจะมีสองตัวที่ดัชนี/ช่องว่างไม่ตรงกัน และ listener ติดอยู่กับตัวที่ถูกทิ้ง)"""
+        db = self._stores.get(name)
+        if db is not None:
+            return db
+        with STORE_LOCK:
+            db = self._stores.get(name)
+            if db is None:
+                _, fmt, size, key = STORE_SPECS[name]
+                db = FixedRecordFile(self.path(name), fmt, size, key, self.checksums)
+                if self.changelog:
+                    if self._changelog is None:
+                        self._changelog = ChangeLog(os.path.join(self.base_dir, self.changelog))
+                    self._changelog.attach(name, db)
+                if self.trace:
+                    if self._recorder is None:
+                        self._recorder = WorkloadRecorder(os.path.join(self.base_dir, self.trace))
+                    self._recorder.attach(name, db)
+                # ใส่ใน _stores หลัง attach ครบ thread อื่นจึงไม่เห็น store ที่ยังไม่มี listener
+                self._stores[name] = db
+        return db
+
+    def search(self, name):
+        idx = self._search.get(name)
+        if idx is None:
+            with STORE_LOCK:
+                idx = self._search.get(name)
+                if idx is None:
+                    unpack, fields = SEARCH_SPECS[name]
+                    idx = self._search[name] = SearchIndex(self.store(name), unpack, fields)
+        return idx
+
+    def field_index(self, name, field):
+        """ดัชนีรอง (ค่า -> id) ของฟิลด์หนึ่ง สร้างเมื่อถูกขอครั้งแรก แล้ว Query จะเลือกใช้ได้เอง"""
+        idx = self._fields.get((name, field))
+        if idx is None:
+            with STORE_LOCK:
+                idx = self._fields.get((name, field))
+                if idx is None:
+                    idx = self._fields[(name, field)] = FieldIndex(self.store(name), STORE_UNPACK[name], field)
+        return idx
+
+    def available_indexes(self, name):
+        """ดัชนีรองที่เปิดอยู่แล้วของ store นี้: {ฟิลด์: FieldIndex}, และ SearchIndex (หรือ None)"""
+        fields = {f: idx for (n, f), idx in self._fields.items() if n == name}
+        return fields, self._search.get(name)
+
+    def sales_archive(self):
+        """คลังรายการขายเก่าแบบบีบอัด อยู่ในโฟลเดอร์ <ไฟล์ขาย>.cold"""
+        if self._archive is None:
+            with STORE_LOCK:
+                if self._archive is None:
+                    self._archive = ColdArchive(self.path('so') + '.cold')
+        return self._archive
+
+    def migrate(self, checksums=None):
+        """อัปเกรดทั้งสามแฟ้มเป็นรูปแบบที่มี header (ปิด store ที่เปิดอยู่ก่อน)"""
+        self.close()
+        results = []
+        for name, (_, fmt, size, _key) in STORE_SPECS.items():
+            if os.path.exists(self.path(name)):
+                results.append(migrate_file(self.path(name), fmt, size, checksums=checksums))
+        return results
+
+    def close(self):
+        """บันทึกดัชนีที่เปิดอยู่ แล้วปล่อยทุก store (เปิดใหม่ได้เมื่อถูกใช้อีกครั้ง)"""
+        with STORE_LOCK:
+            for idx in self._search.values():
+                idx.save()
+            self._search.clear()
+            self._fields.clear()
+            self._stores.clear()
+            self._archive = None
+            if self._changelog is not None:
+                self._changelog.close()
+                self._changelog = None
+            if self._recorder is not None:
+                self._recorder.close()
+                self._recorder = None
+
+class _LazyProxy:
+    """ตัวแทนของ object ที่จะถูกสร้างเมื่อมีการเรียกใช้ attribute ครั้งแรก"""
+    def __init__(self, factory):
+        object.__setattr__(self, '_factory', factory)
+
+    def __getattr__(self, name):
+        return getattr(self._factory(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._factory(), name, value)
+
+registry = StoreRegistry(os.environ.get('CPRO_DATA_DIR', '.'),
+                         changelog=os.environ.get('CPRO_CHANGELOG'),
+                         trace=os.environ.get('CPRO_TRACE'))
+
+cus_db = _LazyProxy(lambda: registry.store('cus'))
+nb_db  = _LazyProxy(lambda: registry.store('nb'))
+so_db  = _LazyProxy(lambda: registry.store('so'))
+
+# ดัชนีค้นหาข้อความ
+cus_search = _LazyProxy(lambda: registry.search('cus'))
+nb_search  = _LazyProxy(lambda: registry.search('nb'))
+
+# รายการขายทั้งแฟ้มปัจจุบัน (hot) และคลังเก่า (cold)
+sales = _LazyProxy(lambda: SalesTiers(registry.store('so'), registry.sales_archive()))
+
+# --------------------------
+# Sharding: แยกแฟ้มตามสาขา / ช่วง id / hash ไปไว้คนละโฟลเดอร์
+# --------------------------
+def hash_router(shards):
+    """กระจาย id แบบ modulo ไปยัง shard ตามลำดับในรายการ"""
+    shards = list(shards)
+    return lambda record_id: shards[record_id % len(shards)]
+
+def range_router(bounds):
+    """bounds: list[(id_สูงสุด_ไม่รวม, shard)] เรียงจากน้อยไปมาก; id ที่เกินช่วงสุดท้ายจะเป็น error"""
+    uppers = [b for b, _ in bounds]
+    names = [n for _, n in bounds]
+    def route(record_id):
+        i = bisect.bisect_right(uppers, record_id)
+        if i >= len(names):
+            raise ValueError(f"ID {record_id} อยู่นอกช่วงของทุก shard")
+        return names[i]
+    return route
+
+class ShardedIndex:
+    """มุมมองรวมของดัชนีทุก shard (ไม่คัดลอก) ใช้แทน FixedRecordFile.index ในจุดที่ต้องการ
+    in / len / get / items; offset ที่คืนเป็นตำแหน่งในไฟล์ของ shard ที่มี id นั้น"""
+    def __init__(self, store):
+        self.store = store
+
+    def __contains__(self, record_id):
+        return self.store.shard_of(record_id) is not None
+
+    def __len__(self):
+        return sum(len(db.index) for db in self.store.shards.values())
+
+    def get(self, record_id, default=None):
+        shard = self.store.shard_of(record_id)
+        if shard is None:
+            return default
+        return self.store.shards[shard].index.get(record_id, default)
+
+    def __getitem__(self, record_id):
+        offset = self.get(record_id)
+        if offset is None:
+            raise KeyError(record_id)
+        return offset
+
+    def __iter__(self):
+        for db in self.store.shards.values():
+            yield from db.index
+
+    def items(self):
+        for db in self.store.shards.values():
+            yield from db.index.items()
+
+class ShardedSnapshot:
+    """snapshot ของทุก shard ที่เปิดพร้อมกันใน STORE_LOCK (จุดเวลาเดียวกัน) ใช้แบบอ่านอย่างเดียว"""
+    def __init__(self, store):
+        self.store = store
+        with STORE_LOCK:
+            self.shards = {shard: db.snapshot() for shard, db in store.shards.items()}
+        self.key_field = store.key_field
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        for snap in self.shards.values():
+            snap.close()
+
+    @property
+    def index(self):
+        # ดัชนีปัจจุบัน (ไม่ใช่ ณ เวลา snapshot) เหมือน Snapshot.index
+        return self.store.index
+
+    def get(self, record_id: int):
+        # ลอง shard ที่มี id อยู่ตอนนี้ก่อน ถ้าถูกย้าย/ลบหลังเปิด snapshot จึงไล่ shard อื่น
+        first = self.store.shard_of(record_id)
+        order = [first] if first is not None else []
+        order += [s for s in self.shards if s != first]
+        for shard in order:
+            offset, rec = self.shards[shard].get(record_id)
+            if rec is not None:
+                return offset, rec
+        return None, None
+
+    def get_many(self, record_ids):
+        """อ่านจาก snapshot ของ shard ที่มี id อยู่ตอนนี้ id ที่ไม่พบ (ถูกลบ/ย้ายหลังเปิด snapshot) ใช้ get ทีละตัว"""
+        groups, rest = {}, []
+        for rid in set(record_ids):
+            shard = self.store.shard_of(rid)
+            if shard is None:
+                rest.append(rid)
+            else:
+                groups.setdefault(shard, []).append(rid)
+        out = {}
+        for shard, ids in groups.items():
+            found = self.shards[shard].get_many(ids)
+            out.update(found)
+            rest.extend(rid for rid in ids if rid not in found)
+        for rid in rest:
+            _, rec = self.get(rid)
+            if rec is not None:
+                out[rid] = rec
+        return out
+
+    def iter_active_by_shard(self):
+        for shard, snap in self.shards.items():
+            for offset, rec in snap.iter_active():
+                yield shard, offset, rec
+
+    def iter_active(self):
+        for _, offset, rec in self.iter_active_by_shard():
+            yield offset, rec
+
+    def stats(self):
+        return _sum_stats(snap.stats() for snap in self.shards.values())
+
+def _sum_stats(parts):
+    total = {'active': 0, 'deleted': 0, 'holes': 0, 'total_slots': 0}
+    for s in parts:
+        for k in total:
+            total[k] += s[k]
+    return total
+
+class ShardedStore:
+    """รวม FixedRecordFile หลายไฟล์ (<root>/<shard>/<ไฟล์ของ store>) ให้ใช้งานเหมือนแฟ้มเดียว
+    router(record_id) -> ชื่อ shard ใช้ตอนเพิ่มระเบียนเมื่อไม่ระบุ shard (เช่น สาขา) เอง
+    iter_active/stats ทำงานแบบ scatter/gather โดยอ่านทุก shard พร้อมกัน
+    index, get_many และ snapshot() ใช้แทน FixedRecordFile ได้ในงานอ่าน (Query, รายงาน)"""
+    STREAM_BATCH = 256   # จำนวนระเบียนต่อชุดที่ thread ของแต่ละ shard ส่งออกมา
+    STREAM_DEPTH = 4     # จำนวนชุดสูงสุดที่ค้างในคิวของแต่ละ shard
+
+    def __init__(self, root, name, shards, router=None):
+        filename, fmt, size, key = STORE_SPECS[name]
+        self.root = root
+        self.name = name
+        self.fmt = fmt
+        self.size = size
+        self.key_field = key
+        self.router = router or hash_router(shards)
+        self.shards = {}
+        for shard in shards:
+            d = os.path.join(root, shard)
+            os.makedirs(d, exist_ok=True)
+            self.shards[shard] = FixedRecordFile(os.path.join(d, filename), fmt, size, key)
+        self.index = ShardedIndex(self)
+
+    def shard_of(self, record_id):
+        """ชื่อ shard ที่มีระเบียนนี้อยู่ (None ถ้าไม่พบ)"""
+        guess = None
+        try:
+            guess = self.router(record_id)
+        except ValueError:
+            pass
+        if guess in self.shards and record_id in self.shards[guess].index:
+            return guess
+        for shard, db in self.shards.items():
+            if record_id in db.index:
+                return shard
+        return None
+
+    def __contains__(self, record_id):
+        return self.shard_of(record_id) is not None
+
+    def __len__(self):
+        return sum(len(db.index) for db in self.shards.values())
+
+    def add(self, packed_with_id: bytes, record_id: int, shard=None):
+        if record_id in self:
+            raise ValueError(f"ID {record_id} มีอยู่แล้ว")
+        shard = shard if shard is not None else self.router(record_id)
+        if shard not in self.shards:
+            raise ValueError(f"ไม่รู้จัก shard {shard}")
+        return self.shards[shard].add(packed_with_id, record_id)
+
+    def get(self, record_id: int):
+        shard = self.shard_of(record_id)
+        if shard is None:
+            return None, None
+        return self.shards[shard].get(record_id)
+
+    def get_many(self, record_ids):
+        """แยก id ตาม shard แล้วให้แต่ละ shard อ่านแบบเรียง offset คืน dict id -> rec"""
+        groups = {}
+        for rid in set(record_ids):
+            shard = self.shard_of(rid)
+            if shard is not None:
+                groups.setdefault(shard, []).append(rid)
+        out = {}
+        for shard, ids in groups.items():
+            out.update(self.shards[shard].get_many(ids))
+        return out
+
+    def snapshot(self):
+        """snapshot ของทุก shard ณ จุดเวลาเดียวกัน (ใช้กับ with หรือเรียก close() เอง)"""
+        return ShardedSnapshot(self)
+
+    def update(self, record_id: int, packed: bytes):
+        shard = self.shard_of(record_id)
+        if shard is None:
+            raise ValueError(f"ไม่พบ ID {record_id}")
+        self.shards[shard].update(record_id, packed)
+
+    def delete(self, record_id: int):
+        shard = self.shard_of(record_id)
+        if shard is None:
+            raise ValueError(f"ไม่พบ ID {record_id}")
+        self.shards[shard].delete(record_id)
+
+    def scatter(self, fn):
+        """เรียก fn(shard, db) กับทุก shard พร้อมกัน คืน dict shard -> ผลลัพธ์ (ตามลำดับ shard)"""
+        if len(self.shards) <= 1:
+            return {shard: fn(shard, db) for shard, db in self.shards.items()}
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=len(self.shards)) as ex:
+            futures = {shard: ex.submit(fn, shard, db) for shard, db in self.shards.items()}
+            return {shard: fut.result() for shard, fut in futures.items()}
+
+    def iter_active_by_shard(self):
+        """วนอ่านระเบียนที่ไม่ถูกลบ คืน (shard, offset, rec); offset เป็นตำแหน่งในไฟล์ของ shard นั้น
+        ทุก shard อ่านพร้อมกันด้วย thread ละ shard ส่งเป็นชุดผ่านคิวที่จำกัดขนาด
+        จึงใช้หน่วยความจำคงที่ไม่ขึ้นกับขนาดไฟล์ (เลิกวนกลางทางได้ thread จะหยุดเอง)"""
+        if len(self.shards) <= 1:
+            for shard, db in self.shards.items():
+                for offset, rec in db.iter_active():
+                    yield shard, offset, rec
+            return
+        stop = threading.Event()
+        queues = {shard: queue.Queue(self.STREAM_DEPTH) for shard in self.shards}
+
+        def put(q, item):
+            while not stop.is_set():
+                try:
+                    q.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def produce(shard, db):
+            q = queues[shard]
+            try:
+                batch = []
+                for item in db.iter_active():
+                    batch.append(item)
+                    if len(batch) >= self.STREAM_BATCH:
+                        if not put(q, batch):
+                            return
+                        batch = []
+                if batch and not put(q, batch):
+                    return
+                put(q, None)
+            except Exception as e:   # ส่งข้อผิดพลาดให้ผู้อ่านยกขึ้นใหม่
+                put(q, e)
+
+        for shard, db in self.shards.items():
+            threading.Thread(target=produce, args=(shard, db), daemon=True).start()
+        try:
+            for shard, q in queues.items():
+                while True:
+                    batch = q.get()
+                    if batch is None:
+                        break
+                    if isinstance(batch, Exception):
+                        raise batch
+                    for offset, rec in batch:
+                        yield shard, offset, rec
+        finally:
+            stop.set()
+
+    def iter_active(self):
+        for _, offset, rec in self.iter_active_by_shard():
+            yield offset, rec
+
+    def stats_by_shard(self):
+        return self.scatter(lambda shard, db: db.stats())
+
+    def stats(self):
+        return _sum_stats(self.stats_by_shard().values())
+
+def open_sharded(root, shards, router=None):
+    """เปิดทั้งสามแฟ้มแบบ sharded คืน dict ที่ส่งต่อให้ build_report_text(**stores) ได้"""
+    return {
+        'cus_db': ShardedStore(root, 'cus', shards, router),
+        'nb_db': ShardedStore(root, 'nb', shards, router),
+        'so_db': ShardedStore(root, 'so', shards, router),
+    }
+
+# --------------------------
+# Scrubber: ตรวจความถูกต้องของแฟ้มเป็นช่วง ๆ ในเบื้องหลัง
+# --------------------------
+class Scrubber:
+    """ตรวจทีละ chunk โดยจำกัดอัตราอ่าน (bytes/วินาที) เพื่อไม่แย่ง I/O กับหน้าร้าน
+    สิ่งที่ตรวจ: CRC ของแต่ละช่อง (ถ้ามี), ค่า is_deleted, ความตรงกันกับดัชนีในหน่วยความจำ
+    และความสัมพันธ์ของรายการขายกับโน้ตบุ๊ก/ลูกค้า (ใช้ดัชนี ไม่ต้องอ่านไฟล์ซ้ำ)"""
+    def __init__(self, cus_db=cus_db, nb_db=nb_db, so_db=so_db,
+                 bytes_per_sec=1 << 20, chunk_records=256):
+        self.stores = {'cus': cus_db, 'nb': nb_db, 'so': so_db}
+        self.bytes_per_sec = bytes_per_sec
+        self.chunk_records = chunk_records
+        self.report = None          # ผลของรอบล่าสุดที่ทำเสร็จ
+        self._stop = False
+        self._thread = None
+
+    def _throttle(self, nbytes, started):
+        if self.bytes_per_sec:
+            wait = nbytes / self.bytes_per_sec - (time.monotonic() - started)
+            if wait > 0:
+                time.sleep(wait)
+
+    def _check_slot(self, db, chunk, offset):
+        """คืนเหตุผลถ้าช่องนี้ผิดปกติ (None ถ้าปกติ)"""
+        try:
+            rec = db._unpack_slot(chunk, offset)
+        except CorruptFileError:
+            return 'crc mismatch'
+        if rec[0] not in (0, 1):
+            return f'is_deleted={rec[0]}'
+        if rec[0] == 0 and db.index.get(rec[1]) != offset:
+            return f'id {rec[1]} ไม่ตรงกับดัชนี'
+        return None
+
+    def scrub_store(self, name):
+        """ตรวจหนึ่งแฟ้มทั้งไฟล์ คืน list[(store, offset, เหตุผล)]"""
+        db = self.stores[name]
+        bad = []
+        offset = db.data_start
+        step = db.stride * self.chunk_records
+        while not self._stop:
+            started = time.monotonic()
+            with open(db.path, 'rb') as f:
+                f.seek(offset)
+                block = f.read(step)
+            usable = len(block) - len(block) % db.stride
+            for pos in range(0, usable, db.stride):
+                reason = self._check_slot(db, block[pos:pos + db.stride], offset + pos)
+                if reason is not None:
+                    # อ่านซ้ำอีกครั้ง เผื่อชนกับการเขียนที่กำลังเกิดขึ้นพอดี
+                    with open(db.path, 'rb') as f:
+                        f.seek(offset + pos)
+                        reason = self._check_slot(db, f.read(db.stride), offset + pos)
+                    if reason is not None:
+                        bad.append((name, offset + pos, reason))
+            offset += usable
+            self._throttle(len(block), started)
+            if len(block) < step:
+                break
+        return bad
+
+    def check_references(self):
+        """รายการขายที่อ้างถึง notebook/customer ที่ไม่มีอยู่ คืน list[(sold_out_id, ฟิลด์, id)]"""
+        nb_index = self.stores['nb'].index
+        cus_index = self.stores['cus'].index
+        orphans = []
+        for _, rec in self.stores['so'].iter_active():
+            _, sid, nid, cid = rec[:4]
+            if nid not in nb_index:
+                orphans.append((sid, 'notebook_id', nid))
+            if cid not in cus_index:
+                orphans.append((sid, 'customer_id', cid))
+        return orphans
+
+    def run_once(self):
+        """ตรวจครบทุกแฟ้มหนึ่งรอบ คืน dict {'bad_slots': [...], 'orphans': [...]}"""
+        bad = []
+        for name in self.stores:
+            bad.extend(self.scrub_store(name))
+        report = {'bad_slots': bad, 'orphans': self.check_references(),
+                  'finished_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
+        if not self._stop:
+            self.report = report
+        return report
+
+    def start(self, interval=3600):
+        """รัน run_once ซ้ำทุก interval วินาทีในเธรด daemon"""
+        self._stop = False
+
+        def loop():
+            while not self._stop:
+                self.run_once()
+                deadline = time.monotonic() + interval
+                while not self._stop and time.monotonic() < deadline:
+                    time.sleep(0.5)
+        self._thread = threading.Thread(target=loop, name='cpro-scrubber', daemon=True)
+        self._thread.start()
+        return self._thread
+
+    def stop(self):
+        self._stop = True
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+# --------------------------
+# Change data capture: บันทึก add/update/delete ทุกครั้งลงไฟล์ log ให้ระบบปลายทางตามอ่าน
+# --------------------------
+class ChangeLog:
+    """เขียนเหตุการณ์การเปลี่ยนแปลงต่อท้ายไฟล์ (JSON Lines หนึ่งบรรทัดต่อเหตุการณ์)
+    {"lsn", "ts", "store", "op", "id", "before", "after"} โดย before/after เป็น dict จาก unpack_*
+    fsync=True จะ fsync ทุกเหตุการณ์ (ช้ากว่าแต่ไม่หายแม้ไฟดับ)"""
+    def __init__(self, path, fsync=False):
+        self.path = path
+        self.fsync = fsync
+        self._lock = threading.Lock()
+        self.lsn = self._recover()
+        self._f = open(path, 'ab')
+
+    def _recover(self):
+        """หา lsn ล่าสุดจากท้ายไฟล์ และตัดบรรทัดท้ายที่เขียนไม่ครบ (ถ้ามี) ทิ้ง"""
+        if not os.path.exists(self.path):
+            return 0
+        with open(self.path, 'r+b') as f:
+            end = f.seek(0, os.SEEK_END)
+            back = min(end, 1 << 16)
+            f.seek(end - back)
+            tail = f.read(back)
+            if tail and not tail.endswith(b'\n'):
+                cut = tail.rfind(b'\n') + 1
+                f.truncate(end - back + cut)
+                tail = tail[:cut]
+            lines = tail.splitlines()
+            if not lines:
+                return 0
+            return json.loads(lines[-1])['lsn']
+
+    def attach(self, name, db):
+        """ให้บันทึกทุกการเปลี่ยนแปลงของ db ในชื่อ store name"""
+        unpack = STORE_UNPACK[name]
+
+        def on_change(op, record_id, offset, before, after):
+            self.append(name, op, record_id,
+                        unpack(before) if before is not None else None,
+                        unpack(after) if after is not None else None)
+        db.add_listener(on_change)
+
+    def append(self, store, op, record_id, before, after):
+        with self._lock:
+            self.lsn += 1
+            event = {'lsn': self.lsn, 'ts': datetime.now().isoformat(timespec='microseconds'),
+                     'store': store, 'op': op, 'id': record_id, 'before': before, 'after': after}
+            self._f.write(json.dumps(event, ensure_ascii=False).encode('utf-8') + b'\n')
+            self._f.flush()
+            if self.fsync:
+                os.fsync(self._f.fileno())
+            return self.lsn
+
+    def close(self):
+        self._f.close()
+
+class ChangeFeed:
+    """อ่าน change log ตั้งแต่ตำแหน่ง (byte offset) ที่บันทึกไว้ ทำงานได้แบบ O(จำนวนการเปลี่ยนแปลง)
+    position ที่คืนมาพร้อมแต่ละเหตุการณ์คือจุดเริ่มของเหตุการณ์ถัดไป ให้เก็บด้วย save_position"""
+    def __init__(self, path):
+        self.path = path
+
+    def _read_from(self, position):
+        if not os.path.exists(self.path):
+            return position, []
+        with open(self.path, 'rb') as f:
+            f.seek(position)
+            data = f.read()
+        events = []
+        for line in data.splitlines(keepends=True):
+            if not line.endswith(b'\n'):
+                break   # บรรทัดที่ยังเขียนไม่เสร็จ รอรอบหน้า
+            position += len(line)
+            events.append((position, json.loads(line)))
+        return position, events
+
+    def events(self, position=0, follow=False, poll=0.5):
+        """generator ของ (position_ถัดไป, event); follow=True จะรอเหตุการณ์ใหม่ไปเรื่อย ๆ"""
+        while True:
+            position, batch = self._read_from(position)
+            yield from batch
+            if not follow:
+                return
+            if not batch:
+                time.sleep(poll)
+
+    async def aevents(self, position=0, follow=True, poll=0.5):
+        """แบบ async iterator: async for pos, ev in feed.aevents(pos): ..."""
+        import asyncio
+        while True:
+            position, batch = self._read_from(position)
+            for item in batch:
+                yield item
+            if not follow:
+                return
+            if not batch:
+                await asyncio.sleep(poll)
+
+    def _cursor_path(self, consumer):
+        return f"{self.path}.cursor.{consumer}"
+
+    def load_position(self, consumer):
+        """ตำแหน่งที่ผู้อ่านชื่อ consumer อ่านถึงล่าสุด (0 ถ้ายังไม่เคยบันทึก)"""
+        try:
+            with open(self._cursor_path(consumer), 'r', encoding='utf-8') as f:
+                return int(f.read().strip() or 0)
+        except OSError:
+            return 0
+
+    def save_position(self, consumer, position):
+        tmp = self._cursor_path(consumer) + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            f.write(str(position))
+        os.replace(tmp, self._cursor_path(consumer))
+
+# --------------------------
+# Cold storage: ย้ายรายการขายเก่าไปเก็บแบบบีบอัดเป็นบล็อก
+# --------------------------
+def parse_sale_date(text):
+    """แปลงวันที่ขาย (YYYY-MM-DD, YYYY-MM หรือ YYYY) เป็น date; รูปแบบอื่นคืน None"""
+    for fmt in ('%Y-%m-%d', '%Y-%m', '%Y'):
+        try:
+            return datetime.strptime(text.strip(), fmt).date()
+        except ValueError:
+            pass
+    return None
+
+class ColdArchive:
+    """คลังระเบียนขายแบบอ่านอย่างเดียว: segment ไฟล์ละหลายบล็อก แต่ละบล็อกบีบอัดด้วย zlib หรือ lzma
+    manifest.json เก็บดัชนีบล็อก [min_id, max_id, offset, ความยาว, จำนวน, วันที่น้อยสุด, มากสุด]
+    จึงอ่านระเบียนเดียวได้โดยคลายบีบอัดแค่บล็อกเดียว"""
+    BLOCK_RECORDS = 512
+    CACHE_BLOCKS = 8
+
+    def __init__(self, directory, fmt=SO_FMT, size=SO_SIZE, codec='zlib'):
+        self.dir = directory
+        self.fmt = fmt
+        self.size = size
+        self.codec = codec
+        self.manifest_path = os.path.join(directory, 'manifest.json')
+        self.segments = []
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, 'r', encoding='utf-8') as f:
+                self.segments = json.load(f)['segments']
+        self._index_blocks()
+        self._cache = {}
+
+    def _index_blocks(self):
+        # (min_id, max_id, file, offset, length, count, min_date, max_date, codec) เรียงตาม min_id
+        self.blocks = sorted(
+            (b[0], b[1], seg['file'], b[2], b[3], b[4], b[5], b[6], seg['codec'])
+            for seg in self.segments for b in seg['blocks']
+        )
+        # reach[i] = max_id ที่มากที่สุดของบล็อก 0..i ใช้หยุดไล่ย้อนหลังเมื่อไม่มีบล็อกก่อนหน้าครอบ id แล้ว
+        self.reach = []
+        top = None
+        for b in self.blocks:
+            top = b[1] if top is None else max(top, b[1])
+            self.reach.append(top)
+
+    def __len__(self):
+        return sum(b[5] for b in self.blocks)
+
+    @staticmethod
+    def _compress(data, codec):
+        if codec == 'lzma':
+            import lzma
+            return lzma.compress(data)
+        return zlib.compress(data, 9)
+
+    @staticmethod
+    def _decompress(data, codec):
+        if codec == 'lzma':
+            import lzma
+            return lzma.decompress(data)
+        return zlib.decompress(data)
+
+    def write_segment(self, records, codec=None):
+        """เขียน segment ใหม่จาก list ของ tuple ระเบียน (is_deleted=0) คืนชื่อไฟล์"""
+        codec = codec or self.codec
+        records = sorted(records, key=lambda r: r[1])
+        if not records:
+            return None
+        os.makedirs(self.dir, exist_ok=True)
+        name = f"seg-{len(self.segments) + 1:06d}.{codec}"
+        path = os.path.join(self.dir, name)
+        blocks = []
+        with open(path + '.tmp', 'wb') as f:
+            for i in range(0, len(records), self.BLOCK_RECORDS):
+                chunk = records[i:i + self.BLOCK_RECORDS]
+                data = self._compress(b''.join(struct.pack(self.fmt, *r) for r in chunk), codec)
+                dates = [from_fixed_bytes(r[5]) for r in chunk]
+                blocks.append([chunk[0][1], chunk[-1][1], f.tell(), len(data), len(chunk),
+                               min(dates), max(dates)])
+                f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+        self.segments.append({'file': name, 'codec': codec, 'blocks': blocks})
+        tmp = self.manifest_path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump({'segments': self.segments}, f, ensure_ascii=False)
+        os.replace(tmp, self.manifest_path)
+        self._index_blocks()
+        return name
+
+    def _load_block(self, block):
+        """คืน (ระเบียน, list ของ id ที่เรียงแล้ว) ของบล็อก เก็บไว้ใน cache ทั้งคู่"""
+        key = (block[2], block[3])
+        cached = self._cache.get(key)
+        if cached is None:
+            with open(os.path.join(self.dir, block[2]), 'rb') as f:
+                f.seek(block[3])
+                raw = self._decompress(f.read(block[4]), block[8])
+            recs = list(struct.iter_unpack(self.fmt, raw))
+            cached = (recs, [r[1] for r in recs])
+            if len(self._cache) >= self.CACHE_BLOCKS:
+                self._cache.pop(next(iter(self._cache)))
+            self._cache[key] = cached
+        return cached
+
+    def _candidates(self, lo, hi):
+        """บล็อกที่ช่วง id ซ้อนกับ [lo, hi] ไล่จากบล็อกที่ min_id มากสุดย้อนลงมา"""
+        i = bisect.bisect_right(self.blocks, (hi, float('inf'))) - 1
+        while i >= 0 and self.reach[i] >= lo:
+            if self.blocks[i][1] >= lo:
+                yield self.blocks[i]
+            i -= 1
+
+    def get(self, record_id: int):
+        for block in self._candidates(record_id, record_id):
+            recs, ids = self._load_block(block)
+            i = bisect.bisect_left(ids, record_id)
+            if i < len(ids) and ids[i] == record_id:
+                return recs[i]
+        return None
+
+    def __contains__(self, record_id):
+        return self.get(record_id) is not None
+
+    def ids_between(self, lo, hi):
+        """set ของ id ในคลังที่อยู่ในช่วง [lo, hi] (คลายบีบอัดเฉพาะบล็อกที่ช่วงซ้อนกัน)"""
+        found = set()
+        for block in self._candidates(lo, hi):
+            _, ids = self._load_block(block)
+            found.update(ids[bisect.bisect_left(ids, lo):bisect.bisect_right(ids, hi)])
+        return found
+
+    def iter_records(self, date=None):
+        """วนอ่านทุกระเบียน; ถ้าระบุ date จะข้ามบล็อกที่ช่วงวันที่ไม่ครอบคลุม"""
+        for block in self.blocks:
+            if date is not None and not (block[6] <= date <= block[7]):
+                continue
+            yield from self._load_block(block)[0]
+
+class SalesTiers:
+    """มองรายการขายใน hot (FixedRecordFile หรือ Snapshot) และ cold (ColdArchive) เป็นแฟ้มเดียว
+    ใช้แทน so_db ได้ใน build_report_text; ระเบียนจาก cold มี offset เป็น None
+    cold ถูกวนก่อน เพื่อให้รายการใหม่ใน hot ทับของเก่าเมื่อสร้างแมป"""
+    def __init__(self, hot, cold):
+        self.hot = hot
+        self.cold = cold
+
+    def get(self, record_id: int):
+        offset, rec = self.hot.get(record_id)
+        if rec is not None:
+            return offset, rec
+        rec = self.cold.get(record_id)
+        return (None, rec) if rec is not None else (None, None)
+
+    def iter_active(self, date=None):
+        hot_index = self.hot.index
+        for rec in self.cold.iter_records(date):
+            if rec[1] not in hot_index:   # ระหว่างย้ายอาจมีอยู่ทั้งสองที่
+                yield None, rec
+        for offset, rec in self.hot.iter_active():
+            if date is None or from_fixed_bytes(rec[5]) == date:
+                yield offset, rec
+
+    def find_by_date(self, date):
+        """รายการขายของวันที่ระบุ (ใน cold อ่านเฉพาะบล็อกที่ช่วงวันที่ครอบคลุม)"""
+        for offset, rec in self.iter_active(date):
+            if from_fixed_bytes(rec[5]) == date:
+                yield offset, rec
+
+    def stats(self):
+        s = dict(self.hot.stats())
+        s['archived'] = len(self.cold)
+        return s
+
+def archive_sales(cutoff, so_db=so_db, archive=None, codec=None, compact=True):
+    """ย้ายรายการขายที่วันที่ขายก่อน cutoff (date หรือ 'YYYY-MM-DD') ไปยังคลัง cold
+    เขียนคลังให้เสร็จก่อนแล้วค่อยลบจาก hot (ถ้าหยุดกลางทาง รันซ้ำได้ ระเบียนจะไม่ซ้ำ)
+    สแกนหา candidate โดยไม่ถือ lock แล้วตรวจซ้ำ เขียนคลัง และลบใน STORE_LOCK เดียวกัน
+    ระเบียนที่ถูกแก้หรือลบหลังสแกนจึงไม่ถูกย้าย (ไม่ทับการแก้ และไม่คืนชีพรายการที่ลบ)
+    ถ้ามี snapshot เปิดอยู่จะข้าม compact ไปก่อน; รายการที่อ่านวันที่ไม่ได้จะคงอยู่ใน hot; คืนจำนวนที่ย้าย"""
+    if isinstance(cutoff, str):
+        cutoff = datetime.strptime(cutoff, '%Y-%m-%d').date()
+    archive = archive if archive is not None else registry.sales_archive()
+    old = []
+    for _, rec in so_db.iter_active():
+        d = parse_sale_date(from_fixed_bytes(rec[5]))
+        if d is not None and d < cutoff:
+            old.append(rec)
+    if not old:
+        return 0
+    with STORE_LOCK:
+        old = [rec for rec in old if so_db.get(rec[1])[1] == rec]
+        if old:
+            archived = archive.ids_between(min(r[1] for r in old), max(r[1] for r in old))
+            archive.write_segment([r for r in old if r[1] not in archived], codec)
+            # id ที่อยู่ในคลังแล้ว (รอบก่อนหยุดกลางทาง) ลบจาก hot ได้เมื่อสำเนาในคลังตรงกันเท่านั้น
+            old = [r for r in old if r[1] not in archived or archive.get(r[1]) == r]
+            for rec in old:
+                so_db.delete(rec[1], op='archive')
+    note = ""
+    if compact and old:
+        try:
+            so_db.compact()
+        except RuntimeError:
+            # มี snapshot (เช่น รายงาน) เปิดอยู่: เลื่อน compact ไปรอบหน้า ช่องว่างยังถูกใช้ซ้ำได้
+            note = " (compact deferred: snapshot open)"
+    log_action(f"Archive {len(old)} sales older than {cutoff}{note}")
+    return len(old)
+
+# --------------------------
+# บันทึก workload และเล่นซ้ำ (replay) เพื่อวัดประสิทธิภาพแบบออฟไลน์
+# --------------------------
+class WorkloadRecorder:
+    """บันทึกการเรียก add/update/delete/get/add_many/update_many/compact ของแต่ละ store ลงไฟล์ trace (JSON Lines)
+    {"t": วินาทีนับจากเริ่มบันทึก, "store", "op", "id", "data": hex ของระเบียน (add/update)}
+    บันทึกหลังแฟ้มเขียนเสร็จใน STORE_LOCK เดียวกัน; งานที่ล้มเหลวมี "ok": false
+    งานแบบชุดเก็บ "items": [[id, hex], ...] แทน id/data ส่วน compact ไม่มี id
+    ตอน attach จะสำเนาไฟล์ข้อมูลปัจจุบันไว้ที่ <trace>.base/ เป็นจุดเริ่มของการ replay
+    หนึ่ง session (หนึ่ง recorder) ต่อหนึ่งคู่ trace/base: ถ้ามี trace เดิมอยู่แล้ว จะย้ายทั้งคู่ไปเป็น
+    <trace>.N และ <trace>.N.base ก่อนเริ่มบันทึกใหม่ เพราะเวลา t และ base ของ session ก่อนใช้ต่อไม่ได้"""
+    OPS = ('add', 'update', 'delete', 'get', 'add_many', 'update_many', 'compact')
+
+    def __init__(self, path):
+        self.path = path
+        self.base_dir = path + '.base'
+        self._rotate()
+        self._lock = threading.Lock()
+        self._t0 = time.monotonic()
+        self._f = open(path, 'a', encoding='utf-8')
+
+    def _rotate(self):
+        """ย้าย trace/base ของ session ก่อนหน้าไปเป็น <trace>.N / <trace>.N.base (N ที่ยังว่าง)"""
+        has_trace = os.path.exists(self.path) and os.path.getsize(self.path) > 0
+        if not has_trace and not os.path.isdir(self.base_dir):
+            return
+        n = 1
+        while os.path.exists(f"{self.path}.{n}") or os.path.exists(f"{self.path}.{n}.base"):
+            n += 1
+        if os.path.exists(self.path):
+            os.replace(self.path, f"{self.path}.{n}")
+        if os.path.isdir(self.base_dir):
+            os.replace(self.base_dir, f"{self.path}.{n}.base")
+
+    def attach(self, name, db):
+        import shutil
+        os.makedirs(self.base_dir, exist_ok=True)
+        base = os.path.join(self.base_dir, STORE_SPECS[name][0])
+        with STORE_LOCK:
+            if not os.path.exists(base):
+                shutil.copyfile(db.path, base)
+            for op in self.OPS:
+                setattr(db, op, self._wrap(name, op, getattr(db, op)))
+
+    def _wrap(self, store, op, fn):
+        run = self._run
+        if op == 'add':
+            def call(packed, record_id, *args, **kw):
+                return run(store, op, fn, (packed, record_id) + args, kw, record_id, packed)
+        elif op == 'update':
+            def call(record_id, packed, *args, **kw):
+                return run(store, op, fn, (record_id, packed) + args, kw, record_id, packed)
+        elif op in ('add_many', 'update_many'):
+            def call(items, *args, **kw):
+                items = list(items)
+                return run(store, op, fn, (items,) + args, kw, items=items)
+        elif op == 'compact':
+            def call(*args, **kw):
+                return run(store, op, fn, args, kw)
+        else:
+            def call(record_id, *args, **kw):
+                return run(store, op, fn, (record_id,) + args, kw, record_id)
+        return call
+
+    def _run(self, store, op, fn, args, kw, record_id=None, packed=None, items=None):
+        """เรียก fn แล้วบันทึก event: งานเขียนทำใน STORE_LOCK เดียวกับที่แฟ้มใช้ ลำดับใน trace จึงตรงกับลำดับจริง
+        ถ้า fn ล้มเหลว (เช่น ID ซ้ำ) จะบันทึก ok=false แล้วส่ง exception ต่อ; get ไม่เปลี่ยนข้อมูลจึงไม่ต้องถือ lock"""
+        if op == 'get':
+            result = fn(*args, **kw)
+            self._write(store, op, record_id, None)
+            return result
+        with STORE_LOCK:
+            try:
+                result = fn(*args, **kw)
+            except Exception:
+                self._write(store, op, record_id, packed, items, ok=False)
+                raise
+            self._write(store, op, record_id, packed, items)
+            return result
+
+    def _write(self, store, op, record_id, packed, items=None, ok=True):
+        event = {'t': round(time.monotonic() - self._t0, 6), 'store': store, 'op': op}
+        if record_id is not None:
+            event['id'] = record_id
+        if packed is not None:
+            event['data'] = packed.hex()
+        if items is not None:
+            event['items'] = [[rid, p.hex()] for rid, p in items]
+        if not ok:
+            event['ok'] = False
+        with self._lock:
+            self._f.write(json.dumps(event) + '\n')
+            self._f.flush()
+
+    def close(self):
+        self._f.close()
+
+def _percentile(sorted_vals, p):
+    if not sorted_vals:
+        return 0.0
+    k = min(len(sorted_vals) - 1, int(round(p / 100 * (len(sorted_vals) - 1))))
+    return sorted_vals[k]
+
+def _replay_worker(args):
+    """รันใน process ย่อย: เล่น event ของ partition นี้กับสำเนาไฟล์ของตัวเอง คืน {op: [latency]}
+    'mismatch' เก็บ event ที่ผลลัพธ์ (สำเร็จ/ล้มเหลว) ไม่ตรงกับตอนบันทึก"""
+    events, base_dir, work_dir, speed = args
+    import shutil
+    os.makedirs(work_dir, exist_ok=True)
+    stores = {}
+    for name, (filename, fmt, size, key) in STORE_SPECS.items():
+        dst = os.path.join(work_dir, filename)
+        src = os.path.join(base_dir, filename) if base_dir else None
+        if src and os.path.exists(src):
+            shutil.copyfile(src, dst)
+        elif os.path.exists(dst):
+            os.remove(dst)
+        stores[name] = FixedRecordFile(dst, fmt, size, key)
+    lat = {op: [] for op in WorkloadRecorder.OPS}
+    lat['error'] = []
+    lat['mismatch'] = []
+    start = time.monotonic()
+    clock = time.perf_counter
+    for ev in events:
+        if speed:
+            due = start + ev['t'] / speed
+            wait = due - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+        db = stores[ev['store']]
+        op = ev['op']
+        t = clock()
+        try:
+            if op == 'add':
+                db.add(bytes.fromhex(ev['data']), ev['id'])
+            elif op == 'update':
+                db.update(ev['id'], bytes.fromhex(ev['data']))
+            elif op == 'delete':
+                db.delete(ev['id'])
+            elif op == 'add_many':
+                db.add_many([(rid, bytes.fromhex(data)) for rid, data in ev['items']])
+            elif op == 'update_many':
+                db.update_many([(rid, bytes.fromhex(data)) for rid, data in ev['items']])
+            elif op == 'compact':
+                db.compact()
+            else:
+                db.get(ev['id'])
+        except ValueError:
+            lat['error'].append(clock() - t)
+            if ev.get('ok', True):
+                lat['mismatch'].append(ev.get('id'))
+            continue
+        lat[op].append(clock() - t)
+        if not ev.get('ok', True):
+            lat['mismatch'].append(ev.get('id'))
+    return lat
+
+def replay_trace(trace_path, work_dir, speed=0, workers=1, base_dir=None):
+    """เล่น trace ซ้ำกับสำเนาใหม่ของ store แล้วคืนสรุป throughput และ latency (มิลลิวินาที)
+    speed: 1 = เร็วเท่าตอนบันทึก, 10 = เร็วขึ้น 10 เท่า, 0 = เร็วที่สุด
+    workers: จำนวน process; event ถูกแบ่งตาม id (id เดียวกันอยู่ worker เดียวเสมอ)
+    งานแบบชุดถูกแยก items ตาม id เช่นกัน ส่วน compact เล่นกับทุก worker
+    แต่ละ worker เริ่มจากสำเนาไฟล์ใน base_dir (ค่าเริ่มต้น <trace>.base) ของตัวเอง
+    mismatches ในผลลัพธ์ = จำนวน event ที่สำเร็จ/ล้มเหลวไม่ตรงกับตอนบันทึก (ควรเป็น 0 เมื่อ workers=1)"""
+    if base_dir is None and os.path.isdir(trace_path + '.base'):
+        base_dir = trace_path + '.base'
+    parts = [[] for _ in range(workers)]
+    with open(trace_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                ev = json.loads(line)
+                if 'items' in ev:
+                    split = [[] for _ in range(workers)]
+                    for rid, data in ev['items']:
+                        split[rid % workers].append([rid, data])
+                    for part, items in zip(parts, split):
+                        if items:
+                            part.append(dict(ev, items=items))
+                elif 'id' not in ev:
+                    for part in parts:
+                        part.append(ev)
+                else:
+                    parts[ev['id'] % workers].append(ev)
+    jobs = [(p, base_dir, os.path.join(work_dir, f"worker-{i}"), speed) for i, p in enumerate(parts)]
+    started = time.perf_counter()
+    if workers == 1:
+        results = [_replay_worker(jobs[0])]
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=workers) as ex:
+            results = list(ex.map(_replay_worker, jobs))
+    elapsed = time.perf_counter() - started
+    summary = {'ops': 0, 'errors': 0, 'seconds': round(elapsed, 3), 'by_op': {}}
+    for op in WorkloadRecorder.OPS:
+        vals = sorted(v for r in results for v in r[op])
+        summary['ops'] += len(vals)
+        if vals:
+            summary['by_op'][op] = {
+                'count': len(vals),
+                'p50_ms': round(_percentile(vals, 50) * 1000, 3),
+                'p95_ms': round(_percentile(vals, 95) * 1000, 3),
+                'p99_ms': round(_percentile(vals, 99) * 1000, 3),
+                'max_ms': round(vals[-1] * 1000, 3),
+            }
+    summary['errors'] = sum(len(r['error']) for r in results)
+    summary['mismatches'] = sum(len(r['mismatch']) for r in results)
+    summary['ops_per_sec'] = round(summary['ops'] / elapsed, 1) if elapsed else 0.0
+    return summary
+
+# --------------------------
+# Query: กรองหลายเงื่อนไข, เรียงลำดับ, top-K และ aggregate พร้อมตัวเลือกวิธีเข้าถึงข้อมูล
+# --------------------------
+class FieldIndex:
+    """ดัชนีรองในหน่วยความจำ: ค่าของฟิลด์ -> set(id) อัปเดตผ่าน listener ของ FixedRecordFile
+    เหมาะกับฟิลด์ที่มีค่าไม่หลากหลาย เช่น brand หรือ status"""
+    def __init__(self, db, unpack, field):
+        self.field = field
+        self.unpack = unpack
+        self.values = {}    # ค่า -> set(id)
+        self.by_id = {}     # id -> ค่า
+        for _, rec in db.iter_active():
+            self._add(rec[1], unpack(rec)[field])
+        db.add_listener(self._on_change)
+
+    def _add(self, rid, value):
+        self.by_id[rid] = value
+        self.values.setdefault(value, set()).add(rid)
+
+    def _remove(self, rid):
+        value = self.by_id.pop(rid, None)
+        ids = self.values.get(value)
+        if ids is not None:
+            ids.discard(rid)
+            if not ids:
+                del self.values[value]
+
+    def _on_change(self, op, record_id, offset, before, after):
+        self._remove(record_id)
+        if after is not None:
+            self._add(record_id, self.unpack(after)[self.field])
+
+    def lookup(self, values, ignore_case=False):
+        out = set()
+        if ignore_case:
+            # ค่าต่างกันมีไม่มาก จึงไล่เทียบทุกค่าแบบไม่สนตัวพิมพ์ได้
+            wanted = {v.lower() for v in values}
+            for v, ids in self.values.items():
+                if v.lower() in wanted:
+                    out |= ids
+            return out
+        for v in values:
+            out |= self.values.get(v, set())
+        return out
+
+# ชื่อตาราง (store) -> ฟิลด์ key
+QUERY_TABLES = {
+    'nb': 'notebook_id',
+    'cus': 'customer_id',
+    'so': 'sold_out_id',
+}
+
+_QUERY_OPS = {
+    '==': lambda a, b: a == b,
+    '!=': lambda a, b: a != b,
+    'ieq': lambda a, b: a.lower() == b.lower(),   # เท่ากันแบบไม่สนตัวพิมพ์เล็ก/ใหญ่
+    '<': lambda a, b: a < b,
+    '<=': lambda a, b: a <= b,
+    '>': lambda a, b: a > b,
+    '>=': lambda a, b: a >= b,
+    'in': lambda a, b: a in b,
+    'between': lambda a, b: b[0] <= a <= b[1],
+    'contains': lambda a, b: normalize_text(b) in normalize_text(a),
+    'prefix': lambda a, b: normalize_text(a).startswith(normalize_text(b)),
+}
+
+class Query:
+    """คิวรีแบบง่ายบนแฟ้ม nb/cus/so เช่น โน้ตบุ๊ก Asus ที่มีของ ถูกที่สุด 10 เครื่อง:
+        Query('nb').where('brand', '==', 'Asus').where('status', '==', 1).order_by('price').limit(10).run()
+    ตัวเลือกวิธีเข้าถึง (plan) เลือกจาก full scan, ดัชนีหลัก (id), FieldIndex หรือ SearchIndex
+    ที่เปิดอยู่ โดยประมาณต้นทุนจากจำนวนระเบียนที่ต้องอ่าน
+    ดัชนีรองของ registry ใช้เฉพาะเมื่อ db คือ store ของ registry เอง (ไม่ใช่ Snapshot หรือแฟ้มอื่น)
+    Query('so') รวมคลังรายการขายเก่า (cold) ด้วย ส่ง cold= เพื่อระบุคลังเองเมื่อส่ง db="""
+    SCAN_COST = 1      # ต้นทุนต่อระเบียนเมื่ออ่านต่อเนื่องทั้งไฟล์
+    RANDOM_COST = 4    # ต้นทุนต่อระเบียนเมื่ออ่านแบบ seek ตาม offset
+
+    def __init__(self, table, db=None, reg=None, cold=None):
+        if table not in QUERY_TABLES:
+            raise ValueError(f"ไม่รู้จักตาราง {table}")
+        self.table = table
+        self.key = QUERY_TABLES[table]
+        self.reg = reg or registry
+        if isinstance(db, _LazyProxy):
+            db = db._factory()
+        self.db = db if db is not None else self.reg.store(table)
+        # ดัชนีรองใน registry ติดตามเฉพาะ store ของ registry เท่านั้น
+        self.use_indexes = self.reg.is_open(table) and self.db is self.reg.store(table)
+        if cold is None and table == 'so' and self.use_indexes:
+            cold = self.reg.sales_archive()
+        self.cold = cold
+        self.unpack = STORE_UNPACK[table]
+        self.preds = []
+        self.order = None
+        self.desc = False
+        self.limit_n = None
+
+    def where(self, field, op, value):
+        if op not in _QUERY_OPS:
+            raise ValueError(f"ไม่รู้จักตัวดำเนินการ {op}")
+        # แปลงครั้งเดียว: generator จะถูกใช้ทั้งตอน plan และตอนกรองแต่ละระเบียน
+        if op == 'in':
+            value = frozenset(value)
+        elif op == 'between':
+            value = tuple(value)
+        self.preds.append((field, op, value))
+        return self
+
+    def order_by(self, field, desc=False):
+        self.order = field
+        self.desc = desc
+        return self
+
+    def limit(self, n):
+        self.limit_n = n
+        return self
+
+    def plan(self):
+        """คืน (ชื่อวิธี, ต้นทุนประมาณ, ชุด id ผู้สมัคร หรือ None = scan)
+        ถ้ามีหลายเงื่อนไขที่ใช้ดัชนีได้ จะใช้ส่วนร่วม (intersection) ของทุกชุด"""
+        cold = len(self.cold) if self.cold is not None else 0
+        total = len(self.db.index) + cold
+        if self.use_indexes and not cold:
+            fields, search = self.reg.available_indexes(self.table)
+        else:
+            # ดัชนีรองไม่ครอบคลุม db อื่นและระเบียนใน cold
+            fields, search = {}, None
+        found = []
+        for field, op, value in self.preds:
+            ids = None
+            if field == self.key and op in ('==', 'in'):
+                # ไม่กรองด้วย db.index: ของ snapshot เป็นดัชนีปัจจุบัน id ที่ไม่มีจริงจะหายไปเองตอน get_many
+                ids = {value} if op == '==' else set(value)
+                path = 'pk'
+            elif field in fields and op in ('==', 'in', 'ieq'):
+                ids = fields[field].lookup([value] if op in ('==', 'ieq') else value,
+                                           ignore_case=(op == 'ieq'))
+                path = f'index:{field}'
+            elif search is not None and field in search.fields and op in ('contains', 'prefix'):
+                ids = set(search.search(value, fields=(field,), prefix=(op == 'prefix')))
+                path = f'search:{field}'
+            if ids is not None:
+                found.append((len(ids), path, ids))
+        if found:
+            found.sort(key=lambda x: x[0])
+            ids = found[0][2].intersection(*[x[2] for x in found[1:]])
+            cost = len(ids) * self.RANDOM_COST
+            if cost < total * self.SCAN_COST:
+                return ('+'.join(x[1] for x in found), cost, ids)
+        return ('scan', total * self.SCAN_COST, None)
+
+    def explain(self):
+        path, cost, ids = self.plan()
+        if ids is None:
+            rows = len(self.db.index) + (len(self.cold) if self.cold is not None else 0)
+        else:
+            rows = len(ids)
+        return f"{path} rows~{rows} cost~{cost}"
+
+    def _rows(self):
+        path, _, ids = self.plan()
+        tiers = SalesTiers(self.db, self.cold) if self.cold is not None and len(self.cold) else None
+        if ids is None:
+            source = (rec for _, rec in (tiers or self.db).iter_active())
+        else:
+            found = self.db.get_many(ids)
+            if tiers is not None:
+                for rid in ids:
+                    if rid not in found:
+                        rec = self.cold.get(rid)
+                        if rec is not None:
+                            found[rid] = rec
+            source = found.values()
+        checks = [(f, _QUERY_OPS[op], v) for f, op, v in self.preds]
+        for rec in source:
+            d = self.unpack(rec)
+            if all(fn(d[f], v) for f, fn, v in checks):
+                yield d
+
+    def run(self):
+        """คืน list ของ dict ตาม where/order_by/limit (top-K ใช้ heap ไม่ต้องเรียงทั้งหมด)"""
+        rows = self._rows()
+        if self.order is None:
+            return list(itertools.islice(rows, self.limit_n)) if self.limit_n is not None else list(rows)
+        key = lambda d: d[self.order]
+        if self.limit_n is not None:
+            pick = heapq.nlargest if self.desc else heapq.nsmallest
+            return pick(self.limit_n, rows, key=key)
+        return sorted(rows, key=key, reverse=self.desc)
+
+    def aggregate(self, group_by=None, **aggs):
+        """เช่น aggregate(group_by='brand', n=('count', None), avg=('avg', 'price'))
+        ฟังก์ชันที่รองรับ: count, sum, avg, min, max; คืน dict (หรือ dict ของกลุ่ม -> dict)"""
+        groups = {}
+        for d in self._rows():
+            g = groups.setdefault(d[group_by] if group_by else None, {})
+            for name, (fn, field) in aggs.items():
+                st = g.setdefault(name, [0, 0.0, None, None])  # count, sum, min, max
+                st[0] += 1
+                if field is not None:
+                    v = d[field]
+                    st[1] += v
+                    st[2] = v if st[2] is None or v < st[2] else st[2]
+                    st[3] = v if st[3] is None or v > st[3] else st[3]
+
+        def finish(g):
+            out = {}
+            for name, (fn, _field) in aggs.items():
+                cnt, total, lo, hi = g.get(name, [0, 0.0, None, None])
+                out[name] = {'count': cnt, 'sum': total, 'min': lo, 'max': hi,
+                             'avg': total / cnt if cnt else None}[fn]
+            return out
+        if group_by is None:
+            return finish(groups.get(None, {}))
+        return {k: finish(g) for k, g in sorted(groups.items())}
+
+# --------------------------
+# Replication: ส่งช่องที่เปลี่ยนไปยังโฟลเดอร์ follower สำหรับอ่านอย่างเดียว
 # --------------------------
-cus_db = FixedRecordFile(CUS_FILE, CUS_FMT, CUS_SIZE, 'customer_id')
-nb_db  = FixedRecordFile(NB_FILE,  NB_FMT,  NB_SIZE,  'notebook_id')
-so_db  = FixedRecordFile(SO_FILE,  SO_FMT,  SO_SIZE,  'sold_out_id')
+REPLICA_STATE = 'REPLICA.json'
+
+def _read_replica_state(directory):
+    try:
+        with open(os.path.join(directory, REPLICA_STATE), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {'seq': 0, 'stores': {}}
+
+def _write_replica_state(directory, state):
+    path = os.path.join(directory, REPLICA_STATE)
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(state, f)
+    os.replace(path + '.tmp', path)
+
+class Replicator:
+    """ฝั่ง primary: ติดตามช่วงที่ถูกเขียนใน _write_at/_append แล้วสำเนาเฉพาะช่วงเหล่านั้นไปยัง follower
+    REPLICA.json ในโฟลเดอร์ follower บอกไฟล์ปัจจุบันของแต่ละ store และ seq (เลขคู่ = ข้อมูลครบ)
+    - สำเนาทั้งไฟล์ (รอบแรก, หลัง compact, หรือ follower ที่ส่งไม่สำเร็จ) อ่านจาก snapshot นอก STORE_LOCK
+      และเขียนเป็นไฟล์ generation ใหม่ <ชื่อ>.g<seq><นามสกุล> follower จึงอ่านไฟล์เดิมต่อได้จนสลับ REPLICA.json
+    - การ patch เฉพาะช่วงเขียนทับไฟล์ปัจจุบัน ระหว่างนั้น seq เป็นเลขคี่ (seqlock) ผู้อ่านรอสั้น ๆ
+    คลังขายเก่า (<ไฟล์ขาย>.cold) ถูกส่งไปด้วย: segment ไม่เปลี่ยนหลังเขียน จึงสำเนาเฉพาะไฟล์ใหม่กับ manifest
+    follower ที่ส่งไม่สำเร็จจะถูกจำไว้ใน failed และได้สำเนาทั้งไฟล์ในรอบถัดไป"""
+    def __init__(self, followers, cus_db=cus_db, nb_db=nb_db, so_db=so_db, fsync=False):
+        self.followers = list(followers)
+        self.stores = {'cus': cus_db, 'nb': nb_db, 'so': so_db}
+        self.fsync = fsync
+        self.failed = {}            # follower -> ข้อความ error ของรอบที่ส่งไม่สำเร็จ
+        self._thread = None
+        self._stop = False
+        for d in self.followers:
+            os.makedirs(d, exist_ok=True)
+
+    def _write_file(self, path, data):
+        self._write_stream(path, (data,))
+
+    def _write_stream(self, path, chunks):
+        shipped = 0
+        with open(path + '.tmp', 'wb') as out:
+            for chunk in chunks:
+                out.write(chunk)
+                shipped += len(chunk)
+            if self.fsync:
+                out.flush()
+                os.fsync(out.fileno())
+        os.replace(path + '.tmp', path)
+        return shipped
+
+    def _current(self, d, state):
+        """ไฟล์ที่ follower ใช้อยู่และเชื่อถือได้ ({} = ต้องสำเนาทั้งหมด เช่น รอบก่อนค้างกลางทาง)"""
+        if state['seq'] % 2 or d in self.failed:
+            return {}
+        return state.get('stores', {})
+
+    def _plan_cold(self):
+        # manifest ถูกแทนที่ทั้งไฟล์เสมอ อ่านครั้งเดียวก็ได้ภาพที่ครบ
+        cold_dir = self.stores['so'].path + '.cold'
+        try:
+            with open(os.path.join(cold_dir, 'manifest.json'), 'rb') as f:
+                manifest = f.read()
+        except FileNotFoundError:
+            return None
+        files = [seg['file'] for seg in json.loads(manifest.decode('utf-8'))['segments']]
+        return cold_dir, manifest, files
+
+    def _ship_cold(self, d, cold):
+        cold_dir, manifest, files = cold
+        dst_dir = os.path.join(d, os.path.basename(cold_dir))
+        os.makedirs(dst_dir, exist_ok=True)
+        for name in files:
+            dst = os.path.join(dst_dir, name)
+            if not os.path.exists(dst):
+                with open(os.path.join(cold_dir, name), 'rb') as src:
+                    data = src.read()
+                self._write_file(dst, data)
+        self._write_file(os.path.join(dst_dir, 'manifest.json'), manifest)
+        return {'dir': os.path.basename(dst_dir), 'segments': len(files)}
+
+    def ship(self):
+        """ส่งการเปลี่ยนแปลงหนึ่งรอบ คืนจำนวน bytes ที่ส่ง (ต่อ follower)"""
+        states = {d: _read_replica_state(d) for d in self.followers}
+        # ใน lock เก็บเฉพาะช่วงที่เปลี่ยน (เล็ก) กับเปิด snapshot สำหรับสำเนาทั้งไฟล์ ภาพทั้งหมดจึงเป็นจุดเวลาเดียวกัน
+        plan = {}
+        with STORE_LOCK:
+            for name, db in self.stores.items():
+                ranges = db.take_dirty()
+                need_full = ranges is None or any(
+                    name not in self._current(d, states[d]) for d in self.followers)
+                snap = db.snapshot() if need_full else None
+                patches = None
+                if ranges is not None:
+                    patches = []
+                    with open(db.path, 'rb') as src:
+                        for offset, length in ranges:
+                            src.seek(offset)
+                            patches.append(src.read(length))
+                        size = src.seek(0, os.SEEK_END)
+                else:
+                    size = None
+                plan[name] = (os.path.basename(db.path), ranges, patches, snap, size)
+            cold = self._plan_cold()
+        shipped = 0
+        try:
+            for d in self.followers:
+                try:
+                    shipped = self._ship_to(d, states[d], plan, cold)
+                except OSError as e:
+                    # ช่วงที่เปลี่ยนถูกใช้ไปแล้ว follower นี้จึงต้องได้สำเนาทั้งไฟล์ในรอบถัดไป
+                    self.failed[d] = str(e)
+                else:
+                    self.failed.pop(d, None)
+        finally:
+            for _, _, _, snap, _ in plan.values():
+                if snap is not None:
+                    snap.close()
+        return shipped
+
+    def _ship_to(self, d, state, plan, cold):
+        current = self._current(d, state)
+        seq = state['seq'] + (2 if state['seq'] % 2 == 0 else 1)
+        stores = {}
+        patch = []
+        shipped = 0
+        # 1) สำเนาทั้งไฟล์ลงไฟล์ generation ใหม่ (ผู้อ่านยังใช้ไฟล์เดิมตาม REPLICA.json ได้ตลอด)
+        for name, (filename, ranges, patches, snap, size) in plan.items():
+            if ranges is None or name not in current:
+                root, ext = os.path.splitext(filename)
+                gen = f"{root}.g{seq}{ext}"
+                shipped += self._write_stream(os.path.join(d, gen), snap.iter_raw())
+                stores[name] = {'file': gen, 'full': True, 'ranges': []}
+            else:
+                patch.append(name)
+                stores[name] = {'file': current[name]['file'], 'full': False, 'ranges': ranges}
+        new_state = {'seq': seq, 'stores': stores}
+        if cold is not None:
+            new_state['cold'] = self._ship_cold(d, cold)
+        # 2) patch ไฟล์ปัจจุบันในที่เดิม: ช่วงนี้ seq เป็นเลขคี่ ผู้อ่านต้องรอ
+        if any(plan[name][1] for name in patch):
+            _write_replica_state(d, {'seq': seq - 1, 'stores': {}})
+            for name in patch:
+                _, ranges, patches, _, size = plan[name]
+                with open(os.path.join(d, stores[name]['file']), 'r+b') as out:
+                    for (offset, _), chunk in zip(ranges, patches):
+                        out.seek(offset)
+                        out.write(chunk)
+                        shipped += len(chunk)
+                    out.truncate(size)
+                    if self.fsync:
+                        out.flush()
+                        os.fsync(out.fileno())
+        # 3) สลับไปใช้ข้อมูลชุดใหม่ในครั้งเดียว แล้วลบไฟล์ generation เก่าที่ไม่มีใครอ้างถึงแล้ว
+        _write_replica_state(d, new_state)
+        old = {info['file'] for info in state.get('stores', {}).values()}
+        for name in old - {info['file'] for info in stores.values()}:
+            try:
+                os.remove(os.path.join(d, name))
+            except FileNotFoundError:
+                pass
+        return shipped
+
+    def start(self, interval=1.0):
+        """ส่งต่อเนื่องทุก interval วินาทีในเธรด daemon"""
+        self._stop = False
+
+        def loop():
+            while not self._stop:
+                self.ship()
+                time.sleep(interval)
+        self._thread = threading.Thread(target=loop, name='cpro-replicator', daemon=True)
+        self._thread.start()
+        return self._thread
+
+    def stop(self):
+        self._stop = True
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+class ReplicaStore:
+    """store แบบอ่านอย่างเดียวบน follower: get/get_many/iter_active/stats
+    ก่อนอ่านจะตรวจ REPLICA.json และอัปเดตดัชนีจากช่วงที่ primary ส่งมา (หรือสแกนใหม่ถ้าตกรอบ)
+    WAIT คือเวลาสูงสุด (วินาที) ที่รอ primary patch เสร็จ หรือรอข้อมูลชุดแรก"""
+    RETRIES = 50
+    WAIT = 10.0
+
+    def __init__(self, directory, name):
+        self.dir = directory
+        self.name = name
+        self.db = None
+        self.seq = None
+        self._by_offset = CompactIndex()
+
+    def _open(self, filename):
+        _, fmt, size, key = STORE_SPECS[self.name]
+        self.db = FixedRecordFile(os.path.join(self.dir, filename), fmt, size, key)
+        self._by_offset = CompactIndex((off, rid) for rid, off in self.db.index.items())
+
+    def _apply(self, ranges):
+        """อัปเดตดัชนีจากช่วงที่เปลี่ยน โดยไม่ต้องสแกนทั้งไฟล์"""
+        db = self.db
+        with open(db.path, 'rb') as f:
+            db._open_header(f)
+            for offset, length in ranges:
+                end = offset + length
+                offset = max(offset, db.data_start)
+                offset -= (offset - db.data_start) % db.stride
+                f.seek(offset)
+                while offset < end:
+                    chunk = f.read(db.stride)
+                    if len(chunk) < db.stride:
+                        break
+                    rec = struct.unpack(db.fmt, chunk[:db.size])
+                    old = self._by_offset.pop(offset, None)
+                    if old is not None and db.index.get(old) == offset:
+                        del db.index[old]
+                    if rec[0] == 0:
+                        db.index[rec[1]] = offset
+                        self._by_offset[offset] = rec[1]
+                    offset += db.stride
+
+    def refresh(self):
+        """ทำให้ดัชนีตรงกับข้อมูลล่าสุดที่ส่งมาแล้ว คืน seq ที่ใช้อยู่
+        ถ้า primary เริ่มส่งรอบใหม่ระหว่างอ่าน header/ระเบียน (ไฟล์ถูกแก้ไปครึ่งหนึ่ง) จะทิ้งดัชนีแล้วลองใหม่"""
+        deadline = time.monotonic() + self.WAIT
+        while time.monotonic() < deadline:
+            state = _read_replica_state(self.dir)
+            if state['seq'] % 2 or self.name not in state['stores']:
+                time.sleep(0.01)
+                continue
+            if state['seq'] == self.seq:
+                return self.seq
+            info = state['stores'][self.name]
+            try:
+                if self.db is None or info['full'] or state['seq'] != self.seq + 2:
+                    self._open(info['file'])
+                else:
+                    self._apply(info['ranges'])
+            except (CorruptFileError, struct.error, OSError):
+                self.db = None
+                self.seq = None
+                time.sleep(0.001)
+                continue
+            self.seq = state['seq']
+            return self.seq
+        raise RuntimeError(f"{self.dir}: ยังไม่มีข้อมูลที่ส่งมาเสร็จสำหรับ {self.name}")
+
+    def _read(self, fn):
+        # อ่านซ้ำถ้า primary ส่งรอบใหม่เข้ามาระหว่างที่กำลังอ่าน (seqlock)
+        for _ in range(self.RETRIES):
+            seq = self.refresh()
+            try:
+                result = fn(self.db)
+            except (CorruptFileError, struct.error, OSError):
+                result = None
+                seq = None          # อ่านเจอไฟล์ที่ถูกแก้ไปครึ่งหนึ่ง: ต้องลองใหม่แน่นอน
+            if seq is not None and _read_replica_state(self.dir)['seq'] == seq:
+                return result
+            time.sleep(0.001)
+        raise RuntimeError(f"{self.dir}: ข้อมูลเปลี่ยนตลอดระหว่างอ่าน")
+
+    @property
+    def index(self):
+        self.refresh()
+        return self.db.index
+
+    def get(self, record_id: int):
+        return self._read(lambda db: db.get(record_id))
+
+    def get_many(self, record_ids):
+        return self._read(lambda db: db.get_many(record_ids))
+
+    def iter_active(self):
+        return iter(self._read(lambda db: list(db.iter_active())))
+
+    def stats(self):
+        return self._read(lambda db: db.stats())
+
+class Follower:
+    """ชุด store อ่านอย่างเดียวของโฟลเดอร์ follower หนึ่งโฟลเดอร์ รวมคลังขายเก่าที่ส่งมา"""
+    def __init__(self, directory):
+        self.dir = directory
+        self.stores = {name: ReplicaStore(directory, name) for name in STORE_SPECS}
+        self._archive = None
+        self._archive_key = None
+
+    def store(self, name):
+        return self.stores[name]
+
+    def sales_archive(self):
+        """ColdArchive ของ follower (เปิดใหม่เมื่อจำนวน segment ที่ส่งมาเปลี่ยน) หรือ None ถ้ายังไม่มี"""
+        cold = _read_replica_state(self.dir).get('cold')
+        if cold is None:
+            return None
+        key = (cold['dir'], cold['segments'])
+        if key != self._archive_key:
+            self._archive = ColdArchive(os.path.join(self.dir, cold['dir']))
+            self._archive_key = key
+        return self._archive
+
+    def sales(self):
+        """รายการขายทั้ง hot และ cold เหมือน sales ของ primary"""
+        archive = self.sales_archive()
+        if archive is None:
+            return self.stores['so']
+        return SalesTiers(self.stores['so'], archive)
+
+    def build_report_text(self):
+        return build_report_text(self.stores['cus'], self.stores['nb'], self.sales())
 
 # เก็บประวัติการทำงานใน session
 activity_log = []  # list[str]
@@ -347,6 +3002,7 @@ def view_customer_menu():
     print("2) ดูทั้งหมด")
     print("3) ดูแบบกรอง (by brand)")
     print("4) สถิติโดยสรุป")
+    print("5) ค้นหา (ชื่อ/ที่อยู่/โทร)")
     print("0) กลับเมนูหลัก")
     choice = input("เลือก: ").strip()
     if choice == '1':
@@ -368,6 +3024,13 @@ def view_customer_menu():
     elif choice == '4':
         s = cus_db.stats()
         print("สรุปลูกค้า:", s)
+    elif choice == '5':
+        q = input("คำค้น: ").strip()
+        prefix = input("1=ขึ้นต้นด้วย, 2=มีคำนี้ [2]: ").strip() == '1'
+        for cid in cus_search.search(q, prefix=prefix):
+            _, rec = cus_db.get(cid)
+            if rec is not None:
+                print(unpack_customer(rec))
 
 # ---- โน้ตบุ๊ก ----
 def add_notebook():
@@ -411,6 +3074,7 @@ def view_notebook_menu():
     print("2) ดูทั้งหมด")
     print("3) ดูแบบกรอง (brand/status/ช่วงราคา)")
     print("4) สถิติโดยสรุป (รวม stock/sold out)")
+    print("5) ค้นหา serial")
     print("0) กลับเมนูหลัก")
     choice = input("เลือก: ").strip()
     if choice == '1':
@@ -424,7 +3088,7 @@ def view_notebook_menu():
         for _, rec in nb_db.iter_active():
             print(unpack_notebook(rec))
     elif choice == '3':
-        print("กรอง: 1=brand, 2=status, 3=ช่วงราคา")
+        print("กรอง: 1=brand, 2=status, 3=ช่วงราคา, 4=หลายเงื่อนไข")
         g = input("เลือกตัวกรอง: ").strip()
         if g == '1':
             brand = input("ระบุแบรนด์: ").strip()
@@ -447,6 +3111,31 @@ def view_notebook_menu():
                 d = unpack_notebook(rec)
                 if pmin <= d['price'] <= pmax:
                     print(d)
+        elif g == '4':
+            # สร้างดัชนีรองของ brand/status (ครั้งแรกครั้งเดียว) ให้ Query เลือกใช้แทนการ scan
+            registry.field_index('nb', 'brand')
+            registry.field_index('nb', 'status')
+            q = Query('nb')
+            brand = input("แบรนด์ (เว้นว่าง=ทั้งหมด): ").strip()
+            if brand:
+                q.where('brand', 'ieq', brand)
+            st = input("สถานะ 1=stock, 0=sold (เว้นว่าง=ทั้งหมด): ").strip()
+            if st in ('0', '1'):
+                q.where('status', '==', int(st))
+            pmin = input("ราคา MIN (เว้นว่างได้): ").strip()
+            if pmin:
+                q.where('price', '>=', float(pmin))
+            pmax = input("ราคา MAX (เว้นว่างได้): ").strip()
+            if pmax:
+                q.where('price', '<=', float(pmax))
+            order = input("เรียงตาม price/rel (เว้นว่าง=ไม่เรียง): ").strip()
+            if order in ('price', 'rel'):
+                q.order_by(order, desc=input("มากไปน้อย? (y/n): ").strip().lower() == 'y')
+            n = input("จำนวนสูงสุด (เว้นว่าง=ทั้งหมด): ").strip()
+            if n.isdigit():
+                q.limit(int(n))
+            for d in q.run():
+                print(d)
     elif choice == '4':
         s = nb_db.stats()
         stock = 0
@@ -458,6 +3147,13 @@ def view_notebook_menu():
             else:
                 sold += 1
         print("สรุปโน้ตบุ๊ก:", s, "| stock=", stock, "sold_out=", sold)
+    elif choice == '5':
+        q = input("serial (บางส่วน): ").strip()
+        prefix = input("1=ขึ้นต้นด้วย, 2=มีคำนี้ [2]: ").strip() == '1'
+        for nid in nb_search.search(q, prefix=prefix):
+            _, rec = nb_db.get(nid)
+            if rec is not None:
+                print(unpack_notebook(rec))
 
 # ---- รายการขาย ----
 def add_soldout():
@@ -468,28 +3164,32 @@ def add_soldout():
     sold_date = input_fixed_str("Sold date: ", 12)
     status = input_status("สถานะ 1=instock, 0=soldout (ตามสเปคไฟล์)")
     packed = pack_soldout(0, sid, nid, cid, name, sold_date, status)
-    so_db.add(packed, sid)
+    # ถือ STORE_LOCK ครอบทั้งการบันทึกการขายและการอัปเดตสถานะโน้ตบุ๊ก ให้ snapshot เห็นพร้อมกัน
+    with STORE_LOCK:
+        if sid in registry.sales_archive():
+            raise ValueError(f"ID {sid} มีอยู่แล้วในคลังรายการขายเก่า")
+        so_db.add(packed, sid)
 
-    # อัปเดตสถานะโน้ตบุ๊กตามการขาย — ใช้ offset ที่ได้จาก nb_db.get()
-    try:
-        off, nbrec = nb_db.get(nid)
-        if nbrec is not None:
-            nbdata = unpack_notebook(nbrec)
-            # เก็บค่า is_deleted ถ้ามี (fallback=0)
-            is_deleted = nbdata.get('is_deleted', 0)
-            packed_nb = pack_notebook(is_deleted,
-                                      nbdata['notebook_id'],
-                                      nbdata['brand'],
-                                      nbdata['serial_num'],
-                                      nbdata['rel'],
-                                      nbdata['price'],
-                                      status)
-            nb_db.update(off, packed_nb)   # <-- ใช้ offset แทน id
-            log_action(f"Notebook id={nid} status updated to {status} due to sale")
-        else:
-            print("** Warning: ไม่พบ notebook เพื่ออัปเดตสถานะ **")
-    except Exception as e:
-        print("** Warning: ไม่สามารถอัปเดตสถานะโน้ตบุ๊กได้:", e)
+        # อัปเดตสถานะโน้ตบุ๊กตามการขาย
+        try:
+            off, nbrec = nb_db.get(nid)
+            if nbrec is not None:
+                nbdata = unpack_notebook(nbrec)
+                # เก็บค่า is_deleted ถ้ามี (fallback=0)
+                is_deleted = nbdata.get('is_deleted', 0)
+                packed_nb = pack_notebook(is_deleted,
+                                          nbdata['notebook_id'],
+                                          nbdata['brand'],
+                                          nbdata['serial_num'],
+                                          nbdata['rel'],
+                                          nbdata['price'],
+                                          status)
+                nb_db.update(nid, packed_nb)
+                log_action(f"Notebook id={nid} status updated to {status} due to sale")
+            else:
+                print("** Warning: ไม่พบ notebook เพื่ออัปเดตสถานะ **")
+        except Exception as e:
+            print("** Warning: ไม่สามารถอัปเดตสถานะโน้ตบุ๊กได้:", e)
 
     log_action(f"Add Soldout id={sid}, nid={nid}, cid={cid}")
 
@@ -508,28 +3208,82 @@ def update_soldout():
     st_in = input(f"สถานะ (1/0) [{data['status']}]: ").strip()
     status = int(st_in) if st_in in ('0', '1') else data['status']
     packed = pack_soldout(0, sid, nid, cid, name, sold_date, status)
-    so_db.update(sid, packed)
+    # ถือ STORE_LOCK ครอบทั้งการบันทึกการขายและการอัปเดตสถานะโน้ตบุ๊ก ให้ snapshot เห็นพร้อมกัน
+    with STORE_LOCK:
+        so_db.update(sid, packed)
 
-    # อัปเดตสถานะโน้ตบุ๊ก ให้สอดคล้องกับ record การขายนี้ — ใช้ offset ของ notebook
-    try:
-        off, nbrec = nb_db.get(nid)
-        if nbrec is not None:
-            nbdata = unpack_notebook(nbrec)
-            is_deleted = nbdata.get('is_deleted', 0)
-            packed_nb = pack_notebook(is_deleted,
-                                      nbdata['notebook_id'],
-                                      nbdata['brand'],
-                                      nbdata['serial_num'],
-                                      nbdata['rel'],
-                                      nbdata['price'],
-                                      status)
-            nb_db.update(off, packed_nb)   # <-- ใช้ offset แทน id
-            log_action(f"Notebook id={nid} status updated to {status} due to soldout update")
-    except Exception as e:
-        print("** Warning: ไม่สามารถอัปเดตสถานะโน้ตบุ๊กได้:", e)
+        # อัปเดตสถานะโน้ตบุ๊ก ให้สอดคล้องกับ record การขายนี้
+        try:
+            off, nbrec = nb_db.get(nid)
+            if nbrec is not None:
+                nbdata = unpack_notebook(nbrec)
+                is_deleted = nbdata.get('is_deleted', 0)
+                packed_nb = pack_notebook(is_deleted,
+                                          nbdata['notebook_id'],
+                                          nbdata['brand'],
+                                          nbdata['serial_num'],
+                                          nbdata['rel'],
+                                          nbdata['price'],
+                                          status)
+                nb_db.update(nid, packed_nb)
+                log_action(f"Notebook id={nid} status updated to {status} due to soldout update")
+        except Exception as e:
+            print("** Warning: ไม่สามารถอัปเดตสถานะโน้ตบุ๊กได้:", e)
 
     log_action(f"Update Soldout id={sid}")
 
+def record_sales(sales, cus_db=cus_db, nb_db=nb_db, so_db=so_db, archive=None):
+    """บันทึกการขายหลายรายการแบบทั้งหมดหรือไม่มีเลย
+    sales: iterable ของ (sold_out_id, notebook_id, customer_id, sold_date)
+    ตรวจทุกรายการกับดัชนีในหน่วยความจำ (และ sold_out_id กับคลังขายเก่า) ก่อน
+    ถ้ามีข้อผิดพลาดจะ raise ValueError โดยไม่เขียนอะไร
+    จากนั้น append รายการขายทั้งหมดในการเขียนครั้งเดียว และตั้งสถานะโน้ตบุ๊กเป็น 0 (sold) เรียงตาม offset"""
+    sales = list(sales)
+    if not sales:
+        return 0
+    archive = archive if archive is not None else registry.sales_archive()
+    with STORE_LOCK:
+        errors = []
+        seen_sid = set()
+        seen_nid = set()
+        for sid, nid, cid, _date in sales:
+            if sid in so_db.index or sid in seen_sid or sid in archive:
+                errors.append(f"sold_out_id {sid} ซ้ำ")
+            seen_sid.add(sid)
+            if nid not in nb_db.index:
+                errors.append(f"sold_out_id {sid}: ไม่พบ notebook_id {nid}")
+            elif nid in seen_nid:
+                errors.append(f"sold_out_id {sid}: notebook_id {nid} ถูกขายซ้ำในชุดเดียวกัน")
+            seen_nid.add(nid)
+            if cid not in cus_db.index:
+                errors.append(f"sold_out_id {sid}: ไม่พบ customer_id {cid}")
+        notebooks = nb_db.get_many(seen_nid) if not errors else {}
+        for nid, rec in notebooks.items():
+            if rec[6] == 0:
+                errors.append(f"notebook_id {nid} ขายไปแล้ว")
+        if errors:
+            raise ValueError("บันทึกการขายไม่สำเร็จ:\n" + "\n".join(errors))
+
+        customers = cus_db.get_many(cid for _, _, cid, _ in sales)
+        so_items = [
+            (sid, pack_soldout(0, sid, nid, cid, unpack_customer(customers[cid])['name'], sold_date, 0))
+            for sid, nid, cid, sold_date in sales
+        ]
+        nb_items = [(nid, struct.pack(NB_FMT, *rec[:6], 0)) for nid, rec in notebooks.items()]
+        so_db.add_many(so_items)
+        nb_db.update_many(nb_items)
+    log_action(f"Record {len(sales)} sales in batch")
+    return len(sales)
+
+def import_sales_csv(path: str):
+    """นำเข้าการขายจากไฟล์ CSV (sold_out_id,notebook_id,customer_id,sold_date; บรรทัดแรกเป็นหัวตาราง)"""
+    import csv
+    with open(path, newline='', encoding='utf-8') as f:
+        reader = csv.reader(f)
+        next(reader, None)
+        sales = [(int(r[0]), int(r[1]), int(r[2]), r[3].strip()) for r in reader if r]
+    return record_sales(sales)
+
 def delete_soldout():
     sid = input_int("ระบุ sold_out_id ที่ต้องการลบ: ", allow_zero=False, positive_only=True)
     so_db.delete(sid)
@@ -545,33 +3299,31 @@ def view_soldout_menu():
     choice = input("เลือก: ").strip()
     if choice == '1':
         sid = input_int("ระบุ sold_out_id: ", allow_zero=False, positive_only=True)
-        offset, rec = so_db.get(sid)
+        offset, rec = sales.get(sid)
         if rec is None:
             print("** ไม่พบข้อมูล **")
             return
         print(unpack_soldout(rec))
     elif choice == '2':
-        for _, rec in so_db.iter_active():
+        for _, rec in sales.iter_active():
             print(unpack_soldout(rec))
     elif choice == '3':
         print("กรอง: 1=วันที่ขาย, 2=สถานะ")
         g = input("เลือกตัวกรอง: ").strip()
         if g == '1':
             date_str = input("ระบุวันที่ (เช่น 2025-10-01): ").strip()
-            for _, rec in so_db.iter_active():
-                d = unpack_soldout(rec)
-                if d['soldout_date'] == date_str:
-                    print(d)
+            for _, rec in sales.find_by_date(date_str):
+                print(unpack_soldout(rec))
         elif g == '2':
             st = input_status("สถานะที่ต้องการ (1=instock,0=soldout)")
-            for _, rec in so_db.iter_active():
+            for _, rec in sales.iter_active():
                 d = unpack_soldout(rec)
                 if d['status'] == st:
                     print(d)
     elif choice == '4':
-        s = so_db.stats()
+        s = sales.stats()
         instock = soldout = 0
-        for _, rec in so_db.iter_active():
+        for _, rec in sales.iter_active():
             d = unpack_soldout(rec)
             if d['status'] == 1:
                 instock += 1
@@ -594,80 +3346,208 @@ def _tz_offset_str():
     mm = (offset_sec % 3600) // 60
     return f"{sign}{hh:02d}:{mm:02d}"
 
+def display_width(s: str) -> int:
+    """ความกว้างที่แสดงจริงบนจอ: สระบน/ล่างและวรรณยุกต์ไทย (combining) กว้าง 0, อักษรเต็มความกว้าง (CJK) กว้าง 2"""
+    if s.isascii():
+        return len(s)
+    w = 0
+    for ch in s:
+        if unicodedata.combining(ch) or unicodedata.category(ch) in ('Mn', 'Me', 'Cf'):
+            continue
+        w += 2 if unicodedata.east_asian_width(ch) in ('W', 'F') else 1
+    return w
+
+def fit_width(s: str, w: int) -> str:
+    """ตัดสตริงให้กว้างไม่เกิน w ช่อง โดยไม่แยกสระ/วรรณยุกต์ออกจากพยัญชนะ แล้วคืนพร้อมความกว้างจริง"""
+    if s.isascii():
+        s = s[:w]
+        return s, len(s)
+    used = 0
+    out = []
+    for ch in s:
+        cw = display_width(ch)
+        if used + cw > w:
+            break
+        out.append(ch)
+        used += cw
+    return ''.join(out), used
+
+def _cell_formatter(w, align):
+    """สร้างฟังก์ชันจัดรูปหนึ่งคอลัมน์ล่วงหน้า (ASCII ใช้ ljust/rjust ตรง ๆ ซึ่งเร็วที่สุด)"""
+    pad_right = align != 'r'
+
+    def fmt(val):
+        s = val if type(val) is str else str(val)
+        if s.isascii():
+            s = s[:w]
+            return s.ljust(w) if pad_right else s.rjust(w)
+        s, used = fit_width(s, w)
+        pad = ' ' * (w - used)
+        return s + pad if pad_right else pad + s
+    return fmt
+
+class TableWriter:
+    """ตัวเขียนตารางแบบ streaming: รับแถวทีละแถวแล้วเขียนลง file object ทันที
+    headers: list[(ชื่อคอลัมน์, ความกว้าง)], aligns: list['l'|'r']"""
+    def __init__(self, out, headers, aligns=None):
+        self.out = out
+        self.headers = headers
+        self.names = [h for h, _ in headers]
+        self.aligns = list(aligns or []) + ['l'] * (len(headers) - len(aligns or []))
+        self.rows = 0
+
+    def begin(self):
+        pass
+
+    def row(self, r):
+        raise NotImplementedError
+
+    def end(self):
+        pass
+
+    def write_rows(self, rows):
+        """เขียนทุกแถวจาก iterable (ไม่ต้องเก็บทั้งหมดไว้ใน list) คืนจำนวนแถว"""
+        self.begin()
+        row = self.row
+        for r in rows:
+            row(r)
+        self.end()
+        return self.rows
+
+class AsciiTableWriter(TableWriter):
+    """ตาราง ASCII แบบเดิมของรายงาน จัดความกว้างตามช่องที่แสดงจริง (รองรับภาษาไทย)"""
+    BATCH = 512  # จำนวนบรรทัดที่รวมก่อนเขียนหนึ่งครั้ง
+
+    def __init__(self, out, headers, aligns=None):
+        super().__init__(out, headers, aligns)
+        self.border = '+' + '+'.join('-' * w for _, w in headers) + '+'
+        self.fmts = [_cell_formatter(w, a) for (_, w), a in zip(headers, self.aligns)]
+        # แถวที่เป็น ASCII ล้วนจัดรูปทั้งแถวด้วย % ครั้งเดียว (ตัด+เติมช่องว่างใน C)
+        self.template = '|' + '|'.join(
+            (f'%{w}.{w}s' if a == 'r' else f'%-{w}.{w}s') for (_, w), a in zip(headers, self.aligns)
+        ) + '|'
+        self._buf = []
+
+    def _flush(self):
+        if self._buf:
+            self.out.write('\n'.join(self._buf) + '\n')
+            self._buf.clear()
+
+    def row(self, r):
+        buf = self._buf
+        if not self.rows:
+            head_fmts = [_cell_formatter(w, 'l') for _, w in self.headers]
+            buf.append(self.border)
+            buf.append('|' + '|'.join(f(h) for f, h in zip(head_fmts, self.names)) + '|')
+            buf.append(self.border)
+        cells = tuple([v if type(v) is str else str(v) for v in r])
+        if ''.join(cells).isascii():
+            buf.append(self.template % cells)
+        else:
+            buf.append('|' + '|'.join([f(v) for f, v in zip(self.fmts, cells)]) + '|')
+        self.rows += 1
+        if len(buf) >= self.BATCH:
+            self._flush()
+
+    def end(self):
+        if self.rows:
+            self._buf.append(self.border)
+        else:
+            self._buf.append("(No active records)")
+        self._flush()
+
+class CsvTableWriter(TableWriter):
+    def begin(self):
+        import csv
+        self._w = csv.writer(self.out, lineterminator='\n')
+        self._w.writerow(self.names)
+
+    def row(self, r):
+        self._w.writerow(r)
+        self.rows += 1
+
+class JsonLinesTableWriter(TableWriter):
+    """หนึ่งแถวต่อหนึ่งบรรทัด JSON (ตัวเลขยังเป็นตัวเลข)"""
+    def row(self, r):
+        self.out.write(json.dumps(dict(zip(self.names, r)), ensure_ascii=False) + '\n')
+        self.rows += 1
+
+class HtmlTableWriter(TableWriter):
+    def begin(self):
+        from html import escape
+        self._esc = escape
+        self._open = ['<td style="text-align:right">' if a == 'r' else '<td>' for a in self.aligns]
+        self.out.write('<table>\n<thead><tr>' +
+                       ''.join(f'<th>{escape(h)}</th>' for h in self.names) +
+                       '</tr></thead>\n<tbody>\n')
+
+    def row(self, r):
+        esc = self._esc
+        self.out.write('<tr>' + ''.join(f'{o}{esc(str(v))}</td>' for o, v in zip(self._open, r)) + '</tr>\n')
+        self.rows += 1
+
+    def end(self):
+        self.out.write('</tbody>\n</table>\n')
+
+TABLE_WRITERS = {
+    'ascii': AsciiTableWriter,
+    'csv': CsvTableWriter,
+    'jsonl': JsonLinesTableWriter,
+    'html': HtmlTableWriter,
+}
+
+def render_table(out, headers, rows, aligns=None, fmt='ascii'):
+    """เขียนตารางจาก iterable ของแถวลง out ในรูปแบบ fmt (ascii/csv/jsonl/html) คืนจำนวนแถว"""
+    if fmt not in TABLE_WRITERS:
+        raise ValueError(f"ไม่รู้จักรูปแบบ {fmt} (มี: {', '.join(TABLE_WRITERS)})")
+    return TABLE_WRITERS[fmt](out, headers, aligns).write_rows(rows)
+
 def _render_table(headers, rows, aligns=None):
     """
     headers: list[(ชื่อคอลัมน์, ความกว้าง)]
-    rows   : list[list[str]] (ต้องมีจำนวนคอลัมน์ตรงกับ headers)
+    rows   : iterable[list] (ต้องมีจำนวนคอลัมน์ตรงกับ headers)
     aligns : list['l'|'r'] ความยาวเท่ากับจำนวนคอลัมน์ ถ้าไม่ระบุจะชิดซ้ายทั้งหมด
     """
-    if not rows:
-        return "(No active records)"
-    if aligns is None:
-        aligns = ['l'] * len(headers)
-
-    def border():
-        return '+' + '+'.join('-' * w for _, w in headers) + '+'
-
-    def fmt_cell(val, w, align='l'):
-        s = str(val)
-        if len(s) > w:
-            s = s[:w]
-        return s.rjust(w) if align == 'r' else s.ljust(w)
-
-    # Header row
-    lines = [border()]
-    head = '|' + '|'.join(fmt_cell(h, w, 'l') for h, w in headers) + '|'
-    lines.append(head)
-    lines.append(border())
-
-    # Data rows
-    for r in rows:
-        line = '|' + '|'.join(
-            fmt_cell(v, headers[i][1], aligns[i] if i < len(aligns) else 'l')
-            for i, v in enumerate(r)
-        ) + '|'
-        lines.append(line)
-    lines.append(border())
-    return '\n'.join(lines)
+    buf = io.StringIO()
+    render_table(buf, headers, rows, aligns)
+    return buf.getvalue()[:-1]
 
 # ---- รายงาน ----
-def build_report_text():
-    # เวลา (แสดงออฟเซ็ตโซนเวลา เช่น +07:00)
-    now_str = f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')} ({_tz_offset_str()})"
-
-    # สถิติรวมจากไฟล์
-    nb_s = nb_db.stats()
-
-    # สร้างแมปลูกค้า (id -> record) จาก cus_db
-    cus_map = {}
-    for _, crec in cus_db.iter_active():
-        cd = unpack_customer(crec)
-        cus_map[cd['customer_id']] = cd
-
-    # สร้างแมป notebook_id -> customer_id จาก so_db (รายการขาย)
-    nb_to_cid = {}
-    for _, srec in so_db.iter_active():
-        sd = unpack_soldout(srec)
-        # ถ้าขายหลายครั้ง จะใช้รายการล่าสุดที่วนเจอ (ไฟล์เรียงตามการเพิ่ม)
-        nb_to_cid[sd['notebook_id']] = sd['customer_id']
-
-    # รวบรวมข้อมูลสำหรับตาราง และคำนวณสรุป
-    nb_rows = []
-    prices = []
-    brand_counter = Counter()
-    stock = sold = 0
-
+# ตารางหลัก (NotebookID ตามด้วย CusID, Tel, Address)
+REPORT_HEADERS = [
+    ("NotebookID", 12),
+    ("CusID", 8),
+    ("Tel", 12),
+    ("Address", 24),
+    ("Brand", 12),
+    ("Serial", 16),
+    ("Year", 6),
+    ("Price (THB)", 12),
+    ("Status", 10),
+    ("Sold", 6),
+]
+REPORT_ALIGNS = ['r', 'r', 'l', 'l', 'l', 'l', 'r', 'r', 'l', 'l']
+
+def _report_rows(nb_db, nb_to_cid, cus_map, acc):
+    """สร้างแถวของตารางรายงานทีละแถว พร้อมสะสมสถิติลง acc"""
+    brand_counter = acc['brands']
     for _, rec in nb_db.iter_active():
         d = unpack_notebook(rec)
 
         status_txt = 'Active' if d['status'] == 1 else 'Sold Out'
         sold_txt = 'Yes' if d['status'] == 0 else 'No'
         if d['status'] == 1:
-            stock += 1
+            acc['stock'] += 1
         else:
-            sold += 1
-
-        prices.append(d['price'])
+            acc['sold'] += 1
+
+        price = d['price']
+        acc['count'] += 1
+        acc['sum'] += price
+        if acc['min'] is None or price < acc['min']:
+            acc['min'] = price
+        if acc['max'] is None or price > acc['max']:
+            acc['max'] = price
         brand_counter[d['brand']] += 1
 
         # หาข้อมูลลูกค้าที่เกี่ยวข้อง (ถ้ามี)
@@ -681,7 +3561,7 @@ def build_report_text():
                 addr = cust.get('address', '')
 
         # เปลี่ยนลำดับคอลัมน์: NotebookID, CusID, Tel, Address, Brand, Serial, Year, Price, Status, Sold
-        nb_rows.append([
+        yield [
             d['notebook_id'],
             cid,
             tel,
@@ -689,94 +3569,14 @@ def build_report_text():
             d['brand'],
             d['serial_num'],
             d['rel'],
-            f"{d['price']:.2f}",
+            f"{price:.2f}",
             status_txt,
             sold_txt,
-        ])
-
-    # สถิติราคา (เฉพาะ Active)
-    if prices:
-        p_min = min(prices)
-        p_max = max(prices)
-        p_avg = sum(prices) / len(prices)
-    else:
-        p_min = p_max = p_avg = None
-
-    # ส่วนหัวรายงาน
-    header_lines = [
-        "Notebook Store – Summary Report (Sample)",
-        f"Generated At: {now_str}",
-        "App Version: 1.0",
-        "Endianness: Little-Endian",
-        "Encoding: UTF-8 (fixed-length)",
-        "",
-    ]
-
-    # ตารางหลัก (NotebookID ตามด้วย CusID, Tel, Address)
-    nb_headers = [
-        ("NotebookID", 12),
-        ("CusID", 8),
-        ("Tel", 12),
-        ("Address", 24),
-        ("Brand", 12),
-        ("Model", 16),
-        ("Year", 6),
-        ("Price (THB)", 12),
-        ("Status", 10),
-        ("Sold", 6),
-    ]
-    nb_aligns = ['r', 'r', 'l', 'l', 'l', 'l', 'r', 'r', 'l', 'l']
-    nb_table = _render_table(nb_headers, nb_rows, nb_aligns)
-
-    # สรุป (เฉพาะ Active)
-    summary_lines = [
-        "",
-        "Summary (เฉพาะสถานะ Active)",
-        f"– Total Notebooks (records): {nb_s['total_slots']}",
-        f"– Active Notebooks: {nb_s['active']}",
-        f"– Deleted Notebooks: {nb_s['deleted']}",
-        f"– Currently Sold: {sold}",
-        f"– Available Now: {stock}",
-        "",
-        "Price Statistics (THB, Active only):",
-        f"– Min : {p_min:.2f}" if p_min is not None else "– Min : N/A",
-        f"– Max : {p_max:.2f}" if p_max is not None else "– Max : N/A",
-        f"– Avg : {p_avg:.2f}" if p_avg is not None else "– Avg : N/A",
-        "",
-        "Notebooks by Brand (Active only):",
-    ]
-    if brand_counter:
-        for brand, cnt in sorted(brand_counter.items()):
-            summary_lines.append(f"– {brand} : {cnt}")
-    else:
-        summary_lines.append("– (none)")
-
-    # กิจกรรมล่าสุด
-    activity_block = ["", "Recent Activities:"]
-    last_n = activity_log[-50:]
-    if last_n:
-        activity_block.extend(last_n)
-    else:
-        activity_block.append("(no activities in this session)")
-
-    parts = []
-    parts.extend(header_lines)
-    parts.append(nb_table)
-    parts.extend(summary_lines)
-    parts.extend(activity_block)
-    parts.append("")
-
-    return "\n".join(parts)
-# ...existing code...
-# filepath: /home/pkp/Notebook_Report/cpro.py
-# ...existing code...
-def build_report_text():
-    # เวลา (แสดงออฟเซ็ตโซนเวลา เช่น +07:00)
-    now_str = f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')} ({_tz_offset_str()})"
-
-    # สถิติรวมจากไฟล์
-    nb_s = nb_db.stats()
+        ]
 
+def write_report(out, cus_db=cus_db, nb_db=nb_db, so_db=so_db, fmt='ascii'):
+    """เขียนรายงานลง file object แบบ streaming (ไม่เก็บตารางทั้งหมดไว้ในหน่วยความจำ)
+    fmt='ascii' คือรายงานเต็มแบบเดิม; csv/jsonl/html จะเขียนเฉพาะตาราง"""
     # สร้างแมปลูกค้า (id -> record) จาก cus_db
     cus_map = {}
     for _, crec in cus_db.iter_active():
@@ -789,87 +3589,34 @@ def build_report_text():
         sd = unpack_soldout(srec)
         nb_to_cid[sd['notebook_id']] = sd['customer_id']
 
-    # DEBUG: แสดงแม็ปในรายงาน (ลบออกเมื่อเสร็จ)
-    debug_lines = []
-    debug_lines.append(f"DEBUG: nb_to_cid = {nb_to_cid}")
-    debug_lines.append(f"DEBUG: cus_map keys = {list(cus_map.keys())}")
-
-    # รวบรวมข้อมูลสำหรับตาราง และคำนวณสรุป
-    nb_rows = []
-    prices = []
-    brand_counter = Counter()
-    stock = sold = 0
-
-    for _, rec in nb_db.iter_active():
-        d = unpack_notebook(rec)
-
-        status_txt = 'Active' if d['status'] == 1 else 'Sold Out'
-        sold_txt = 'Yes' if d['status'] == 0 else 'No'
-        if d['status'] == 1:
-            stock += 1
-        else:
-            sold += 1
-
-        prices.append(d['price'])
-        brand_counter[d['brand']] += 1
-
-        # หาข้อมูลลูกค้าที่เกี่ยวข้อง (ถ้ามี)
-        cid = nb_to_cid.get(d['notebook_id'], '')
-        tel = ''
-        addr = ''
-        if cid:
-            cust = cus_map.get(cid)
-            if cust:
-                tel = cust.get('tel', '')
-                addr = cust.get('address', '')
+    acc = {'stock': 0, 'sold': 0, 'count': 0, 'sum': 0.0, 'min': None, 'max': None,
+           'brands': Counter()}
+    rows = _report_rows(nb_db, nb_to_cid, cus_map, acc)
+    if fmt != 'ascii':
+        render_table(out, REPORT_HEADERS, rows, REPORT_ALIGNS, fmt)
+        return
 
-        # เปลี่ยนลำดับคอลัมน์: NotebookID, CusID, Tel, Address, Brand, Serial, Year, Price, Status, Sold
-        nb_rows.append([
-            d['notebook_id'],
-            cid,
-            tel,
-            addr,
-            d['brand'],
-            d['serial_num'],
-            d['rel'],
-            f"{d['price']:.2f}",
-            status_txt,
-            sold_txt,
-        ])
+    # เวลา (แสดงออฟเซ็ตโซนเวลา เช่น +07:00)
+    now_str = f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')} ({_tz_offset_str()})"
 
-    # สถิติราคา (เฉพาะ Active)
-    if prices:
-        p_min = min(prices)
-        p_max = max(prices)
-        p_avg = sum(prices) / len(prices)
-    else:
-        p_min = p_max = p_avg = None
+    # สถิติรวมจากไฟล์
+    nb_s = nb_db.stats()
 
     # ส่วนหัวรายงาน
-    header_lines = [
+    out.write("\n".join([
         "Notebook Store – Summary Report (Sample)",
         f"Generated At: {now_str}",
         "App Version: 1.0",
         "Endianness: Little-Endian",
         "Encoding: UTF-8 (fixed-length)",
         "",
-    ]
+        "",
+    ]))
+    render_table(out, REPORT_HEADERS, rows, REPORT_ALIGNS)
 
-    # ตารางหลัก (NotebookID ตามด้วย CusID, Tel, Address)
-    nb_headers = [
-        ("NotebookID", 12),
-        ("CusID", 8),
-        ("Tel", 12),
-        ("Address", 24),
-        ("Brand", 12),
-        ("Serial", 16),
-        ("Year", 6),
-        ("Price (THB)", 12),
-        ("Status", 10),
-        ("Sold", 6),
-    ]
-    nb_aligns = ['r', 'r', 'l', 'l', 'l', 'l', 'r', 'r', 'l', 'l']
-    nb_table = _render_table(nb_headers, nb_rows, nb_aligns)
+    # สถิติราคา (เฉพาะ Active)
+    p_min, p_max = acc['min'], acc['max']
+    p_avg = acc['sum'] / acc['count'] if acc['count'] else None
 
     # สรุป (เฉพาะ Active)
     summary_lines = [
@@ -878,8 +3625,8 @@ def build_report_text():
         f"– Total Notebooks (records): {nb_s['total_slots']}",
         f"– Active Notebooks: {nb_s['active']}",
         f"– Deleted Notebooks: {nb_s['deleted']}",
-        f"– Currently Sold: {sold}",
-        f"– Available Now: {stock}",
+        f"– Currently Sold: {acc['sold']}",
+        f"– Available Now: {acc['stock']}",
         "",
         "Price Statistics (THB, Active only):",
         f"– Min : {p_min:.2f}" if p_min is not None else "– Min : N/A",
@@ -888,8 +3635,8 @@ def build_report_text():
         "",
         "Notebooks by Brand (Active only):",
     ]
-    if brand_counter:
-        for brand, cnt in sorted(brand_counter.items()):
+    if acc['brands']:
+        for brand, cnt in sorted(acc['brands'].items()):
             summary_lines.append(f"– {brand} : {cnt}")
     else:
         summary_lines.append("– (none)")
@@ -903,15 +3650,17 @@ def build_report_text():
         activity_block.append("(no activities in this session)")
 
     parts = []
-    parts.extend(header_lines)
-    parts.append(nb_table)
     parts.extend(summary_lines)
     parts.extend(activity_block)
-    parts.append("") 
-    parts.extend(debug_lines)   # <-- ให้บล็อก debug แสดงในท้ายรายงาน
     parts.append("")
+    out.write("\n".join(parts))
+
+def build_report_text(cus_db=cus_db, nb_db=nb_db, so_db=so_db):
+    """สร้างข้อความรายงาน; ส่ง store อื่น (เช่น ShardedStore หรือ Snapshot) แทนสามแฟ้มหลักได้"""
+    buf = io.StringIO()
+    write_report(buf, cus_db, nb_db, so_db)
+    return buf.getvalue()
 
-    return "\n".join(parts)
 # --------------------------
 # เมนูหลัก
 # --------------------------
@@ -923,6 +3672,7 @@ def main_menu():
         print("3) Delete (ลบ)")
         print("4) View (ดู)")
         print("5) Report (.txt) (สร้างรายงาน)")
+        print("6) Export ตารางรายงาน (csv/jsonl/html)")
         print("0) Exit")
         choice = input("เลือกเมนู: ").strip()
 
@@ -971,13 +3721,26 @@ def main_menu():
             elif c == '3': view_soldout_menu()
 
         elif choice == '5':
-            report_text = build_report_text()
-            with open(REPORT_FILE, 'w', encoding='utf-8') as rf:
-                rf.write(report_text)
+            with snapshot_all(cus_db, nb_db, so_db) as (c, n, so), \
+                    open(REPORT_FILE, 'w', encoding='utf-8') as rf:
+                write_report(rf, c, n, SalesTiers(so, registry.sales_archive()))
             log_action(f"Report written: {REPORT_FILE}")
             print(f"Report saved to {REPORT_FILE}")
 
+        elif choice == '6':
+            fmt = input("รูปแบบ (csv/jsonl/html): ").strip().lower()
+            if fmt not in TABLE_WRITERS or fmt == 'ascii':
+                print("** รูปแบบไม่ถูกต้อง **")
+                continue
+            path = f"report.{fmt}"
+            with snapshot_all(cus_db, nb_db, so_db) as (c, n, so), \
+                    open(path, 'w', encoding='utf-8', newline='') as ef:
+                write_report(ef, c, n, SalesTiers(so, registry.sales_archive()), fmt=fmt)
+            log_action(f"Report exported: {path}")
+            print(f"Exported to {path}")
+
         elif choice == '0':
+            registry.close()
             print("ลาก่อน")
             break
 
@@ -985,4 +3748,21 @@ def main_menu():
             print("** เมนูไม่ถูกต้อง กรุณาลองใหม่ **")
 
 if __name__ == '__main__':
-    main_menu()
\ No newline at end of file
+    if sys.argv[1:2] == ['migrate']:
+        for r in registry.migrate(checksums=True if '--checksums' in sys.argv else None):
+            print(r)
+    elif sys.argv[1:] == ['scrub']:
+        print(Scrubber(bytes_per_sec=0).run_once())
+    elif len(sys.argv) == 3 and sys.argv[1] == 'import-sales':
+        import_sales_csv(sys.argv[2])
+    elif len(sys.argv) == 3 and sys.argv[1] == 'archive-sales':
+        print(archive_sales(sys.argv[2]), "sales archived")
+    elif 3 <= len(sys.argv) <= 5 and sys.argv[1] == 'replay':
+        # python cpro.py replay <trace> [speed] [workers]
+        import tempfile
+        speed = float(sys.argv[3]) if len(sys.argv) > 3 else 0
+        workers = int(sys.argv[4]) if len(sys.argv) > 4 else 1
+        with tempfile.TemporaryDirectory() as tmp:
+            print(json.dumps(replay_trace(sys.argv[2], tmp, speed, workers), indent=2))
+    else:
+        main_menu()
\ No newline at end of file
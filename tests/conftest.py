@@ -0,0 +1,17 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cpro  # noqa: E402
+
+
+@pytest.fixture
+def reg(tmp_path):
+    """StoreRegistry ในโฟลเดอร์ชั่วคราว ไม่แตะไฟล์ .dat ของโปรเจกต์"""
+    r = cpro.StoreRegistry(str(tmp_path / 'primary'))
+    os.makedirs(r.base_dir, exist_ok=True)
+    yield r
+    r.close()
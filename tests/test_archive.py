@@ -0,0 +1,58 @@
+import cpro
+
+
+def sale(sid, date, name='x'):
+    return cpro.pack_soldout(0, sid, sid, 1, name, date, 1)
+
+
+def fill(so, n=50):
+    so.add_many([(i, sale(i, '2020-01-01' if i <= 30 else '2026-01-01')) for i in range(1, n + 1)])
+
+
+def test_rows_changed_after_the_scan_are_not_archived(reg, monkeypatch):
+    so = reg.store('so')
+    fill(so)
+    archive = reg.sales_archive()
+    real = so.iter_active
+
+    def racing_scan():
+        # สแกนไม่ถือ lock: มีการแก้และลบรายการเก่าหลังจากอ่านผ่านไปแล้ว
+        yield from real()
+        so.update(5, sale(5, '2020-01-01', name='edited'))
+        so.delete(6)
+    monkeypatch.setattr(so, 'iter_active', racing_scan)
+
+    assert cpro.archive_sales('2021-01-01', so_db=so, archive=archive) == 28
+    monkeypatch.undo()
+    assert 5 not in archive and 6 not in archive
+    assert so.get(5)[1][4].rstrip(b'\x00') == b'edited'
+    tiers = cpro.SalesTiers(so, archive)
+    assert sorted(rec[1] for _, rec in tiers.iter_active()) == [i for i in range(1, 51) if i != 6]
+
+    # รอบถัดไปย้าย id 5 ตามข้อมูลที่แก้แล้ว
+    assert cpro.archive_sales('2021-01-01', so_db=so, archive=archive) == 1
+    assert archive.get(5)[4].rstrip(b'\x00') == b'edited'
+
+
+def test_rerun_after_interrupted_archive_only_deletes_matching_copies(reg):
+    so = reg.store('so')
+    fill(so)
+    archive = reg.sales_archive()
+    # รอบก่อนเขียนคลังเสร็จแต่ยังไม่ได้ลบจาก hot และ id 7 ถูกแก้หลังจากนั้น
+    archive.write_segment([rec for _, rec in so.iter_active() if rec[1] <= 30])
+    so.update(7, sale(7, '2020-01-01', name='edited'))
+    assert cpro.archive_sales('2021-01-01', so_db=so, archive=archive) == 29
+    assert so.get(7)[1][4].rstrip(b'\x00') == b'edited'
+    assert cpro.SalesTiers(so, archive).get(7)[1][4].rstrip(b'\x00') == b'edited'
+
+
+def test_open_snapshot_defers_compaction(reg):
+    so = reg.store('so')
+    fill(so)
+    archive = reg.sales_archive()
+    with so.snapshot() as snap:
+        assert cpro.archive_sales('2021-01-01', so_db=so, archive=archive) == 30
+        assert len(list(snap.iter_active())) == 50
+        assert so.stats()['holes'] == 30
+    assert len(archive) == 30
+    assert cpro.archive_sales('2021-01-01', so_db=so, archive=archive) == 0
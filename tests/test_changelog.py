@@ -0,0 +1,77 @@
+import os
+import random
+import threading
+
+import cpro
+
+
+def nb_rec(nid, price):
+    return cpro.pack_notebook(0, nid, 'B', f'SN{nid}', 2020, price, 1)
+
+
+def test_concurrent_writes_produce_a_consistent_before_after_chain(tmp_path):
+    """หลาย thread เขียน id ชุดเดียวกันพร้อมกัน: before ของทุกเหตุการณ์ต้องเท่ากับ after
+    ของเหตุการณ์ก่อนหน้าของ id เดียวกัน และ after สุดท้ายต้องตรงกับข้อมูลในแฟ้ม"""
+    reg = cpro.StoreRegistry(str(tmp_path), changelog='changes.log')
+    nb = reg.store('nb')
+    ids = list(range(1, 21))
+    nb.add_many([(i, nb_rec(i, 0.0)) for i in ids])
+
+    def writer(seed):
+        rnd = random.Random(seed)
+        for k in range(150):
+            rid = rnd.choice(ids)
+            price = float(seed * 1000 + k)
+            try:
+                if rnd.random() < 0.1:
+                    nb.delete(rid)
+                elif rnd.random() < 0.2:
+                    nb.add(nb_rec(rid, price), rid)
+                elif rnd.random() < 0.2:
+                    nb.update_many([(rid, nb_rec(rid, price))])
+                else:
+                    nb.update(rid, nb_rec(rid, price))
+            except ValueError:
+                pass    # id ถูกลบ/เพิ่มไปแล้วโดย thread อื่น
+
+    threads = [threading.Thread(target=writer, args=(s,)) for s in range(1, 7)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    reg.close()
+
+    feed = cpro.ChangeFeed(os.path.join(str(tmp_path), 'changes.log'))
+    events = [ev for _, ev in feed.events()]
+    assert [ev['lsn'] for ev in events] == list(range(1, len(events) + 1))
+
+    last = {}
+    for ev in events:
+        if ev['id'] in last:
+            assert ev['before'] == last[ev['id']], ev
+        last[ev['id']] = ev['after']
+
+    nb = reg.store('nb')
+    for rid in ids:
+        _, rec = nb.get(rid)
+        assert last[rid] == (cpro.unpack_notebook(rec) if rec is not None else None)
+    reg.close()
+
+
+def test_feed_resumes_from_saved_position(tmp_path):
+    reg = cpro.StoreRegistry(str(tmp_path), changelog='changes.log')
+    nb = reg.store('nb')
+    nb.add(nb_rec(1, 1.0), 1)
+    nb.update(1, nb_rec(1, 2.0))
+
+    feed = cpro.ChangeFeed(os.path.join(str(tmp_path), 'changes.log'))
+    pos = 0
+    for pos, ev in feed.events():
+        pass
+    feed.save_position('report', pos)
+
+    nb.delete(1)
+    reg.close()
+    rest = [ev for _, ev in feed.events(feed.load_position('report'))]
+    assert [(ev['op'], ev['id'], ev['after']) for ev in rest] == [('delete', 1, None)]
+    assert rest[0]['before']['price'] == 2.0
@@ -0,0 +1,108 @@
+import random
+from array import array
+
+import pytest
+
+import cpro
+
+
+def check_same(c, d):
+    assert len(c) == len(d)
+    assert sorted(c.items()) == sorted(d.items())
+    assert sorted(c) == sorted(d)
+
+
+@pytest.mark.parametrize('merge_min', [1, 4, 1024])
+def test_random_operations_match_dict(merge_min):
+    """เทียบกับ dict ทุกขั้น ทั้งตอนที่ยังอยู่ใน delta, ถูกลบเป็น TOMB และหลังรวมเข้าส่วนหลัก"""
+    rnd = random.Random(merge_min)
+    for _ in range(10):
+        init = [(rnd.randrange(500), rnd.randrange(10 ** 6)) for _ in range(rnd.randrange(300))]
+        d = dict(init)
+        c = cpro.CompactIndex(init)
+        c.MERGE_MIN = merge_min
+        for _ in range(2000):
+            k = rnd.randrange(600)
+            op = rnd.random()
+            if op < 0.4:
+                v = rnd.randrange(10 ** 6)
+                d[k] = v
+                c[k] = v
+            elif op < 0.6:
+                if k in d:
+                    del d[k]
+                    del c[k]
+                else:
+                    with pytest.raises(KeyError):
+                        del c[k]
+            elif op < 0.7:
+                assert c.pop(k, None) == d.pop(k, None)
+            elif op < 0.72:
+                c.merge()
+            else:
+                assert (k in c) == (k in d)
+                assert c.get(k) == d.get(k)
+            assert len(c) == len(d)
+        check_same(c, d)
+
+
+def test_dict_semantics_for_missing_and_foreign_keys():
+    c = cpro.CompactIndex([(1, 0), (3, 64)])
+    assert c[3] == 64 and c.get(2) is None and c.get(2, 'x') == 'x'
+    assert 'a' not in c and c.get(None) is None
+    with pytest.raises(KeyError):
+        c[2]
+    with pytest.raises(KeyError):
+        c.pop(2)
+    assert c.pop(1) == 0 and 1 not in c and len(c) == 1
+    c.clear()
+    assert len(c) == 0 and list(c.items()) == []
+
+
+@pytest.mark.parametrize('shape', ['sorted', 'reversed', 'nearly', 'random', 'duplicates'])
+def test_bulk_load_matches_dict(shape, monkeypatch):
+    # SORT_CHUNK เล็ก ๆ เพื่อให้ผ่านทั้งการเรียงทีละชิ้นและการ merge ของชิ้น
+    monkeypatch.setattr(cpro.CompactIndex, 'SORT_CHUNK', 64)
+    rnd = random.Random(shape)
+    n = 2000
+    keys = list(range(n))
+    if shape == 'reversed':
+        keys.reverse()
+    elif shape == 'nearly':
+        for _ in range(n // 20):
+            i, j = rnd.randrange(n), rnd.randrange(n)
+            keys[i], keys[j] = keys[j], keys[i]
+    elif shape == 'random':
+        rnd.shuffle(keys)
+    elif shape == 'duplicates':
+        keys = [rnd.randrange(n // 4) for _ in range(n)]
+    offsets = [i * 64 for i in range(len(keys))]
+
+    d = dict(zip(keys, offsets))      # key ซ้ำ: ตัวหลังชนะเหมือน dict
+    c = cpro.CompactIndex()
+    c.load(array('q', keys), array('q', offsets))
+    check_same(c, d)
+
+    # ต่อด้วยการแก้ไขหลัง bulk load
+    for k in list(d)[::7]:
+        del d[k]
+        del c[k]
+    for k in range(n, n + 50):
+        d[k] = k
+        c[k] = k
+    c.merge()
+    check_same(c, d)
+
+
+def test_reopened_store_index_matches_live_index(reg):
+    nb = reg.store('nb')
+    rnd = random.Random(7)
+    ids = rnd.sample(range(1, 10 ** 6), 3000)
+    nb.add_many([(i, cpro.pack_notebook(0, i, 'B', 'S', 2020, 1.0, 1)) for i in ids])
+    for i in ids[::3]:
+        nb.delete(i)
+    for i in ids[::3][:500]:
+        nb.add(cpro.pack_notebook(0, i, 'B', 'S', 2020, 1.0, 1), i)   # ลงช่องว่างเดิม
+    again = cpro.FixedRecordFile(nb.path, cpro.NB_FMT, cpro.NB_SIZE, 'notebook_id')
+    assert sorted(again.index.items()) == sorted(nb.index.items())
+    assert len(again.index) == 3000 - len(ids[::3]) + 500
@@ -0,0 +1,131 @@
+import struct
+
+import pytest
+
+import cpro
+
+FMT, SIZE = cpro.NB_FMT, cpro.NB_SIZE
+
+
+def rec(nid, deleted=0):
+    return cpro.pack_notebook(deleted, nid, 'B', f'SN{nid}', 2020, float(nid), 1)
+
+
+def legacy(path, n=10, holes=(3, 7), tail=b''):
+    with open(path, 'wb') as f:
+        for i in range(1, n + 1):
+            f.write(rec(i, 1 if i in holes else 0))
+        f.write(tail)
+    return str(path)
+
+
+def header_v1(count, live, holes, generation=4):
+    raw = struct.pack(cpro.HEADER_FMT, cpro.FILE_MAGIC, 1, cpro.HEADER_SIZE,
+                      SIZE, count, live, holes, generation, 0)
+    return raw + b'\x00' * cpro.HEADER_PAD
+
+
+def open_nb(path):
+    return cpro.FixedRecordFile(str(path), FMT, SIZE, 'notebook_id')
+
+
+def read_hdr(path):
+    with open(path, 'rb') as f:
+        return cpro.read_header(f)
+
+
+def test_new_file_has_header_and_counters(tmp_path):
+    db = open_nb(tmp_path / 'nb.dat')
+    for i in range(1, 6):
+        db.add(rec(i), i)
+    db.delete(2)
+    h = read_hdr(db.path)
+    assert (h['version'], h['record_count'], h['live'], h['holes']) == (cpro.FORMAT_VERSION, 5, 4, 1)
+    assert open_nb(db.path).stats() == {'active': 4, 'deleted': 1, 'holes': 1, 'total_slots': 5}
+
+
+def test_legacy_file_opens_and_migrates(tmp_path):
+    path = legacy(tmp_path / 'nb.dat')
+    db = open_nb(path)
+    assert db.header is None and db.data_start == 0
+    ids = sorted(db.index)
+    result = cpro.migrate_file(path, FMT, SIZE)
+    assert result['was_legacy'] and (result['records'], result['live'], result['holes']) == (10, 8, 2)
+    assert result['dropped_tail_bytes'] == 0
+    db = open_nb(path)
+    assert db.data_start == cpro.HEADER_SIZE and sorted(db.index) == ids
+    assert db.get(5)[1][5] == 5.0 and db.get(3) == (None, None)
+
+
+def test_partial_tail_is_dropped(tmp_path):
+    path = legacy(tmp_path / 'nb.dat', tail=b'\x01' * 7)
+    result = cpro.migrate_file(path, FMT, SIZE, chunk_records=3)
+    assert result['records'] == 10 and result['dropped_tail_bytes'] == 7
+    with open(path, 'rb') as f:
+        assert len(f.read()) == cpro.HEADER_SIZE + 10 * SIZE
+
+
+def test_v1_header_is_read_and_upgraded(tmp_path):
+    path = tmp_path / 'nb.dat'
+    with open(path, 'wb') as f:
+        f.write(header_v1(3, 3, 0))
+        f.write(rec(1) + rec(2) + rec(3))
+    db = open_nb(path)
+    assert db.header['version'] == 1 and db.header['flags'] == 0 and len(db.index) == 3
+    cpro.migrate_file(str(path), FMT, SIZE)
+    h = read_hdr(path)
+    assert (h['version'], h['generation'], h['record_count']) == (cpro.FORMAT_VERSION, 5, 3)
+
+
+def test_size_mismatch_raises_until_migrated(tmp_path):
+    db = open_nb(tmp_path / 'nb.dat')
+    for i in range(1, 6):
+        db.add(rec(i), i)
+    with open(db.path, 'r+b') as f:           # ระเบียนสุดท้ายเขียนไม่ครบ (ไฟดับ)
+        f.truncate(cpro.HEADER_SIZE + 4 * SIZE + 10)
+    with pytest.raises(cpro.CorruptFileError):
+        open_nb(db.path)
+    result = cpro.migrate_file(db.path, FMT, SIZE)
+    assert result['records'] == 4 and result['dropped_tail_bytes'] == 10
+    assert sorted(open_nb(db.path).index) == [1, 2, 3, 4]
+
+
+def test_inconsistent_or_foreign_headers_are_rejected(tmp_path):
+    path = tmp_path / 'nb.dat'
+    with open(path, 'wb') as f:                # live + holes ไม่เท่ากับ record_count
+        f.write(header_v1(2, 2, 1) + rec(1) + rec(2))
+    with pytest.raises(cpro.CorruptFileError):
+        open_nb(path)
+
+    with open(path, 'wb') as f:                # ขนาดระเบียนไม่ตรงกับ format
+        f.write(cpro.pack_header(SIZE + 4, 0, 0, 0, 0))
+    with pytest.raises(cpro.CorruptFileError):
+        open_nb(path)
+    with pytest.raises(cpro.CorruptFileError):
+        cpro.migrate_file(str(path), FMT, SIZE)
+
+    with open(path, 'wb') as f:                # รูปแบบจากโปรแกรมรุ่นใหม่กว่า
+        f.write(struct.pack(cpro.HEADER_FMT, cpro.FILE_MAGIC, cpro.FORMAT_VERSION + 1,
+                            cpro.HEADER_SIZE, SIZE, 0, 0, 0, 0, 0) + b'\x00' * cpro.HEADER_PAD)
+    with pytest.raises(cpro.CorruptFileError):
+        open_nb(path)
+
+
+def test_migrate_with_checksums_detects_corruption(tmp_path):
+    path = legacy(tmp_path / 'nb.dat')
+    cpro.migrate_file(path, FMT, SIZE, checksums=True)
+    db = open_nb(path)
+    assert db.header['flags'] & cpro.FLAG_CRC and db.stride == SIZE + cpro.CRC_SIZE
+    assert db.get(4)[1][5] == 4.0
+
+    offset = db.index[4]
+    with open(path, 'r+b') as f:
+        f.seek(offset + 12)
+        f.write(b'X')
+    with pytest.raises(cpro.CorruptFileError):
+        db.get(4)
+
+    cpro.migrate_file(path, FMT, SIZE, checksums=False)
+    db = open_nb(path)
+    assert db.stride == SIZE and not db.header['flags'] & cpro.FLAG_CRC
+    assert len(db.index) == 8
@@ -0,0 +1,53 @@
+import cpro
+
+
+def nb_rec(nid, brand='Asus', price=1.0, status=1):
+    return cpro.pack_notebook(0, nid, brand, f'SN{nid}', 2020, price, status)
+
+
+def test_primary_key_query_on_snapshot_reads_snapshot_version(reg):
+    nb = reg.store('nb')
+    nb.add_many([(i, nb_rec(i, price=float(i))) for i in range(1, 301)])
+    with nb.snapshot() as snap:
+        nb.update(2, nb_rec(2, price=999.0))
+        nb.delete(3)
+        nb.add(nb_rec(400), 400)
+        q = cpro.Query('nb', db=snap, reg=reg).where('notebook_id', 'in', [2, 3, 400])
+        assert q.explain().startswith('pk')
+        assert sorted((d['notebook_id'], d['price']) for d in q.run()) == [(2, 2.0), (3, 3.0)]
+    assert cpro.Query('nb', reg=reg).where('notebook_id', '==', 2).run()[0]['price'] == 999.0
+
+
+def test_primary_key_query_on_sharded_snapshot(tmp_path):
+    st = cpro.ShardedStore(str(tmp_path / 'shards'), 'nb', ['a', 'b'])
+    for i in range(1, 301):
+        st.add(nb_rec(i, price=float(i)), i)
+    with st.snapshot() as snap:
+        st.update(7, nb_rec(7, price=70.0))
+        st.delete(8)
+        q = cpro.Query('nb', db=snap).where('notebook_id', 'in', [7, 8, 9999])
+        assert q.explain().startswith('pk')
+        assert sorted((d['notebook_id'], d['price']) for d in q.run()) == [(7, 7.0), (8, 8.0)]
+
+
+def test_in_accepts_a_generator(reg):
+    nb = reg.store('nb')
+    nb.add_many([(i, nb_rec(i)) for i in range(1, 301)])
+    rows = cpro.Query('nb', reg=reg).where('notebook_id', 'in', (x for x in [2, 3])).run()
+    assert sorted(d['notebook_id'] for d in rows) == [2, 3]
+    rows = cpro.Query('nb', reg=reg).where('price', 'between', iter([0.5, 1.5])).limit(5).run()
+    assert len(rows) == 5
+
+
+def test_registry_indexes_only_for_registry_store(reg):
+    nb = reg.store('nb')
+    nb.add_many([(i, nb_rec(i, brand='Asus' if i % 10 == 0 else 'Dell')) for i in range(1, 501)])
+    reg.field_index('nb', 'brand')
+    q = cpro.Query('nb', reg=reg).where('brand', 'ieq', 'ASUS')
+    assert q.explain().startswith('index:brand')
+    assert len(q.run()) == 50
+    with nb.snapshot() as snap:
+        nb.update(10, nb_rec(10, brand='Dell'))
+        q = cpro.Query('nb', db=snap, reg=reg).where('brand', 'ieq', 'asus')
+        assert q.explain().startswith('scan')
+        assert len(q.run()) == 50
@@ -0,0 +1,71 @@
+import pytest
+
+import cpro
+
+
+@pytest.fixture
+def shop(reg):
+    cus, nb, so = reg.store('cus'), reg.store('nb'), reg.store('so')
+    for cid in (1, 2, 3):
+        cus.add(cpro.pack_customer(0, cid, f'c{cid}', 'addr', 'B', 'M', '081'), cid)
+    for nid in range(1, 7):
+        nb.add(cpro.pack_notebook(0, nid, 'B', f'SN{nid}', 2020, 1000.0, 0 if nid == 6 else 1), nid)
+    so.add(cpro.pack_soldout(0, 10, 6, 1, 'c1', '2024-01-01', 0), 10)
+    archive = reg.sales_archive()
+    archive.write_segment([(0, 900, 99, 1, b'old', b'2019-01-01', 0)])
+    return cus, nb, so, archive
+
+
+def file_bytes(*dbs):
+    out = []
+    for db in dbs:
+        with open(db.path, 'rb') as f:
+            out.append(f.read())
+    return out
+
+
+def record(shop, sales):
+    cus, nb, so, archive = shop
+    return cpro.record_sales(sales, cus_db=cus, nb_db=nb, so_db=so, archive=archive)
+
+
+def test_batch_is_written_and_notebooks_marked_sold(shop):
+    cus, nb, so, _ = shop
+    assert record(shop, [(11, 1, 1, '2024-02-01'), (12, 2, 3, '2024-02-02')]) == 2
+    assert cpro.unpack_soldout(so.get(12)[1])['name'] == 'c3'
+    assert [nb.get(n)[1][6] for n in (1, 2, 3)] == [0, 0, 1]
+
+
+def test_empty_batch_writes_nothing(shop):
+    cus, nb, so, _ = shop
+    before = file_bytes(nb, so)
+    versions = (nb.version, so.version)
+    assert record(shop, []) == 0
+    assert file_bytes(nb, so) == before
+    assert (nb.version, so.version) == versions
+
+
+@pytest.mark.parametrize('sales, message', [
+    ([(11, 1, 1, 'd'), (11, 2, 1, 'd')], 'sold_out_id 11 ซ้ำ'),
+    ([(11, 1, 1, 'd'), (10, 2, 1, 'd')], 'sold_out_id 10 ซ้ำ'),
+    ([(11, 1, 1, 'd'), (900, 2, 1, 'd')], 'sold_out_id 900 ซ้ำ'),
+    ([(11, 1, 1, 'd'), (12, 77, 1, 'd')], 'ไม่พบ notebook_id 77'),
+    ([(11, 1, 1, 'd'), (12, 2, 55, 'd')], 'ไม่พบ customer_id 55'),
+    ([(11, 1, 1, 'd'), (12, 1, 2, 'd')], 'notebook_id 1 ถูกขายซ้ำในชุดเดียวกัน'),
+    ([(11, 1, 1, 'd'), (12, 6, 2, 'd')], 'notebook_id 6 ขายไปแล้ว'),
+])
+def test_any_bad_row_rejects_the_whole_batch(shop, sales, message):
+    cus, nb, so, _ = shop
+    before = file_bytes(cus, nb, so)
+    with pytest.raises(ValueError) as err:
+        record(shop, sales)
+    assert message in str(err.value)
+    assert file_bytes(cus, nb, so) == before
+    assert 11 not in so.index and nb.get(1)[1][6] == 1
+
+
+def test_all_errors_are_reported_together(shop):
+    with pytest.raises(ValueError) as err:
+        record(shop, [(10, 77, 55, 'd')])
+    text = str(err.value)
+    assert 'sold_out_id 10 ซ้ำ' in text and 'notebook_id 77' in text and 'customer_id 55' in text
@@ -0,0 +1,125 @@
+import os
+import threading
+import time
+
+import cpro
+
+
+def nb_rec(nid, price):
+    return cpro.pack_notebook(0, nid, 'B', f'SN{nid}', 2020, price, 1)
+
+
+def test_follower_reads_never_see_a_half_shipped_round(reg, tmp_path):
+    """ทุกรอบ primary เปลี่ยนราคาทุกเครื่องเป็นเลขรอบ และลบ/เพิ่มอย่างละหนึ่ง
+    follower ที่อ่านพร้อมกับ ship() ต้องเห็นราคาเดียวกันทั้งไฟล์และจำนวนคงที่เสมอ"""
+    n = 300
+    nb = reg.store('nb')
+    nb.add_many([(i, nb_rec(i, 0.0)) for i in range(1, n + 1)])
+    rep = cpro.Replicator([str(tmp_path / 'f1')], reg.store('cus'), nb, reg.store('so'))
+    rep.ship()
+    follower = cpro.Follower(str(tmp_path / 'f1'))
+    store = follower.store('nb')
+
+    stop = threading.Event()
+    seen, errors = set(), []
+
+    def reader():
+        while not stop.is_set():
+            try:
+                recs = [rec for _, rec in store.iter_active()]
+                prices = {rec[5] for rec in recs}
+                if len(recs) != n or len(prices) != 1:
+                    errors.append((len(recs), sorted(prices)[:3]))
+                seen.update(prices)
+                # อ่านทีหลังต้องไม่ย้อนไปเห็นรอบที่เก่ากว่า
+                _, rec = store.get(n)
+                if rec is None or rec[5] < max(prices):
+                    errors.append(('get', rec and rec[5], max(prices)))
+            except Exception as e:   # noqa: BLE001 - ส่งต่อให้ assert ด้านล่าง
+                errors.append(repr(e))
+
+    t = threading.Thread(target=reader)
+    t.start()
+    try:
+        for k in range(1, 31):
+            live = [rid for rid in nb.index]
+            nb.update_many([(rid, nb_rec(rid, float(k))) for rid in live])
+            victim = min(live)
+            nb.delete(victim)
+            nb.add(nb_rec(victim + 100000, float(k)), victim + 100000)
+            rep.ship()
+            time.sleep(0.02)
+    finally:
+        stop.set()
+        t.join()
+
+    assert errors == []
+    assert len(seen) > 1
+    assert {rec[5] for _, rec in store.iter_active()} == {30.0}
+    assert rep.failed == {}
+
+
+def test_failed_follower_is_resynced_in_full(reg, tmp_path, monkeypatch):
+    nb = reg.store('nb')
+    nb.add_many([(i, nb_rec(i, 1.0)) for i in range(1, 51)])
+    d = str(tmp_path / 'f1')
+    rep = cpro.Replicator([d], reg.store('cus'), nb, reg.store('so'))
+    rep.ship()
+
+    nb.update(7, nb_rec(7, 9.0))
+    real = rep._ship_to
+
+    def broken(*args):
+        raise OSError('disk full')
+    monkeypatch.setattr(rep, '_ship_to', broken)
+    rep.ship()
+    assert d in rep.failed
+
+    # ช่วงที่เปลี่ยนในรอบที่ล้มเหลวถูกใช้ไปแล้ว รอบถัดไปต้องส่งทั้งไฟล์จึงจะเห็นค่าใหม่
+    monkeypatch.setattr(rep, '_ship_to', real)
+    rep.ship()
+    assert rep.failed == {}
+    assert cpro.Follower(d).store('nb').get(7)[1][5] == 9.0
+
+
+def test_slow_full_ship_keeps_follower_readable_and_writers_unblocked(reg, tmp_path, monkeypatch):
+    """สำเนาทั้งไฟล์หลัง compact ที่ใช้เวลานาน: follower ยังอ่านข้อมูลชุดก่อนได้
+    และผู้เขียนฝั่ง primary ไม่ต้องรอจนสำเนาเสร็จ"""
+    nb = reg.store('nb')
+    nb.add_many([(i, nb_rec(i, 1.0)) for i in range(1, 201)])
+    d = str(tmp_path / 'f1')
+    rep = cpro.Replicator([d], reg.store('cus'), nb, reg.store('so'))
+    rep.ship()
+    store = cpro.Follower(d).store('nb')
+    store.WAIT = 0.3
+    assert store.get(1)[1][5] == 1.0
+
+    nb.delete(200)
+    nb.compact()                      # ช่วงที่เปลี่ยนหายไป รอบถัดไปต้องสำเนาทั้งไฟล์
+    nb.update(1, nb_rec(1, 2.0))
+    copying = threading.Event()
+    real = cpro.Snapshot.iter_raw
+
+    def slow_iter_raw(self, *args, **kw):
+        for chunk in real(self, *args, **kw):
+            copying.set()
+            time.sleep(0.4)
+            yield chunk
+    monkeypatch.setattr(cpro.Snapshot, 'iter_raw', slow_iter_raw)
+
+    t = threading.Thread(target=rep.ship)
+    t.start()
+    assert copying.wait(5)
+    started = time.monotonic()
+    nb.update(2, nb_rec(2, 3.0))      # ไม่ติด STORE_LOCK ระหว่างสำเนา
+    assert time.monotonic() - started < 0.2
+    assert store.get(1)[1][5] == 1.0  # ยังเป็นข้อมูลชุดก่อน ไม่ error
+    t.join()
+
+    assert store.get(1)[1][5] == 2.0
+    assert store.get(200) == (None, None)
+    assert store.get(2)[1][5] == 1.0  # เขียนหลังเปิด snapshot ของรอบนี้: มากับรอบถัดไป
+    rep.ship()
+    assert store.get(2)[1][5] == 3.0
+    files = sorted(f for f in os.listdir(d) if f.startswith('Info_notebook'))
+    assert len(files) == 1
@@ -0,0 +1,121 @@
+import os
+import random
+
+import pytest
+
+import cpro
+
+FIELDS = ('name', 'address', 'tel')
+QUERIES = ['สม', 'สมพร', 'ถนน', 'ซอย1', '081', '12', 'na', 'a', 'ma ri', 'zz', 'ใหม่', 'ไม่มี']
+
+
+@pytest.fixture(autouse=True)
+def rebuilds(monkeypatch):
+    """ปิด autosave และนับจำนวนครั้งที่ดัชนีถูกสร้างใหม่จากแฟ้ม"""
+    monkeypatch.setattr(cpro.SearchIndex, 'SAVE_DELAY', None)
+    calls = []
+    rebuild = cpro.SearchIndex.rebuild
+
+    def counting(self):
+        calls.append(self.path)
+        return rebuild(self)
+    monkeypatch.setattr(cpro.SearchIndex, 'rebuild', counting)
+    return calls
+
+
+def cus_rec(cid, name, address, tel):
+    return cpro.pack_customer(0, cid, name, address, 'b', 'm', tel)
+
+
+def open_db(path):
+    return cpro.FixedRecordFile(path, cpro.CUS_FMT, cpro.CUS_SIZE, 'customer_id')
+
+
+def open_index(db):
+    return cpro.SearchIndex(db, cpro.unpack_customer, FIELDS)
+
+
+def brute(idx, db, query, prefix=False, fields=FIELDS):
+    """ผลที่ถูกต้องจากการไล่ทุกเรคอร์ดในแฟ้ม"""
+    q = cpro.normalize_text(query)
+    cols = [FIELDS.index(f) for f in fields]
+    hits = []
+    for _, rec in db.iter_active():
+        vals = idx._values_of(rec)
+        if any((vals[i].startswith(q) if prefix else q in vals[i]) for i in cols):
+            hits.append(rec[1])
+    return sorted(hits)
+
+
+def check(idx, db):
+    for q in QUERIES:
+        for prefix in (False, True):
+            assert idx.search(q, prefix=prefix) == brute(idx, db, q, prefix), (q, prefix)
+    assert idx.search('zz', fields=('name',)) == brute(idx, db, 'zz', fields=('name',))
+
+
+def fill(db, n, rng):
+    first = ['สมพร', 'สมชาย', 'มานี', 'Maria', 'Nana', 'John']
+    for cid in range(1, n + 1):
+        db.add(cus_rec(cid, f'{rng.choice(first)} {cid}', f'{cid} ถนน{rng.choice(first)} ซอย{cid % 30}',
+                       f'08{rng.randrange(10 ** 8):08d}'), cid)
+
+
+def test_matches_brute_force_after_writes_and_reload(tmp_path, rebuilds):
+    rng = random.Random(1)
+    db = open_db(str(tmp_path / 'cus.dat'))
+    fill(db, 300, rng)
+    idx = open_index(db)
+    check(idx, db)
+
+    # index/unindex ทีละเรคอร์ดผ่าน listener
+    next_id = 1000
+    for i in range(200):
+        cid = rng.randrange(1, 301)
+        if cid in db.index:
+            if rng.random() < 0.5:
+                db.delete(cid)
+            else:
+                db.update(cid, cus_rec(cid, f'ใหม่{i}', f'ซอย{i}', f'0999{i}'))
+        db.add(cus_rec(next_id, f'zz{i}', 'x', '1'), next_id)
+        next_id += 1
+    check(idx, db)
+
+    idx.save()
+    assert os.path.exists(idx.path)
+    with open(idx.path, 'rb') as f:
+        assert f.read(4) == cpro.SearchIndex.MAGIC
+
+    db = open_db(str(tmp_path / 'cus.dat'))
+    del rebuilds[:]
+    idx2 = open_index(db)
+    assert rebuilds == []                      # โหลดจาก .sidx ไม่ได้ rebuild
+    check(idx2, db)
+
+
+def test_stale_or_broken_file_is_rebuilt(tmp_path, rebuilds):
+    path = str(tmp_path / 'cus.dat')
+    db = open_db(path)
+    fill(db, 100, random.Random(2))
+    open_index(db).save()
+
+    # แก้แฟ้มโดยไม่มีดัชนีฟังอยู่ signature จึงไม่ตรงกับ .sidx
+    db = open_db(path)
+    db.delete(7)
+    db.add(cus_rec(500, 'zz ใหม่', 'ซอยใหม่', '0999'), 500)
+
+    db = open_db(path)
+    del rebuilds[:]
+    idx = open_index(db)
+    assert len(rebuilds) == 1
+    assert idx.search('zz') == [500]
+    check(idx, db)
+    idx.save()
+
+    with open(path + '.sidx', 'r+b') as f:
+        f.truncate(os.path.getsize(path + '.sidx') // 2)
+    db = open_db(path)
+    del rebuilds[:]
+    idx = open_index(db)
+    assert len(rebuilds) == 1
+    check(idx, db)
@@ -0,0 +1,93 @@
+import pytest
+
+import cpro
+
+
+def nb_rec(nid, brand='B', price=1.0):
+    return cpro.pack_notebook(0, nid, brand, f'SN{nid}', 2020, price, 1)
+
+
+def state(view):
+    return {rec[1]: rec for _, rec in view.iter_active()}
+
+
+def test_snapshot_ignores_overwrites_deletes_and_hole_reuse(reg):
+    nb = reg.store('nb')
+    for i in range(1, 21):
+        nb.add(nb_rec(i), i)
+    holes = {nb.index[4], nb.index[5]}
+    nb.delete(5)                      # ช่องว่างก่อนเปิด snapshot
+    before = state(nb)
+
+    with nb.snapshot() as snap:
+        nb.update(1, nb_rec(1, 'NEW', 9.0))
+        nb.update_many([(i, nb_rec(i, 'MANY', 8.0)) for i in (2, 3)])
+        nb.delete(4)
+        nb.add(nb_rec(100, 'HOLE'), 100)      # เขียนลงช่องของ id 5
+        nb.add(nb_rec(101, 'HOLE'), 101)      # เขียนลงช่องของ id 4
+        nb.add(nb_rec(102, 'TAIL'), 102)      # append หลัง end ของ snapshot
+
+        assert {nb.index[100], nb.index[101]} == holes
+        assert state(snap) == before
+        assert snap.get(1)[1] == before[1]
+        assert snap.get(4)[1] == before[4]
+        assert snap.get(100) == (None, None)
+        assert snap.get(102) == (None, None)
+        assert snap.stats()['active'] == len(before)
+
+        # แฟ้มจริงเห็นทุกการเปลี่ยนแปลง
+        assert nb.get(1)[1][2].rstrip(b'\x00') == b'NEW'
+        assert nb.get(4) == (None, None)
+        assert {100, 101, 102} <= set(state(nb))
+        with pytest.raises(RuntimeError):
+            nb.compact()
+
+    # ปิด snapshot แล้วไม่ต้องเก็บสำเนาเดิมอีก
+    assert nb._cow == {}
+
+
+def test_nested_snapshots_each_see_their_own_version(reg):
+    nb = reg.store('nb')
+    for i in range(1, 6):
+        nb.add(nb_rec(i, price=1.0), i)
+    first = nb.snapshot()
+    nb.update(3, nb_rec(3, price=2.0))
+    second = nb.snapshot()
+    nb.update(3, nb_rec(3, price=3.0))
+    nb.delete(2)
+    nb.add(nb_rec(50), 50)
+
+    assert first.get(3)[1][5] == 1.0
+    assert second.get(3)[1][5] == 2.0
+    assert 2 in state(first) and 2 in state(second)
+    assert 50 not in state(first) and 50 not in state(second)
+
+    first.close()
+    assert second.get(3)[1][5] == 2.0 and state(second)[2][1] == 2
+    second.close()
+    assert nb._cow == {}
+    assert nb.get(3)[1][5] == 3.0
+
+
+def test_snapshot_get_finds_moved_ids_without_scanning(reg, monkeypatch):
+    nb = reg.store('nb')
+    for i in range(1, 11):
+        nb.add(nb_rec(i, price=float(i)), i)
+    with nb.snapshot() as snap:
+        offset4 = nb.index[4]
+        nb.delete(4)
+        nb.delete(3)
+        nb.add(nb_rec(3, price=30.0), 3)     # id เดิมกลับมาในช่องของ id 4
+        assert nb.index[3] == offset4
+        nb.add(nb_rec(99), 99)
+
+        def no_scan(*args, **kw):
+            raise AssertionError('get ไม่ควรสแกนทั้งไฟล์')
+        monkeypatch.setattr(snap, 'iter_active', no_scan)
+        monkeypatch.setattr(snap, '_iter_slots', no_scan)
+
+        assert snap.get(3)[1][5] == 3.0
+        assert snap.get(4)[1][5] == 4.0
+        assert snap.get(99) == (None, None)
+        assert snap.get(12345) == (None, None)
+    assert nb._gone == {}
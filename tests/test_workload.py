@@ -0,0 +1,67 @@
+import filecmp
+import json
+import os
+import random
+import threading
+
+import cpro
+
+
+def nb_rec(nid, price=1.0):
+    return cpro.pack_notebook(0, nid, 'B', f'SN{nid}', 2020, price, 1)
+
+
+def test_trace_of_racing_writers_replays_to_the_same_file(tmp_path):
+    """add/delete ของ id ชุดเดียวกันจากหลาย thread: ลำดับใน trace ต้องเป็นลำดับที่แฟ้มรับจริง
+    replay จึงได้ไฟล์เหมือนเดิมทุก byte และจำนวน error ตรงกับที่บันทึกไว้"""
+    d = str(tmp_path)
+    reg = cpro.StoreRegistry(d, trace='trace.jsonl')
+    nb = reg.store('nb')
+
+    def writer(seed):
+        rnd = random.Random(seed)
+        for k in range(200):
+            rid = rnd.randrange(1, 15)
+            try:
+                if rnd.random() < 0.5:
+                    nb.add(nb_rec(rid, float(k)), rid)
+                elif rnd.random() < 0.7:
+                    nb.delete(rid)
+                else:
+                    nb.update_many([(rid, nb_rec(rid, float(-k)))])
+            except ValueError:
+                pass
+
+    threads = [threading.Thread(target=writer, args=(s,)) for s in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    reg.close()
+
+    trace = os.path.join(d, 'trace.jsonl')
+    with open(trace, encoding='utf-8') as f:
+        failed = sum(1 for line in f if json.loads(line).get('ok') is False)
+    assert failed > 0
+
+    summary = cpro.replay_trace(trace, str(tmp_path / 'replay'))
+    assert summary['mismatches'] == 0
+    assert summary['errors'] == failed
+    assert filecmp.cmp(os.path.join(d, 'Info_notebook.dat'),
+                       str(tmp_path / 'replay' / 'worker-0' / 'Info_notebook.dat'), shallow=False)
+
+
+def test_each_session_gets_its_own_trace_and_base(tmp_path):
+    d = str(tmp_path)
+    for k in (1, 2):
+        reg = cpro.StoreRegistry(d, trace='trace.jsonl')
+        nb = reg.store('nb')
+        nb.add_many([(k * 100 + i, nb_rec(k * 100 + i)) for i in range(5)])
+        nb.delete(k * 100)
+        nb.compact()
+        reg.close()
+    assert {'trace.jsonl', 'trace.jsonl.base', 'trace.jsonl.1', 'trace.jsonl.1.base'} <= set(os.listdir(d))
+    for name in ('trace.jsonl.1', 'trace.jsonl'):
+        summary = cpro.replay_trace(os.path.join(d, name), str(tmp_path / f'r-{name}'))
+        assert summary['errors'] == 0 and summary['mismatches'] == 0
+        assert set(summary['by_op']) == {'add_many', 'delete', 'compact'}